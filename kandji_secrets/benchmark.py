@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+
+"""Benchmark the Kandji scripts against a local fake Kandji API."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Starts fake_kandji_server.py in-process and runs every benchmark case in a fresh
+#   Python process against it, so that each case gets its own peak RSS figure. For each
+#   case it prints records per second, request count, request latency percentiles and
+#   peak RSS. --json also writes the results to a file for comparing runs.
+#
+#   python3 benchmark.py --devices 20000
+#   python3 benchmark.py --devices 5000 --latency-ms 80 --jitter-ms 40 --error-rate 0.01
+#   python3 benchmark.py --cases report-memory,report-stream --json results.json
+#
+################################################################################################
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# The scripts read their token on first use; the fake server does not check it.
+os.environ.setdefault("KANDJI_API_TOKEN", "benchmark")
+
+import requests  # noqa: E402
+
+import kandji_devices_report as report  # noqa: E402
+from fake_kandji_server import make_device, start_server  # noqa: E402
+from kandji_client import KandjiClient  # noqa: E402
+from kandji_json import CHUNK_SIZE, get_loads, iter_json_array  # noqa: E402
+
+
+class SkipCase(Exception):
+    """Raised by a case that cannot run here, e.g. without an optional module."""
+
+
+class PerCallClient:
+    """Opens a new session for every request, like kandji_api() used to."""
+
+    def __init__(self, base_url, headers):
+        self.base_url = base_url
+        self.headers = headers
+
+    def request(self, method, endpoint, params=None, payload=None):
+        with KandjiClient(self.base_url, headers=self.headers) as client:
+            return client.request(method, endpoint, params=params, payload=payload)
+
+
+class RequestTimer:
+    """Records the wall time of every HTTP request sent through requests."""
+
+    def __init__(self):
+        self.latencies = []
+
+    def install(self):
+        """Wrap requests.Session.request, which every requests call goes through."""
+        timer = self
+        original = requests.Session.request
+
+        def timed_request(session, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(session, *args, **kwargs)
+            finally:
+                timer.latencies.append(time.perf_counter() - start)
+
+        requests.Session.request = timed_request
+
+    def reset(self):
+        self.latencies = []
+
+    # the asyncio engine does not use requests, and reports its requests to Metrics.record
+    enabled = True
+
+    def record(self, status_code, seconds, size, retried=0):
+        self.latencies.append(seconds)
+
+    def retried(self):
+        pass
+
+
+# Modules that importing the scripts must not pull in
+DEFERRED_MODULES = ("requests", "urllib3", "dateutil", "dotenv", "sqlite3", "pyarrow", "aiohttp")
+
+IMPORT_CHECK = """
+import sys
+import kandji_devices_report, kandji_device_secrets
+print(" ".join(sorted({name.split(".")[0] for name in sys.modules} & set(sys.argv[1:]))))
+"""
+
+
+def percentile_ms(values, fraction):
+    """Return the nearest-rank percentile of a list of seconds in milliseconds, or None."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+
+def recursive_flatten(input_dict, separator="_", prefix=""):
+    """The recursive flatten() the report used before, kept for comparison."""
+    output_dict = {}
+    for key, value in input_dict.items():
+        if isinstance(value, dict) and value:
+            deeper = recursive_flatten(value, separator, prefix + key + separator)
+            output_dict.update({key2: val2 for key2, val2 in deeper.items()})
+        elif isinstance(value, list) and value:
+            for index, sublist in enumerate(value, start=1):
+                if isinstance(sublist, dict) and sublist:
+                    deeper = recursive_flatten(
+                        sublist, separator, prefix + key + separator + str(index) + separator
+                    )
+                    output_dict.update({key2: val2 for key2, val2 in deeper.items()})
+                else:
+                    output_dict[prefix + key + separator + str(index)] = sublist
+        else:
+            output_dict[prefix + key] = value
+    return output_dict
+
+
+########################################################################################
+# Cases. Each takes the parsed arguments and returns the number of records handled.
+########################################################################################
+
+
+def case_pool_per_call(args):
+    """get_devices() with a new session for every page."""
+    client = PerCallClient(args.base_url, report.HEADERS)
+    return len(report.get_devices(params={}, client=client))
+
+
+def case_pool_shared(args):
+    """get_devices() with the shared keep-alive pool."""
+    client = KandjiClient(args.base_url, headers=report.HEADERS)
+    return len(report.get_devices(params={}, client=client))
+
+
+def pages_case(workers):
+    """Return a case that runs get_devices() with `workers` concurrent pages."""
+
+    def case_pages(args):
+        client = KandjiClient(args.base_url, headers=report.HEADERS, pool_size=workers)
+        devices = report.get_devices(params={}, client=client, workers=workers)
+        serials = [device["serial_number"] for device in devices]
+        if serials != sorted(serials):
+            raise SystemExit(f"get_devices(workers={workers}) returned pages out of order")
+        return len(devices)
+
+    return case_pages
+
+
+def case_flatten_recursive(args):
+    """The old recursive flatten on synthetic devices."""
+    devices = [make_device(index) for index in range(args.flatten_docs)]
+    args.timer.start = time.perf_counter()
+    return len([recursive_flatten(device) for device in devices])
+
+
+def case_flatten_iterative(args):
+    """flatten() on synthetic devices."""
+    devices = [make_device(index) for index in range(args.flatten_docs)]
+    args.timer.start = time.perf_counter()
+    rows = [report.flatten(device) for device in devices]
+    if [recursive_flatten(device) for device in devices[:100]] != rows[:100]:
+        raise SystemExit("flatten() output differs from recursive_flatten()")
+    return len(rows)
+
+
+def case_report_memory(args):
+    """iter_devices -> generate_report_payload -> write_report, with the rows in memory."""
+    client = KandjiClient(args.base_url, headers=report.HEADERS, pool_size=args.workers)
+    devices = report.iter_devices(params={}, client=client, workers=args.workers)
+    payload = report.generate_report_payload(devices)
+    with tempfile.TemporaryDirectory() as tmp:
+        report.write_report(payload, os.path.join(tmp, "report.csv"))
+    return len(payload)
+
+
+def case_report_stream(args):
+    """The --stream pipeline, iter_devices -> iter_report_payload -> write_report_stream."""
+    client = KandjiClient(args.base_url, headers=report.HEADERS, pool_size=args.workers)
+    records = report.iter_devices(params={}, client=client, workers=args.workers)
+    with tempfile.TemporaryDirectory() as tmp:
+        return report.write_report_stream(
+            report.iter_report_payload(records), os.path.join(tmp, "report.csv")
+        )
+
+
+def decode_case(decoder):
+    """Return a case that decodes synthetic device pages with a --json-decoder."""
+
+    def case_decode(args):
+        if decoder == "orjson" and importlib.util.find_spec("orjson") is None:
+            raise SkipCase("orjson is not installed")
+        devices = [make_device(index) for index in range(args.flatten_docs)]
+        limit = report.DEVICE_PAGE_LIMIT
+        pages = [
+            json.dumps(devices[start : start + limit]).encode()
+            for start in range(0, len(devices), limit)
+        ]
+
+        args.timer.start = time.perf_counter()
+        if decoder == "stream":
+            decoded = [
+                list(
+                    iter_json_array(
+                        page[start : start + CHUNK_SIZE]
+                        for start in range(0, len(page), CHUNK_SIZE)
+                    )
+                )
+                for page in pages
+            ]
+        else:
+            loads = get_loads(decoder)
+            decoded = [loads(page) for page in pages]
+        if decoded[0] != devices[:limit]:
+            raise SystemExit(f"The {decoder} decoder returned different records")
+        return sum(len(page) for page in decoded)
+
+    return case_decode
+
+
+def fetch_case(decoder):
+    """Return a case that runs the --stream report with a single worker and a decoder.
+
+    Also records how long the first record took to reach the flatten step.
+    """
+
+    def case_fetch(args):
+        report.JSON_DECODER = decoder
+        client = KandjiClient(args.base_url, headers=report.HEADERS)
+        records = report.iter_devices(params={}, client=client)
+
+        def first_timed(records):
+            for record in records:
+                if args.first_record is None:
+                    args.first_record = time.perf_counter() - args.timer.start
+                yield record
+
+        with tempfile.TemporaryDirectory() as tmp:
+            return report.write_report_stream(
+                report.iter_report_payload(first_timed(records)),
+                os.path.join(tmp, "report.csv"),
+            )
+
+    return case_fetch
+
+
+def case_enrich(args):
+    """--enrich details,apps for the first --enrich-devices devices of the tenant."""
+    client = KandjiClient(args.base_url, headers=report.HEADERS, pool_size=args.workers)
+    devices = report.get_devices(params={}, client=client)[: args.enrich_devices]
+
+    # only the per-device calls count towards this case
+    args.timer.reset()
+    args.timer.start = time.perf_counter()
+    enricher = report.DeviceEnricher(report.ENRICH_KINDS, workers=args.workers, client=client)
+    return len(list(enricher.enrich(devices)))
+
+
+def secrets_case(workers, engine="threads"):
+    """Return a case that runs fetch_device_secrets() for the first --secrets-devices
+    devices of the tenant, with `workers` concurrent calls (None for --workers), or
+    fetch_device_secrets_asyncio() with engine="asyncio"."""
+
+    def case_secrets(args):
+        import kandji_device_secrets as secrets
+
+        concurrent = workers or args.workers
+        secrets.url_base = f"{args.base_url}/v1"
+        secrets.client = KandjiClient(
+            secrets.url_base, headers=report.HEADERS, pool_size=concurrent
+        )
+        client = KandjiClient(args.base_url, headers=report.HEADERS)
+        devices = report.get_devices(params={}, client=client)[: args.secrets_devices]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            device_report = os.path.join(tmp, "devices.csv")
+            report.write_report(report.generate_report_payload(devices), device_report)
+            rows = secrets.parse_csv_report(device_report)
+
+        # only the secrets calls count towards this case
+        args.timer.reset()
+        args.timer.start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if engine == "asyncio":
+                secrets.metrics = args.timer
+                device_secrets = secrets.fetch_device_secrets_asyncio(rows, concurrent, None)
+            else:
+                device_secrets = secrets.fetch_device_secrets(rows, workers=concurrent)
+        if [row["device_id"] for row in device_secrets] != [row["device_id"] for row in rows]:
+            raise SystemExit(
+                f"fetch_device_secrets(workers={concurrent}) returned rows out of order"
+            )
+        return len(device_secrets)
+
+    return case_secrets
+
+
+def case_import(args):
+    """Start a fresh interpreter that imports both scripts, --import-runs times.
+
+    Runs without KANDJI_API_TOKEN, and fails if importing needs it or loads any of
+    DEFERRED_MODULES. --help and --version must work without a token too.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = {key: value for key, value in os.environ.items() if key != "KANDJI_API_TOKEN"}
+
+    for flag in ("--help", "--version"):
+        subprocess.run(
+            [sys.executable, os.path.join(here, "kandji_devices_report.py"), flag],
+            check=True,
+            capture_output=True,
+            cwd=tempfile.gettempdir(),
+            env=env,
+        )
+
+    for _ in range(args.import_runs):
+        child = subprocess.run(
+            [sys.executable, "-c", IMPORT_CHECK, *DEFERRED_MODULES],
+            capture_output=True,
+            text=True,
+            cwd=here,
+            env=env,
+        )
+        if child.returncode != 0:
+            raise SystemExit(f"Importing the scripts failed:\n{child.stderr}")
+        if child.stdout.strip():
+            raise SystemExit(f"Importing the scripts loaded {child.stdout.strip()}")
+    return args.import_runs
+
+
+CASES = {
+    "pool-per-call": case_pool_per_call,
+    "pool-shared": case_pool_shared,
+    "pages-1": pages_case(1),
+    "pages-4": pages_case(4),
+    "pages-8": pages_case(8),
+    "flatten-recursive": case_flatten_recursive,
+    "flatten-iterative": case_flatten_iterative,
+    "report-memory": case_report_memory,
+    "report-stream": case_report_stream,
+    "decode-json": decode_case("json"),
+    "decode-orjson": decode_case("orjson"),
+    "decode-stream": decode_case("stream"),
+    "fetch-json": fetch_case("json"),
+    "fetch-stream": fetch_case("stream"),
+    "enrich": case_enrich,
+    "secrets": secrets_case(1),
+    "secrets-workers": secrets_case(None),
+    "secrets-asyncio": secrets_case(None, engine="asyncio"),
+    "import": case_import,
+}
+
+
+def peak_rss_mib():
+    """Return the peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_case(args):
+    """Run a single case in this process and print its best run as JSON."""
+    args.timer = RequestTimer()
+    args.timer.install()
+    case = CASES[args.case]
+
+    best = None
+    for _ in range(args.repeat):
+        args.timer.reset()
+        args.first_record = None
+        # cases move the start past any setup they do not want timed
+        args.timer.start = time.perf_counter()
+        try:
+            records = case(args)
+        except SkipCase as skip:
+            print(json.dumps({"case": args.case, "skipped": str(skip)}))
+            return
+        seconds = time.perf_counter() - args.timer.start
+        if best is None or seconds < best["seconds"]:
+            latencies = args.timer.latencies
+            best = {
+                "case": args.case,
+                "records": records,
+                "seconds": seconds,
+                "records_per_second": records / seconds if seconds else None,
+                "requests": len(latencies),
+                "p50_ms": percentile_ms(latencies, 0.50),
+                "p99_ms": percentile_ms(latencies, 0.99),
+                "first_record_ms": (
+                    None if args.first_record is None else args.first_record * 1000
+                ),
+            }
+
+    best["peak_rss_mib"] = peak_rss_mib()
+    print(json.dumps(best))
+
+
+def format_ms(value):
+    """Return milliseconds for the summary table."""
+    return "-" if value is None else f"{value:.1f}"
+
+
+def main():
+    """Start the fake tenant, run each case in its own process and print a summary."""
+    parser = argparse.ArgumentParser(prog="benchmark", allow_abbrev=False)
+    parser.add_argument("--devices", type=int, default=20000, help="Number of synthetic devices.")
+    parser.add_argument("--repeat", type=int, default=3, help="Best-of-N runs per case.")
+    parser.add_argument(
+        "--cases",
+        type=str,
+        default=",".join(CASES),
+        help=f"Comma separated cases to run (default: all). Available: {', '.join(CASES)}.",
+    )
+    parser.add_argument(
+        "--handshake-ms",
+        type=float,
+        default=50.0,
+        help="Simulated TCP+TLS setup cost per new connection (default: 50).",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=50.0,
+        help="Simulated network round-trip per request (default: 50).",
+    )
+    parser.add_argument(
+        "--jitter-ms",
+        type=float,
+        default=0.0,
+        help="Add up to this much random delay to every request (default: 0).",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="Answer 429 above this many requests per second (default: off).",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with --error-status (default: 0).",
+    )
+    parser.add_argument(
+        "--error-status",
+        type=int,
+        default=503,
+        help="Status code for injected errors (default: 503).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Concurrent requests for the report, enrich and secrets-* cases (default: 8).",
+    )
+    parser.add_argument(
+        "--flatten-docs",
+        type=int,
+        default=50000,
+        help="Number of synthetic device documents for the flatten cases.",
+    )
+    parser.add_argument(
+        "--enrich-devices",
+        type=int,
+        default=1000,
+        help="Number of devices to enrich in the enrich case (default: 1000).",
+    )
+    parser.add_argument(
+        "--secrets-devices",
+        type=int,
+        default=200,
+        help="Number of devices to fetch secrets for in the secrets case (default: 200).",
+    )
+    parser.add_argument(
+        "--import-runs",
+        type=int,
+        default=20,
+        help="Number of fresh interpreters started by the import case (default: 20).",
+    )
+    parser.add_argument(
+        "--json", type=str, metavar="FILENAME", help="Also write the results to this file."
+    )
+    # used to run a single case in a child process
+    parser.add_argument("--case", type=str, choices=list(CASES), help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args)
+        return
+
+    cases = [name.strip() for name in args.cases.split(",")]
+    for name in cases:
+        if name not in CASES:
+            parser.error(f"Unknown case {name}. Available: {', '.join(CASES)}")
+
+    server, base_url = start_server(
+        devices=args.devices,
+        handshake=args.handshake_ms / 1000,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+
+    results = []
+    try:
+        print(f"Fake tenant: {args.devices} devices at {base_url}\n")
+        print(
+            f"{'case':<18} {'records':>8} {'seconds':>8} {'records/s':>10} {'requests':>8} "
+            f"{'p50 ms':>7} {'p99 ms':>7} {'first ms':>8} {'RSS MiB':>8}"
+        )
+        for name in cases:
+            command = [
+                sys.executable,
+                os.path.abspath(__file__),
+                f"--case={name}",
+                f"--base-url={base_url}",
+                f"--repeat={args.repeat}",
+                f"--workers={args.workers}",
+                f"--flatten-docs={args.flatten_docs}",
+                f"--enrich-devices={args.enrich_devices}",
+                f"--secrets-devices={args.secrets_devices}",
+                f"--import-runs={args.import_runs}",
+            ]
+            child = subprocess.run(command, capture_output=True, text=True)
+            if child.returncode != 0:
+                print(child.stderr, file=sys.stderr)
+                raise SystemExit(f"Benchmark case {name} failed")
+
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            results.append(result)
+            if "skipped" in result:
+                print(f"{name:<18} skipped: {result['skipped']}")
+                continue
+            print(
+                f"{name:<18} {result['records']:>8} {result['seconds']:>8.3f} "
+                f"{result['records_per_second'] or 0:>10.0f} {result['requests']:>8} "
+                f"{format_ms(result['p50_ms']):>7} {format_ms(result['p99_ms']):>7} "
+                f"{format_ms(result['first_record_ms']):>8} "
+                f"{result['peak_rss_mib']:>8.1f}"
+            )
+        print(f"\nServer status codes: {dict(sorted(server.tenant.status_codes.items()))}")
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, mode="w", encoding="utf-8") as json_file:
+            settings = {
+                key: value
+                for key, value in vars(args).items()
+                if key not in ("json", "case", "base_url")
+            }
+            json.dump({"settings": settings, "results": results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the Kandji API, used for benchmarking the Kandji scripts."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Serves a synthetic inventory of N devices so that the scripts in this directory can
+#   be measured without a live tenant:
+#
+#       /api/v1/devices                                  paged device list
+#       /api/v1/devices/{id}                             device record
+#       /api/v1/devices/{id}/details                     nested device details
+#       /api/v1/devices/{id}/apps                        installed apps
+#       /api/v1/devices/{id}/secrets/filevaultkey        Macs only
+#       /api/v1/devices/{id}/secrets/unlockpin           Macs only
+#       /api/v1/devices/{id}/secrets/bypasscode
+#
+#   Latency, jitter, a requests-per-second ceiling (429 + Retry-After) and random 5xx
+#   errors can be configured to reproduce a busy tenant. With --etags every 200 carries
+#   an ETag and a matching If-None-Match is answered with 304 Not Modified.
+#
+#   python3 fake_kandji_server.py --devices 20000 --port 8765
+#
+################################################################################################
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PLATFORMS = {
+    "Mac": ["MacBook Pro (14-inch, 2021)", "MacBook Air (M2, 2022)", "Mac mini (2023)"],
+    "iPhone": ["iPhone 14", "iPhone 15 Pro"],
+    "iPad": ["iPad Air (5th generation)", "iPad Pro (11-inch)"],
+    "AppleTV": ["Apple TV 4K"],
+}
+
+OS_VERSIONS = {
+    "Mac": ["12.6.8", "13.5.2", "13.6", "14.0", "14.1.1"],
+    "iPhone": ["16.6", "17.0.3", "17.1"],
+    "iPad": ["16.6", "17.1"],
+    "AppleTV": ["16.6", "17.0"],
+}
+
+
+def make_device(index, seed=0):
+    """Return a synthetic device record shaped like a GET /v1/devices entry."""
+    rnd = random.Random(seed * 1_000_003 + index)
+    platform = rnd.choice(list(PLATFORMS))
+    last_check_in = datetime(2024, 1, 1, tzinfo=timezone.utc) - timedelta(
+        minutes=rnd.randrange(0, 60 * 24 * 365)
+    )
+    serial = "".join(rnd.choice("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789") for _ in range(10))
+
+    return {
+        "device_id": str(uuid.UUID(int=rnd.getrandbits(128))),
+        "device_name": f"{platform}-{index:06d}",
+        "model": rnd.choice(PLATFORMS[platform]),
+        "serial_number": serial,
+        "platform": platform,
+        "os_version": rnd.choice(OS_VERSIONS[platform]),
+        "last_check_in": last_check_in.isoformat().replace("+00:00", "Z"),
+        "user": {
+            "email": f"user{index}@example.com",
+            "name": f"User {index}",
+            "id": index,
+            "is_archived": False,
+        },
+        "asset_tag": "" if rnd.random() < 0.5 else f"AT-{index:06d}",
+        "blueprint_id": str(uuid.UUID(int=rnd.getrandbits(128))),
+        "mdm_enabled": True,
+        "agent_installed": platform == "Mac",
+        "is_missing": rnd.random() < 0.02,
+        "is_removed": False,
+        "agent_version": "4.2.1" if platform == "Mac" else "",
+        "first_enrollment": "2022-03-01T10:00:00Z",
+        "last_enrollment": "2023-06-01T10:00:00Z",
+        "blueprint_name": rnd.choice(["Standard", "Engineering", "Kiosk"]),
+        "lost_mode_status": "",
+        "tags": [rnd.choice(["remote", "office", "loaner"])],
+    }
+
+
+APPS = [
+    ("Google Chrome", "com.google.Chrome"),
+    ("Slack", "com.tinyspeck.slackmacgap"),
+    ("Zoom", "us.zoom.xos"),
+    ("Microsoft Word", "com.microsoft.Word"),
+    ("1Password", "com.1password.1password"),
+    ("Visual Studio Code", "com.microsoft.VSCode"),
+    ("Firefox", "org.mozilla.firefox"),
+    ("Kandji Self Service", "io.kandji.KandjiSelfService"),
+]
+
+
+def make_details(device, index, seed=0):
+    """Return synthetic GET /v1/devices/{id}/details data for a device."""
+    rnd = random.Random(seed * 1_000_003 + index + 7)
+    return {
+        "general": {
+            "device_id": device["device_id"],
+            "device_name": device["device_name"],
+            "platform": device["platform"],
+            "model": device["model"],
+            "os_version": device["os_version"],
+            "last_enrollment": device["last_enrollment"],
+            "blueprint_name": device["blueprint_name"],
+        },
+        "mdm": {
+            "mdm_enabled": True,
+            "supervised": rnd.random() < 0.9,
+            "last_check_in": device["last_check_in"],
+        },
+        "hardware_overview": {
+            "serial_number": device["serial_number"],
+            "processor_name": rnd.choice(["Apple M1", "Apple M2", "Intel Core i7"]),
+            "memory": rnd.choice(["8 GB", "16 GB", "32 GB"]),
+            "model_identifier": rnd.choice(["MacBookPro18,3", "Mac14,2", "iPhone15,2"]),
+        },
+        "volumes": [
+            {
+                "name": name,
+                "format": "APFS",
+                "capacity": f"{rnd.choice([256, 512, 1024])} GB",
+                "available": f"{rnd.randrange(10, 200)} GB",
+                "encrypted": rnd.random() < 0.95,
+            }
+            for name in ("Macintosh HD", "Data")
+        ],
+        "network": {
+            "local_hostname": device["device_name"],
+            "mac_address": ":".join(f"{rnd.randrange(256):02x}" for _ in range(6)),
+            "ip_address": f"10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}",
+        },
+        "filevault": {
+            "filevault_enabled": device["platform"] == "Mac",
+            "filevault_prk_escrowed": device["platform"] == "Mac",
+        },
+        "users": {
+            "regular_users": [{"username": f"user{index}", "uid": "501", "admin": False}],
+        },
+    }
+
+
+def make_apps(device, index, seed=0):
+    """Return synthetic GET /v1/devices/{id}/apps data for a device."""
+    rnd = random.Random(seed * 1_000_003 + index + 13)
+    apps = rnd.sample(APPS, rnd.randrange(2, len(APPS)))
+    return {
+        "device_id": device["device_id"],
+        "apps": [
+            {
+                "app_name": name,
+                "bundle_id": bundle_id,
+                "version": f"{rnd.randrange(1, 4)}.{rnd.randrange(0, 3)}",
+                "source": "Kandji",
+            }
+            for name, bundle_id in apps
+        ],
+    }
+
+
+def make_secret(device, index, secret, seed=0):
+    """Return (status, body) for a device secret request."""
+    rnd = random.Random(seed * 1_000_003 + index + 17)
+    is_mac = device["platform"] == "Mac"
+    if secret == "filevaultkey" and is_mac:
+        return 200, {"key": "-".join(f"{rnd.randrange(16**4):04X}" for _ in range(6))}
+    if secret == "unlockpin" and is_mac:
+        return 200, {"pin": f"{rnd.randrange(10**6):06d}"}
+    if secret == "bypasscode":
+        return 200, {
+            "user_based_albc": "-".join(f"{rnd.randrange(16**4):04X}" for _ in range(4)),
+            "device_based_albc": "-".join(f"{rnd.randrange(16**4):04X}" for _ in range(4)),
+        }
+    return 404, {"detail": "Not found."}
+
+
+DEVICE_PATH_RE = re.compile(
+    r"^/api/v1/devices/(?P<device_id>[^/]+)"
+    r"(?:/(?P<section>details|apps|secrets/(?:filevaultkey|bypasscode|unlockpin)))?/?$"
+)
+
+
+class FakeKandji:
+    """Synthetic tenant state shared by the request handlers."""
+
+    def __init__(
+        self,
+        devices=1000,
+        seed=0,
+        handshake=0.0,
+        latency=0.0,
+        jitter=0.0,
+        record_latency=0.0,
+        rate_limit=0.0,
+        error_rate=0.0,
+        error_status=503,
+        etags=False,
+    ):
+        # seconds of delay added to every new connection, standing in for TCP+TLS setup
+        self.handshake = handshake
+        # seconds of delay added to every request, standing in for the network round-trip
+        self.latency = latency
+        # up to this many extra seconds of random delay per request
+        self.jitter = jitter
+        # seconds of delay per device in a device list page, standing in for a slow query
+        self.record_latency = record_latency
+        # requests per second allowed before answering 429, 0 for no limit
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.updated = time.monotonic()
+        # fraction of requests answered with error_status
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # send ETags and answer If-None-Match with 304
+        self.etags = etags
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.status_codes = {}
+        self.devices = [make_device(i, seed) for i in range(devices)]
+        self.index = {device["device_id"]: i for i, device in enumerate(self.devices)}
+        self.lock = threading.Lock()
+        self.requests = 0
+        # (platform, ordering) -> filtered and sorted device list
+        self.views = {}
+
+    def admit(self):
+        """Return the status code to answer the next request with."""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate_limit:
+                self.tokens = min(
+                    self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit
+                )
+                self.updated = now
+                if self.tokens < 1:
+                    status = 429
+                else:
+                    self.tokens -= 1
+                    status = 200
+            else:
+                status = 200
+            if status == 200 and self.random.random() < self.error_rate:
+                status = self.error_status
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+            return status
+
+    def device_view(self, platform=None, ordering=None):
+        """Return the filtered, ordered device list, cached between pages."""
+        key = (platform, ordering)
+        with self.lock:
+            if key not in self.views:
+                records = self.devices
+                if platform:
+                    records = [d for d in records if d["platform"] == platform]
+                if ordering:
+                    reverse = ordering.startswith("-")
+                    field = ordering.lstrip("-")
+                    records = sorted(
+                        records, key=lambda d: str(d.get(field, "")), reverse=reverse
+                    )
+                self.views[key] = records
+            return self.views[key]
+
+    def delay(self):
+        """Return the simulated network delay for one request."""
+        if not self.jitter:
+            return self.latency
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.jitter)
+
+    def device_resource(self, device_id, section):
+        """Return (status, body) for a single device endpoint."""
+        index = self.index.get(device_id)
+        if index is None:
+            return 404, {"detail": "Not found."}
+        device = self.devices[index]
+        if section is None:
+            return 200, device
+        if section == "details":
+            return 200, make_details(device, index, self.seed)
+        if section == "apps":
+            return 200, make_apps(device, index, self.seed)
+        return make_secret(device, index, section.split("/")[1], self.seed)
+
+    def list_devices(self, query):
+        """Return one page of devices for the query string dict."""
+        records = self.device_view(query.get("platform"), query.get("ordering"))
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 300))
+        return records[offset : offset + limit]
+
+
+def make_handler(tenant):
+    """Return a request handler class bound to the tenant."""
+
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so that clients can keep connections alive.
+        protocol_version = "HTTP/1.1"
+        # headers and body go out in separate writes. With Nagle on, the body waits for
+        # the client's delayed ACK, adding ~40ms to every keep-alive request.
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            if tenant.handshake:
+                time.sleep(tenant.handshake)
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            raw = json.dumps(body).encode()
+            headers = dict(headers or {})
+            if tenant.etags and status == 200:
+                etag = f'"{hashlib.blake2b(raw, digest_size=16).hexdigest()}"'
+                headers["ETag"] = etag
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            with tenant.lock:
+                tenant.requests += 1
+            delay = tenant.delay()
+            if delay:
+                time.sleep(delay)
+
+            status = tenant.admit()
+            if status == 429:
+                self.send_json(429, {"detail": "Rate limit exceeded."}, {"Retry-After": "1"})
+                return
+            if status >= 500:
+                self.send_json(status, {"detail": "Service unavailable."})
+                return
+
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            device_path = DEVICE_PATH_RE.match(url.path)
+
+            if url.path.rstrip("/") == "/api/v1/devices":
+                page = tenant.list_devices(query)
+                if tenant.record_latency:
+                    time.sleep(tenant.record_latency * len(page))
+                self.send_json(200, page)
+            elif device_path:
+                self.send_json(
+                    *tenant.device_resource(device_path["device_id"], device_path["section"])
+                )
+            else:
+                self.send_json(404, {"detail": "Not found."})
+
+    return Handler
+
+
+def start_server(port=0, **tenant_options):
+    """Start a fake tenant in a background thread.
+
+    tenant_options are passed to FakeKandji.
+    Returns (server, base_url). Call server.shutdown() when done.
+    """
+    tenant = FakeKandji(**tenant_options)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(tenant))
+    server.daemon_threads = True
+    server.tenant = tenant
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api"
+
+
+def main():
+    """Run the fake tenant in the foreground."""
+    parser = argparse.ArgumentParser(prog="fake_kandji_server", allow_abbrev=False)
+    parser.add_argument("--devices", type=int, default=1000, help="Number of synthetic devices.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic inventory.")
+    parser.add_argument(
+        "--handshake-ms",
+        type=float,
+        default=0.0,
+        help="Delay added to every new connection to simulate TCP+TLS setup.",
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="Delay added to every request."
+    )
+    parser.add_argument(
+        "--jitter-ms", type=float, default=0.0, help="Up to this much extra random delay."
+    )
+    parser.add_argument(
+        "--record-latency-ms",
+        type=float,
+        default=0.0,
+        help="Delay per device in a device list page, so that large pages are slow.",
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0.0, help="Requests per second before a 429."
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 5xx."
+    )
+    parser.add_argument(
+        "--error-status", type=int, default=503, help="Status code for injected errors."
+    )
+    parser.add_argument(
+        "--etags", action="store_true", help="Send ETags and answer If-None-Match with 304."
+    )
+    args = parser.parse_args()
+
+    server, base_url = start_server(
+        devices=args.devices,
+        port=args.port,
+        seed=args.seed,
+        handshake=args.handshake_ms / 1000,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        record_latency=args.record_latency_ms / 1000,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        etags=args.etags,
+    )
+    print(f"Fake Kandji API listening at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
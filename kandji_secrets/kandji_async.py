@@ -0,0 +1,153 @@
+"""asyncio HTTP client for the Kandji API scripts."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   AsyncKandjiClient is the event loop counterpart of KandjiClient, for work that is
+#   nothing but many small independent requests, such as dumping device secrets. A
+#   single thread drives every request, so thousands can be in flight for the cost of a
+#   coroutine each instead of a thread each.
+#
+#   A semaphore caps the number of requests in flight and the same RateLimiter token
+#   bucket as KandjiClient caps the requests per second, backing off on 429s. 429, 502,
+#   503 and 504 responses, timeouts and dropped connections are retried with
+#   exponential backoff, honouring Retry-After.
+#
+#   Needs aiohttp (python3 -m pip install aiohttp), imported when the client is opened.
+#
+################################################################################################
+
+import asyncio
+import time
+
+from kandji_client import RateLimiter, retry_after
+from kandji_output import import_optional
+
+# Status codes worth another try, as retried by KandjiClient and urllib3
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class AsyncResponse:
+    """Status and body of a completed request."""
+
+    __slots__ = ("status_code", "text")
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class AsyncKandjiClient:
+    """Connection pool and request budget for a single Kandji tenant on an event loop.
+
+    base_url     - the tenant API URL, e.g. https://example.api.kandji.io/api
+    headers      - default headers sent with every request.
+    concurrency  - number of requests in flight at once.
+    retries      - number of retries for 5xx responses, timeouts and connection errors.
+    rate_limit_retries - number of retries for 429 responses.
+    backoff      - backoff factor between retries (seconds, doubled each retry).
+    timeout      - per-request timeout in seconds.
+    rate_limit   - request budget in requests per second, or a RateLimiter to share.
+                   None or 0 disables rate limiting.
+    metrics      - optional kandji_metrics.Metrics that records every response.
+
+    Use it as an async context manager: async with AsyncKandjiClient(...) as client.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        headers=None,
+        concurrency=100,
+        retries=3,
+        backoff=0.5,
+        timeout=30,
+        rate_limit=None,
+        rate_limit_retries=10,
+        metrics=None,
+    ):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.concurrency = concurrency
+        self.retries = retries
+        self.rate_limit_retries = rate_limit_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.metrics = metrics
+        self.session = None
+        self.semaphore = None
+
+        if isinstance(rate_limit, RateLimiter):
+            self.limiter = rate_limit
+        else:
+            self.limiter = RateLimiter(rate_limit)
+
+    async def __aenter__(self):
+        aiohttp = import_optional("aiohttp", "aiohttp")
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def acquire(self):
+        """Wait for the rate limiter without blocking the event loop."""
+        while True:
+            wait = self.limiter.reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def get(self, endpoint):
+        """Send a GET request and return an AsyncResponse.
+
+        Once retries run out the last response is returned for the caller to handle,
+        or the last timeout or connection error is raised.
+        """
+        import aiohttp
+
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                await self.acquire()
+                sent_at = time.monotonic()
+                started = time.perf_counter()
+                try:
+                    async with self.session.get(self.base_url + endpoint) as response:
+                        body = await response.read()
+                    result = AsyncResponse(response.status, body.decode("utf-8", "replace"))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt >= self.retries:
+                        raise
+                    delay = self.backoff * 2**attempt
+                else:
+                    if self.metrics:
+                        self.metrics.record(
+                            result.status_code, time.perf_counter() - started, len(body)
+                        )
+
+                    if result.status_code == 429:
+                        retries = self.rate_limit_retries
+                    elif result.status_code in RETRY_STATUS_CODES:
+                        retries = self.retries
+                    else:
+                        self.limiter.succeeded()
+                        return result
+
+                    if attempt >= retries:
+                        return result
+                    delay = retry_after(response, self.backoff * 2**attempt)
+                    if result.status_code == 429:
+                        self.limiter.throttled(delay, sent_at)
+                        delay = 0
+
+                if self.metrics:
+                    self.metrics.retried()
+                await asyncio.sleep(delay)
+                attempt += 1
@@ -0,0 +1,145 @@
+"""On-disk cache of Kandji API GET responses."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   ResponseCache keeps successful GET responses on disk, keyed by URL and query params,
+#   so that re-running a report while working on its columns or filters does not
+#   download the whole tenant again. Every entry is a gzip file holding one JSON line of
+#   metadata (URL, time stored, validators) followed by the raw response body.
+#
+#   Entries younger than the TTL are served without a request. Older entries that came
+#   with an ETag or Last-Modified header are revalidated with a conditional request, and
+#   a 304 answer refreshes them. In replay mode the cache answers every request whatever
+#   its age, and a request that was never recorded raises CacheMiss.
+#
+################################################################################################
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from urllib.parse import urlencode
+
+# gzip level for cache entries, fast rather than small
+COMPRESS_LEVEL = 1
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode for a request that is not in the cache."""
+
+    def __init__(self, url, params=None):
+        self.url = url
+        self.params = params
+        query = f"?{urlencode(sorted((params or {}).items()))}" if params else ""
+        super().__init__(f"GET {url}{query} is not in the recorded crawl")
+
+
+class CacheEntry:
+    """A cached response."""
+
+    def __init__(self, path, meta, body):
+        self.path = path
+        self.meta = meta
+        self.body = body
+
+    def age(self):
+        """Return the number of seconds since the response was stored."""
+        return time.time() - self.meta["stored_at"]
+
+    def validators(self):
+        """Return the headers for a conditional request, if the response had validators."""
+        headers = {}
+        if self.meta.get("etag"):
+            headers["If-None-Match"] = self.meta["etag"]
+        if self.meta.get("last_modified"):
+            headers["If-Modified-Since"] = self.meta["last_modified"]
+        return headers
+
+    def response(self):
+        """Return the entry as a requests.Response."""
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = self.meta["url"]
+        response.headers = CaseInsensitiveDict(self.meta.get("headers", {}))
+        response._content = self.body
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        return response
+
+
+class ResponseCache:
+    """Directory of cached GET responses.
+
+    directory - where entries are kept. Created if missing.
+    ttl       - seconds for which an entry is served without asking the API.
+    """
+
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, params=None):
+        """Return the file for a URL and its query params."""
+        query = urlencode(sorted((params or {}).items()))
+        key = hashlib.sha256(f"GET {url}?{query}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.gz")
+
+    def get(self, url, params=None):
+        """Return the CacheEntry for a request, or None."""
+        path = self.path(url, params)
+        try:
+            with gzip.open(path, mode="rb") as entry_file:
+                meta = json.loads(entry_file.readline())
+                body = entry_file.read()
+        except (OSError, EOFError, ValueError):
+            # missing, or a half written or corrupt entry that will be replaced
+            return None
+        return CacheEntry(path, meta, body)
+
+    def fresh(self, entry):
+        """Return True if the entry can be served without revalidating it."""
+        return entry.age() < self.ttl
+
+    def put(self, url, params, response):
+        """Store a successful response."""
+        meta = {
+            "url": url,
+            "stored_at": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "headers": {
+                name: response.headers[name]
+                for name in ("Content-Type", "ETag", "Last-Modified")
+                if name in response.headers
+            },
+        }
+        self.write(self.path(url, params), meta, response.content)
+
+    def refresh(self, entry):
+        """Mark an entry as fresh again after a 304 Not Modified."""
+        entry.meta["stored_at"] = time.time()
+        self.write(entry.path, entry.meta, entry.body)
+
+    def write(self, path, meta, body):
+        """Write an entry atomically, so readers never see half of it."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(handle, mode="wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=COMPRESS_LEVEL) as entry:
+                    entry.write(json.dumps(meta).encode("utf-8"))
+                    entry.write(b"\n")
+                    entry.write(body)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
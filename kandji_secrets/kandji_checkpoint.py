@@ -0,0 +1,293 @@
+"""Checkpoints for long Kandji device inventory crawls and secrets dumps."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   CrawlJournal keeps every device page a crawl has completed in a checkpoint
+#   directory, one gzip file per page holding its offset, page size, record count and
+#   records, next to a crawl.json describing the crawl (URL, params, ordering, page size).
+#
+#   When a crawl dies part way through (timeout, 5xx, an exit from http_errors) the
+#   directory is left behind, and the next run with --resume replays the saved pages
+#   and carries on from the first offset that is missing. The directory is removed
+#   once the report has been written.
+#
+#   A checkpoint left by a different crawl, or older than max_age, is thrown away.
+#   Devices added or removed between the two runs shift the later pages, so records
+#   already replayed are skipped when they show up again.
+#
+#   SecretsJournal does the same for kandji_device_secrets.py. The output CSV is itself
+#   the record of the devices that are done, and a <output>.journal file next to it lists,
+#   one JSON line per device written, which of its secrets failed with an error worth
+#   retrying. --resume skips the devices that are done, fetches only the failed secrets
+#   of the others, and appends to the output, which is compacted to one row per device.
+#
+################################################################################################
+
+import csv
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# Checkpoints older than this many seconds are not resumed
+MAX_AGE = 24 * 60 * 60
+
+HEADER = "crawl.json"
+
+PAGE_RE = re.compile(r"^page-(\d+)\.json\.gz$")
+
+
+class CrawlJournal:
+    """Checkpoint directory of the device pages a crawl has completed.
+
+    path    - directory holding the checkpoint. Created if missing.
+    crawl   - dict describing the crawl, including its default page "limit". It must
+              match for a checkpoint to be resumed. Pages saved with a size of their
+              own, e.g. by --adaptive-pages, keep it in their page file.
+    max_age - seconds for which a checkpoint can be resumed.
+    """
+
+    def __init__(self, path, crawl, max_age=MAX_AGE):
+        self.path = path
+        self.crawl = crawl
+        self.limit = crawl["limit"]
+        self.max_age = max_age
+        # offsets of the saved pages that can be replayed, in order
+        self.offsets = []
+        self.next_offset = 0
+        self.finished = False
+        # device ids of the replayed records
+        self.device_ids = set()
+
+    def start(self):
+        """Load the checkpoint left by an earlier run, or start a new one.
+
+        Returns the number of saved pages that will be replayed.
+        """
+        header = self.read_header()
+        if header is not None:
+            if header.get("crawl") != self.crawl:
+                print(f"Checkpoint {self.path} is for a different crawl, starting over")
+            elif time.time() - header.get("started", 0) > self.max_age:
+                print(f"Checkpoint {self.path} is too old to resume, starting over")
+            else:
+                self.load_offsets()
+                return len(self.offsets)
+            shutil.rmtree(self.path)
+
+        os.makedirs(self.path, exist_ok=True)
+        self.write_json(
+            os.path.join(self.path, HEADER), {"crawl": self.crawl, "started": time.time()}
+        )
+        return 0
+
+    def read_header(self):
+        try:
+            with open(os.path.join(self.path, HEADER), encoding="utf-8") as header_file:
+                return json.load(header_file)
+        except (OSError, ValueError):
+            return None
+
+    def load_offsets(self):
+        """Find the saved pages that follow on from each other from offset 0."""
+        saved = {}
+        for name in os.listdir(self.path):
+            match = PAGE_RE.match(name)
+            if match:
+                saved[int(match.group(1))] = name
+
+        offset = 0
+        while offset in saved:
+            page = self.read_page(offset)
+            if page is None:
+                break
+            self.offsets.append(offset)
+            limit = page.get("limit", self.limit)
+            offset += limit
+            if page["count"] < limit:
+                self.finished = True
+                break
+        self.next_offset = offset
+
+    def page_path(self, offset):
+        return os.path.join(self.path, f"page-{offset:010d}.json.gz")
+
+    def read_page(self, offset):
+        """Return a saved page, or None if it is unreadable."""
+        try:
+            with gzip.open(self.page_path(offset), mode="rt", encoding="utf-8") as page_file:
+                page = json.load(page_file)
+        except (OSError, EOFError, ValueError):
+            return None
+        if page.get("offset") != offset or page.get("count") != len(page.get("records", ())):
+            return None
+        return page
+
+    def completed(self):
+        """Yield the records of every saved page, one page at a time."""
+        for offset in self.offsets:
+            page = self.read_page(offset)
+            if page is None:
+                raise OSError(f"Checkpoint page {self.page_path(offset)} went missing")
+            records = page["records"]
+            self.device_ids.update(record.get("device_id") for record in records)
+            yield records
+
+    def add(self, offset, records, limit=None):
+        """Save a completed page. A short page marks the end of the crawl.
+
+        limit - the page size the page was fetched with, if not the crawl's.
+        """
+        limit = limit or self.limit
+        self.write_json(
+            self.page_path(offset),
+            {"offset": offset, "limit": limit, "count": len(records), "records": records},
+            compress=True,
+        )
+        self.next_offset = offset + limit
+        if len(records) < limit:
+            self.finished = True
+
+    def write_json(self, path, data, compress=False):
+        """Write a file atomically, so a crash never leaves half a page behind."""
+        handle, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(handle, mode="wb") as raw:
+                body = json.dumps(data).encode("utf-8")
+                raw.write(gzip.compress(body, compresslevel=1) if compress else body)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def remove(self):
+        """Delete the checkpoint once the crawl's report has been written."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SecretsJournal:
+    """Record of the devices a secrets dump has written, for --resume.
+
+    output  - the secrets CSV being written. The journal is kept next to it.
+    columns - the secret columns of a row.
+    """
+
+    def __init__(self, output, columns):
+        self.output = output
+        self.path = f"{output}.journal"
+        self.columns = columns
+        # device ids whose row is in the output with every secret that could be fetched
+        self.completed = set()
+        # device id -> output row of the devices with failed secrets, those set to None
+        self.partial = {}
+        # device ids that still have failed secrets
+        self.failed = set()
+        # a device with a row in the output was written again
+        self.rewritten = False
+        self.file = None
+
+    def load(self):
+        """Index the output and the journal left by earlier runs.
+
+        Returns the number of devices that are done and will be skipped.
+        """
+        failures = {}
+        try:
+            with open(self.path, encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a run that was killed while writing it
+                        continue
+                    failures[entry["device_id"]] = entry["failed"]
+        except OSError:
+            pass
+
+        try:
+            with open(self.output, newline="") as csv_file:
+                for row in csv.DictReader(csv_file):
+                    device_id = row["device_id"]
+                    failed = failures.get(device_id)
+                    if failed:
+                        self.partial[device_id] = {**row, **dict.fromkeys(failed)}
+                        self.completed.discard(device_id)
+                    else:
+                        self.completed.add(device_id)
+                        self.partial.pop(device_id, None)
+        except OSError:
+            pass
+
+        self.failed = set(self.partial)
+        self.file = open(self.path, mode="a", encoding="utf-8")
+        return len(self.completed)
+
+    def resume(self, devices):
+        """Yield the devices still to fetch: new ones, and the rows of those with failed secrets."""
+        for device in devices:
+            device_id = device["device_id"]
+            if device_id in self.completed:
+                continue
+            yield self.partial.get(device_id, device)
+
+    def add(self, row):
+        """Record a row that is being written to the output."""
+        device_id = row["device_id"]
+        failed = [column for column in self.columns if row.get(column) is None]
+        self.file.write(json.dumps({"device_id": device_id, "failed": failed}) + "\n")
+        self.file.flush()
+        if failed:
+            self.failed.add(device_id)
+        else:
+            self.failed.discard(device_id)
+        if device_id in self.partial:
+            self.rewritten = True
+
+    def finish(self, complete):
+        """Compact the output, and drop the journal once every device is done.
+
+        complete - every device of the input was fetched.
+        """
+        self.file.close()
+        if self.rewritten:
+            self.compact()
+        if complete and not self.failed:
+            os.unlink(self.path)
+
+    def compact(self):
+        """Rewrite the output with one row per device, the latest one, in its first place."""
+        seen = set()
+        # device id -> latest row of the devices written more than once
+        latest = {}
+        with open(self.output, newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            fieldnames = reader.fieldnames
+            for row in reader:
+                device_id = row["device_id"]
+                if device_id in seen:
+                    latest[device_id] = row
+                seen.add(device_id)
+
+        directory = os.path.dirname(os.path.abspath(self.output))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with open(self.output, newline="") as csv_file, os.fdopen(
+                handle, mode="w", newline=""
+            ) as temp_file:
+                writer = csv.DictWriter(temp_file, fieldnames=fieldnames)
+                writer.writeheader()
+                written = set()
+                for row in csv.DictReader(csv_file):
+                    device_id = row["device_id"]
+                    if device_id not in written:
+                        writer.writerow(latest.get(device_id, row))
+                        written.add(device_id)
+            os.replace(temp_path, self.output)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
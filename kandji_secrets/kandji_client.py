@@ -0,0 +1,385 @@
+"""Shared, long-lived HTTP client for the Kandji API scripts."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   The Kandji scripts in this directory used to build a new requests.Session for every
+#   API call, so every page of results paid for a fresh TCP+TLS handshake. KandjiClient
+#   owns a single keep-alive connection pool that all callers reuse.
+#
+#   Every request also goes through a RateLimiter, a token bucket shared by all threads
+#   using the client. There is no request budget by default (RATE_LIMIT is None), so
+#   --workers and friends are only limited by the tenant. The first 429 pauses every
+#   caller for the Retry-After period and starts the bucket at half the request rate
+#   of the last few seconds. A later 429 slows the bucket down further, once per burst:
+#   429s to requests sent before the last slow down are the same burst. The rate creeps
+#   back up as requests succeed. Pass a rate (--rate-limit RPS) to cap requests from
+#   the start.
+#
+#   PageSizer picks the page size of paginated requests from how long recent pages
+#   took and how big they were, and halves it when pages time out.
+#
+#   requests and urllib3 are only imported when the first client is created.
+#
+################################################################################################
+
+import collections
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Only retry methods that are safe to send twice.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Transient status codes worth another try at the connection level.
+RETRY_STATUS_CODES = (502, 504)
+
+# Default request budget, in requests per second. None sends as fast as callers ask
+# until the tenant answers 429.
+RATE_LIMIT = None
+
+# Seconds of recent requests the rate is taken from on the first 429
+RATE_WINDOW = 5.0
+
+
+class KandjiAPIError(Exception):
+    """Raised when the Kandji API returns an error that cannot be retried away."""
+
+    def __init__(self, response, message=None):
+        self.response = response
+        self.status_code = response.status_code
+        super().__init__(message or f"{response.status_code} {response.reason}: {response.url}")
+
+
+class KandjiRateLimitError(KandjiAPIError):
+    """Raised when requests are still rate limited (429) after every retry."""
+
+
+class KandjiServerError(KandjiAPIError):
+    """Raised when the Kandji API keeps returning a 5xx error."""
+
+
+def retry_after(response, default):
+    """Return the Retry-After delay of a response in seconds, or the default."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, (when - datetime.now(tz=timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Thread-safe token bucket with additive increase, multiplicative decrease.
+
+    rate     - requests per second to allow. None or 0 sends requests unlimited until
+               the first 429, which starts the bucket at half the rate of the last
+               RATE_WINDOW seconds.
+    burst    - number of requests that may be sent back to back.
+    min_rate - floor for the rate after repeated 429s.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=None, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate) if rate else min_rate
+        self.fixed_burst = burst
+        self.burst = burst or max(1.0, rate or 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # times of the requests sent in the last RATE_WINDOW seconds while unlimited, to
+        # pick a rate from on the first 429
+        self.started = self.updated
+        self.recent = collections.deque()
+        # when the rate was last slowed down
+        self.throttled_at = float("-inf")
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def reserve(self):
+        """Take a token if one is free. Returns 0, or the seconds to wait before asking again.
+
+        Lets callers that must not block, such as an event loop, wait in their own way.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+
+            if self.max_rate:
+                elapsed = now - self.updated
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.updated = now
+                wait = max(wait, (1 - self.tokens) / self.rate)
+
+            if wait <= 0:
+                if self.max_rate:
+                    self.tokens -= 1
+                else:
+                    self.recent.append(now)
+                    while self.recent[0] < now - RATE_WINDOW:
+                        self.recent.popleft()
+                return 0
+            return wait
+
+    def throttled(self, delay, sent_at=None):
+        """Halve the rate and pause every caller for `delay` seconds after a 429.
+
+        sent_at is the time.monotonic() the request was sent at. A 429 to a request sent
+        before the rate was last halved belongs to the burst that caused it, so it only
+        pauses callers.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + delay)
+            if sent_at is not None and sent_at < self.throttled_at:
+                return
+            self.throttled_at = now
+            if not self.max_rate:
+                # start limiting, from the rate the tenant has just turned down
+                span = now - max(self.started, now - RATE_WINDOW)
+                self.max_rate = max(self.min_rate, len(self.recent) / max(span, 0.1))
+                self.rate = self.max_rate
+                self.burst = self.fixed_burst or max(1.0, self.max_rate)
+                self.updated = now
+                self.recent.clear()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        """Creep the rate back towards the budget after a successful request.
+
+        Each request adds a share of max_rate / 20 per second at the current rate, so a
+        full recovery takes about 20 seconds of successes however fast requests are sent.
+        """
+        if self.max_rate and self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20 / self.rate)
+
+
+class PageSizer:
+    """Thread-safe page size picker for paginated requests.
+
+    Every page has a fixed cost (the round-trip) and a cost per record, so records per
+    second grow with the page size. The page size is therefore kept as large as
+    allowed, as long as a page is expected to take no more than `target` seconds and to
+    stay under `max_bytes`. After a timeout the size is halved and then allowed to
+    double again with every page that comes back in time.
+
+    minimum   - smallest page size.
+    maximum   - largest page size the server allows.
+    target    - seconds a page should take, well inside the request timeout.
+    max_bytes - largest page body to ask for.
+    window    - number of recent pages the estimates are taken from.
+    """
+
+    def __init__(self, minimum=25, maximum=300, target=7.5, max_bytes=16 * 2**20, window=16):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.max_bytes = max_bytes
+        self.limit = maximum
+        # (records, seconds, bytes) of recent pages
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, records, seconds, size):
+        """Record a page that came back and pick the size of the next one."""
+        if not records:
+            return
+        with self.lock:
+            self.samples.append((records, seconds, size))
+            total_records = sum(sample[0] for sample in self.samples)
+            # per record estimates that ignore the fixed cost, so they err on the small side
+            seconds_per_record = sum(sample[1] for sample in self.samples) / total_records
+            bytes_per_record = sum(sample[2] for sample in self.samples) / total_records
+
+            limit = self.limit * 2
+            if seconds_per_record:
+                limit = min(limit, self.target / seconds_per_record)
+            if bytes_per_record:
+                limit = min(limit, self.max_bytes / bytes_per_record)
+            self.limit = int(max(self.minimum, min(self.maximum, limit)))
+
+    def timed_out(self):
+        """Halve the page size after a page timed out. Returns False if it cannot shrink."""
+        with self.lock:
+            if self.limit <= self.minimum:
+                return False
+            self.limit = max(self.minimum, self.limit // 2)
+            # the old timings no longer say how a page of this size will do
+            self.samples.clear()
+            return True
+
+
+class KandjiClient:
+    """Keep-alive connection pool for a single Kandji tenant.
+
+    base_url     - the tenant API URL, e.g. https://example.api.kandji.io/api
+    headers      - default headers sent with every request.
+    pool_size    - number of pooled connections to keep open to the tenant.
+    retries      - number of retries for idempotent requests and 503 responses.
+    rate_limit_retries - number of retries for 429 responses.
+    backoff      - backoff factor between retries (seconds, doubled each retry).
+    timeout      - per-request timeout in seconds.
+    rate_limit   - request budget in requests per second, or a RateLimiter to share
+                   between clients. None or 0 disables rate limiting.
+    metrics      - optional kandji_metrics.Metrics that records every response.
+    cache        - optional kandji_cache.ResponseCache for GET responses.
+    replay       - answer GET requests from the cache only, never from the tenant.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        headers=None,
+        pool_size=10,
+        retries=3,
+        backoff=0.5,
+        timeout=30,
+        rate_limit=None,
+        rate_limit_retries=10,
+        metrics=None,
+        cache=None,
+        replay=False,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.rate_limit_retries = rate_limit_retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.cache = cache
+        self.replay = replay
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        if isinstance(rate_limit, RateLimiter):
+            self.limiter = rate_limit
+        else:
+            self.limiter = RateLimiter(rate_limit)
+
+        self.session = requests.Session()
+
+        if headers:
+            self.session.headers.update(headers)
+
+        if metrics:
+            self.session.hooks["response"].append(metrics.response_hook)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+            # urllib3 would otherwise retry 429s and 503s with Retry-After itself, out of
+            # sight of send() and the rate limiter
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, endpoint, params=None, payload=None, **kwargs):
+        """Send a request to the tenant and return the requests.Response.
+
+        GET requests go through the response cache when the client has one.
+        """
+        if self.cache is not None and method.upper() == "GET":
+            return self.cached_get(endpoint, params, **kwargs)
+        return self.send(method, endpoint, params, payload, **kwargs)
+
+    def cached_get(self, endpoint, params=None, **kwargs):
+        """Answer a GET request from the cache, revalidating or refetching stale entries."""
+        from kandji_cache import CacheMiss
+
+        url = self.base_url + endpoint
+        entry = self.cache.get(url, params)
+        if entry is not None and (self.replay or self.cache.fresh(entry)):
+            if self.metrics:
+                self.metrics.cached()
+            return entry.response()
+        if self.replay:
+            raise CacheMiss(url, params)
+
+        if entry is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **entry.validators()}
+        response = self.send("GET", endpoint, params, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.refresh(entry)
+            return entry.response()
+        if response.status_code == 200:
+            self.cache.put(url, params, response)
+        return response
+
+    def send(self, method, endpoint, params=None, payload=None, **kwargs):
+        """Send a request to the tenant, bypassing the cache.
+
+        429 responses, and 503 responses to idempotent requests, are retried with
+        exponential backoff, honouring Retry-After. Once retries run out the last
+        response is returned for the caller to handle.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+
+        while True:
+            self.limiter.acquire()
+            sent_at = time.monotonic()
+            response = self.session.request(
+                method, self.base_url + endpoint, params=params, data=payload, **kwargs
+            )
+
+            if response.status_code == 429:
+                retries = self.rate_limit_retries
+            elif response.status_code == 503 and method.upper() in IDEMPOTENT_METHODS:
+                retries = self.retries
+            else:
+                self.limiter.succeeded()
+                return response
+
+            if attempt >= retries:
+                return response
+
+            # hand a streamed connection back to the pool before waiting
+            response.close()
+            if self.metrics:
+                self.metrics.retried()
+            delay = retry_after(response, self.backoff * 2**attempt)
+            if response.status_code == 429:
+                self.limiter.throttled(delay, sent_at)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,165 @@
+"""Kandji tenant settings for the Kandji API scripts."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Importing the scripts in this directory must not read the environment, load .env or
+#   exit, so that they can be used from cron wrappers and other Python code. Config holds
+#   the tenant settings and only resolves them, and validates them, on first use.
+#
+#   load_tenants() reads several tenants from a JSON file for multi-tenant reports:
+#
+#       {"tenants": [
+#           {"name": "us", "subdomain": "example", "token_env": "KANDJI_US_TOKEN"},
+#           {"name": "eu", "subdomain": "example", "region": "eu",
+#            "token_env": "KANDJI_EU_TOKEN", "rate_limit": 5}
+#       ]}
+#
+#   Each tenant needs a name and a subdomain (or base_url). token_env names the
+#   environment variable holding its token (default KANDJI_API_TOKEN), and rate_limit
+#   optionally sets its own request budget in requests per second.
+#
+################################################################################################
+
+import json
+import os
+
+# Environment variable holding the Kandji API token
+TOKEN_VARIABLE = "KANDJI_API_TOKEN"
+
+# Keys allowed for a tenant in a tenants file
+TENANT_KEYS = frozenset(["name", "subdomain", "region", "base_url", "token_env", "rate_limit"])
+
+ENV_LOADED = False
+
+
+class ConfigError(Exception):
+    """Raised when the Kandji tenant settings are missing or invalid."""
+
+
+def load_env():
+    """Load a .env file into the environment, once."""
+    global ENV_LOADED
+    if ENV_LOADED:
+        return
+    ENV_LOADED = True
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        # without python-dotenv the token has to be exported in the environment
+        return
+    load_dotenv()
+
+
+class Config:
+    """Settings for a single Kandji tenant.
+
+    subdomain - tenant subdomain, e.g. example for example.api.kandji.io.
+    region    - "" or "us" for US tenants, "eu" for EU tenants.
+    token     - API token. Read from token_variable, or a .env file, when not given.
+    base_url  - full API URL, e.g. https://example.api.kandji.io/api. Overrides
+                subdomain and region.
+    name      - tenant name used in multi-tenant reports.
+    token_variable - environment variable to read the token from.
+    rate_limit - request budget for this tenant, or None for the caller's default.
+    """
+
+    def __init__(
+        self,
+        subdomain="",
+        region="",
+        token=None,
+        base_url=None,
+        name=None,
+        token_variable=TOKEN_VARIABLE,
+        rate_limit=None,
+    ):
+        self.subdomain = subdomain
+        self.region = region
+        self._token = token
+        self._base_url = base_url
+        self.name = name or subdomain
+        self.token_variable = token_variable
+        self.rate_limit = rate_limit
+
+    @property
+    def token(self):
+        """The API token, read from the environment on first use."""
+        if self._token is None:
+            load_env()
+            token = os.getenv(self.token_variable)
+            if not token:
+                raise ConfigError(
+                    f"Please run export {self.token_variable}=<API_TOKEN> before running "
+                    "this script"
+                )
+            self._token = token
+        return self._token
+
+    @property
+    def base_url(self):
+        """The tenant API URL."""
+        if self._base_url is None:
+            if self.region in ["", "us"]:
+                self._base_url = f"https://{self.subdomain}.api.kandji.io/api"
+            elif self.region in ["eu"]:
+                self._base_url = f"https://{self.subdomain}.api.{self.region}.kandji.io/api"
+            else:
+                raise ConfigError(
+                    f'Unsupported region "{self.region}". Please update and try again'
+                )
+        return self._base_url
+
+    @property
+    def headers(self):
+        """Default headers for every API request."""
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Accept": "application/json",
+            "Content-Type": "application/json;charset=utf-8",
+            "Cache-Control": "no-cache",
+        }
+
+
+def load_tenants(path):
+    """Return a Config for every tenant in a tenants JSON file, in file order."""
+    try:
+        with open(path, encoding="utf-8") as tenants_file:
+            data = json.load(tenants_file)
+    except (OSError, ValueError) as error:
+        raise ConfigError(f"Cannot read tenants file {path}: {error}") from error
+
+    entries = data.get("tenants") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ConfigError(f'{path} needs a non-empty "tenants" list')
+
+    tenants = []
+    names = set()
+    for number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            raise ConfigError(f"Tenant {number} in {path} is not an object")
+        unknown = set(entry) - TENANT_KEYS
+        if unknown:
+            raise ConfigError(f"Tenant {number} in {path} has unknown keys: {sorted(unknown)}")
+
+        name = entry.get("name")
+        if not name:
+            raise ConfigError(f"Tenant {number} in {path} needs a name")
+        if name in names:
+            raise ConfigError(f"Tenant name {name} is used twice in {path}")
+        if not entry.get("subdomain") and not entry.get("base_url"):
+            raise ConfigError(f"Tenant {name} in {path} needs a subdomain or base_url")
+        names.add(name)
+
+        tenants.append(
+            Config(
+                subdomain=entry.get("subdomain", ""),
+                region=entry.get("region", ""),
+                base_url=entry.get("base_url"),
+                name=name,
+                token_variable=entry.get("token_env", TOKEN_VARIABLE),
+                rate_limit=entry.get("rate_limit"),
+            )
+        )
+    return tenants
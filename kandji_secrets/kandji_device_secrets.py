@@ -1,12 +1,18 @@
 import argparse
+import contextlib
 import csv
-from typing import Any
-import requests
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Iterator
 
-from dotenv import load_dotenv
-
-load_dotenv()
+from kandji_checkpoint import SecretsJournal
+from kandji_client import RATE_LIMIT, KandjiClient
+from kandji_config import Config, ConfigError
+from kandji_metrics import Metrics
+from kandji_planner import LEARNED_SKIP, SecretsPlanner
 
 ################################################################################################
 # Created by Patrick Albert | patrickalbert@truework.com | Truework
@@ -23,14 +29,17 @@ load_dotenv()
 #
 #   The kandji_devices_report.py script will generate a CSV file with the required headers.
 #
+#   Every device needs three API calls, one per secret. They all go through one
+#   KandjiClient, so connections are kept alive between calls, and with --workers N
+#   up to N of them, across devices and within a device, are in flight at once.
+#
 ########################################################################################
 ######################### UPDATE VARIABLES BELOW #######################################
 ########################################################################################
 
-# Replace with your own API token
-api_token = os.getenv("KANDJI_API_TOKEN")
-if not api_token:
-    raise SystemExit("Please run export KANDJI_API_TOKEN=<API_TOKEN> before running this script")
+# Replace with your own API token, or leave as None to read KANDJI_API_TOKEN from the
+# environment or a .env file
+api_token = None
 # URL endpoint for the Kandji API
 url_base = "https://truework.api.kandji.io/api/v1"
 
@@ -38,81 +47,407 @@ url_base = "https://truework.api.kandji.io/api/v1"
 ######################### DO NOT MODIFY BELOW THIS LINE ################################
 ########################################################################################
 
-def parse_csv_report(filename: str) -> list[dict[str, str | Any]]:
+# Run metrics, enabled by --profile or --metrics-out
+metrics = Metrics(enabled=False)
+
+# (endpoint, output column, description) of every secret fetched for a device
+SECRETS = (
+    ("filevaultkey", "filevault_key", "FileVault key"),
+    ("bypasscode", "bypass_code", "bypass code"),
+    ("unlockpin", "unlock_pin", "unlock PIN"),
+)
+
+# Seconds before the first --retry-failed pass, doubled for every pass after it
+RETRY_BACKOFF = 5
+
+# Columns of the output file
+FIELDNAMES = ['device_id', 'serial_number', 'device_name', 'model', 'filevault_key', 'bypass_code', 'unlock_pin']
+
+# Shared API client, created on first use
+client = None
+
+# Picks the secrets to request for each device, set up by main(). None requests them all
+planner = None
+
+def get_api_token():
+    return Config(token=api_token, base_url=url_base).token
+
+def iter_csv_report(filename: str) -> Iterator[dict[str, str | Any]]:
+    # Yield the devices of the report one row at a time, without reading the whole file
     with open(filename) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        devices = [
-            {
+        for row in csv.DictReader(csv_file):
+            yield {
                 'device_id': row['device_id'],
                 'serial_number': row['serial_number'],
                 'device_name': row['device_name'],
                 'model': row['model'],
+                # a devices report has the platform, which tells the planner more than the model
+                'platform': row.get('platform', ''),
             }
-            for row in csv_reader
-        ]
-    return devices
 
-def fetch_device_secrets(devices):
-    device_secrets = []
-    for device in devices:
-        filevault_key = ""
-        bypass_code = ""
-        unlock_pin = ""
+def parse_csv_report(filename: str) -> list[dict[str, str | Any]]:
+    return list(iter_csv_report(filename))
 
-        print(f"Retrieving secrets for device {device['device_id']}")
+def get_client(workers=1, rate_limit=RATE_LIMIT):
+    global client
+    if client is None:
+        client = KandjiClient(
+            url_base,
+            headers={"Authorization": f"Bearer {get_api_token()}"},
+            pool_size=max(1, workers),
+            rate_limit=rate_limit,
+            metrics=metrics if metrics.enabled else None,
+        )
+    return client
 
-        # Make API call to retrieve FileVault key
-        url = f"{url_base}/devices/{device['device_id']}/secrets/filevaultkey/"
-        headers = {"Authorization": f"Bearer {api_token}"}
-        response = requests.get(url, headers=headers)
+def secret_endpoint(device, secret):
+    return f"/devices/{device['device_id']}/secrets/{secret}/"
 
-        if response.status_code == 200:
-            filevault_key = response.text
-            print(f"FileVault key retrieved for device {device['device_id']}")
-        else:
-            print(f"Error retrieving FileVault key for device {device['device_id']}: {response.text}")
+def secret_value(device, secret, description, response):
+    # Return the secret from an API response, "" if the device has none, or None if the
+    # call failed in a way worth retrying later (rate limited, server error)
+    if planner is not None:
+        planner.learn(device, secret, response.status_code)
+    if response.status_code == 200:
+        print(f"{description[:1].upper()}{description[1:]} retrieved for device {device['device_id']}")
+        return response.text
+    if response.status_code == 404:
+        print(f"No {description} for device {device['device_id']}")
+        return ""
+    print(f"Error retrieving {description} for device {device['device_id']}: {response.text}")
+    if response.status_code == 429 or response.status_code >= 500:
+        return None
+    return ""
+
+def secret_error(device, description, error):
+    # A call that raised, e.g. a timeout, is worth retrying later
+    print(f"Error retrieving {description} for device {device['device_id']}: {error}")
+    return None
 
-        # Make API call to retrieve bypass code
-        url = f"{url_base}/devices/{device['device_id']}/secrets/bypasscode/"
-        response = requests.get(url, headers=headers)
+def fetch_secret(device, secret, description):
+    # Make API call to retrieve one secret
+    from requests.exceptions import RequestException
 
-        if response.status_code == 200:
-            bypass_code = response.text
-            print(f"Bypass code retrieved for device {device['device_id']}")
+    try:
+        response = get_client().request("GET", secret_endpoint(device, secret))
+    except RequestException as error:
+        return secret_error(device, description, error)
+    return secret_value(device, secret, description, response)
+
+def plan_device(device):
+    # The secrets a device still needs, all of them for a device from the input report or
+    # the ones that failed for a row being retried, less those the planner rules out.
+    # Returns a copy of the device with the cells of the ruled out secrets filled in, and
+    # the secrets to request
+    planned = dict(device)
+    wanted = []
+    for secret, column, description in SECRETS:
+        if device.get(column) is not None:
+            continue
+        cell = planner.plan(device, secret) if planner is not None else None
+        if cell is None:
+            wanted.append((secret, column, description))
         else:
-            print(f"Error retrieving bypass code for device {device['device_id']}: {response.text}")
+            planned[column] = cell
+    return planned, wanted
+
+def failed_secrets(row):
+    return [column for _, column, _ in SECRETS if row.get(column) is None]
+
+def device_secrets_row(device, secrets):
+    print(f"Secrets retrieved for device {device['device_id']}\n")
+    return {
+        'device_id': device['device_id'],
+        'serial_number': device['serial_number'],
+        'device_name': device['device_name'],
+        'model': device['model'],
+        **{column: device.get(column) for _, column, _ in SECRETS},
+        **secrets,
+    }
+
+def iter_device_secrets(devices, workers=1, ordered=True):
+    # Yield the secrets row of each device as soon as it can be handed on: in input order,
+    # or with ordered=False as soon as all three secrets of a device are in
+    get_client(workers)
+
+    if workers <= 1:
+        for device in devices:
+            print(f"Retrieving secrets for device {device['device_id']}")
+            device, wanted = plan_device(device)
+            secrets = {
+                column: fetch_secret(device, secret, description)
+                for secret, column, description in wanted
+            }
+            yield device_secrets_row(device, secrets)
+        return
+
+    # Every secret of every device is a task of its own on one bounded pool, so the three
+    # calls of a device run side by side and a slow device does not hold up the others.
+    # devices whose calls are in flight, oldest first: input position -> (device, futures)
+    pending = {}
+    # enough devices in flight to keep the workers busy while the oldest one finishes
+    window = workers * 32
+    # input positions of the devices whose secrets are all in, as they finish (unordered)
+    ready = queue.SimpleQueue()
+    lock = threading.Lock()
+
+    def collect(device, futures):
+        secrets = {column: future.result() for column, future in futures.items()}
+        return device_secrets_row(device, secrets)
 
-        # Make API call to retrieve unlock PIN
-        url = f"{url_base}/devices/{device['device_id']}/secrets/unlockpin/"
-        response = requests.get(url, headers=headers)
+    def when_finished(index, futures):
+        # queue the device on ready once the last of its secrets is in
+        remaining = [len(futures)]
+        if not futures:
+            ready.put(index)
 
-        if response.status_code == 200:
-            unlock_pin = response.text
-            print(f"Unlock PIN retrieved for device {device['device_id']}")
+        def secret_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            ready.put(index)
+
+        for future in futures:
+            future.add_done_callback(secret_done)
+
+    def take_finished(block=False):
+        # yield the rows that can be handed on now, first waiting for one if block
+        if ordered:
+            while pending:
+                oldest = next(iter(pending))
+                futures = pending[oldest][1].values()
+                if block:
+                    wait(futures)
+                    block = False
+                elif not all(future.done() for future in futures):
+                    return
+                yield collect(*pending.pop(oldest))
         else:
-            print(f"Error retrieving unlock PIN for device {device['device_id']}: {response.text}")
-            
-            # Write secrets to terminal
-        device_secrets.append({
-            'device_id': device['device_id'],
-            'serial_number': device['serial_number'],
-            'device_name': device['device_name'],
-            'model': device['model'],
-            'filevault_key': filevault_key,
-            'bypass_code': bypass_code,
-            'unlock_pin': unlock_pin
-        })
-
-        print(f"Secrets retrieved for device {device['device_id']}\n")
-    return device_secrets
-
-def write_output_file(data, filename: str) -> None:
-    with open(filename, mode='w', newline='') as csv_file:
-        fieldnames = ['device_id', 'serial_number', 'device_name', 'model', 'filevault_key', 'bypass_code', 'unlock_pin']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
+            while block or not ready.empty():
+                block = False
+                yield collect(*pending.pop(ready.get()))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for index, device in enumerate(devices):
+            print(f"Retrieving secrets for device {device['device_id']}")
+            device, wanted = plan_device(device)
+            futures = {
+                column: executor.submit(fetch_secret, device, secret, description)
+                for secret, column, description in wanted
+            }
+            pending[index] = (device, futures)
+            if not ordered:
+                when_finished(index, futures.values())
+            yield from take_finished(block=len(pending) >= window)
+
+        while pending:
+            yield from take_finished(block=True)
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def fetch_device_secrets(devices, workers=1):
+    # Rows are collected in input order
+    return list(iter_device_secrets(devices, workers))
+
+def fetch_device_secrets_asyncio(devices, workers=1, rate_limit=RATE_LIMIT, write=None, ordered=True):
+    # Same rows as fetch_device_secrets, with every request driven by one event loop.
+    # The rows are returned, or handed to write as they can be: in input order, or with
+    # ordered=False as soon as each device has finished.
+    # Ctrl-C cancels the requests in flight and keeps the rows of the devices that had
+    # already finished, still in input order. With write it then raises KeyboardInterrupt.
+    import asyncio
+
+    from kandji_async import AsyncKandjiClient
+
+    rows = []
+    emit = write or rows.append
+    # input position -> row of devices that finished before an earlier device
+    finished = {}
+    next_index = 0
+    count = 0
+    # rows held back for an earlier device before no more devices are started
+    window = workers * 32
+
+    def done(index, row):
+        nonlocal next_index, count
+        count += 1
+        if not ordered:
+            emit(row)
+            return
+        finished[index] = row
+        while next_index in finished:
+            emit(finished.pop(next_index))
+            next_index += 1
+
+    async def fetch_device(client, index, device):
+        import aiohttp
+
+        print(f"Retrieving secrets for device {device['device_id']}")
+        device, wanted = plan_device(device)
+        responses = await asyncio.gather(
+            *(client.get(secret_endpoint(device, secret)) for secret, _, _ in wanted),
+            return_exceptions=True,
+        )
+        secrets = {}
+        for (secret, column, description), response in zip(wanted, responses):
+            if isinstance(response, (aiohttp.ClientError, asyncio.TimeoutError)):
+                secrets[column] = secret_error(device, description, response)
+            elif isinstance(response, BaseException):
+                raise response
+            else:
+                secrets[column] = secret_value(device, secret, description, response)
+        done(index, device_secrets_row(device, secrets))
+
+    async def fetch_all():
+        async with AsyncKandjiClient(
+            url_base,
+            headers={"Authorization": f"Bearer {get_api_token()}"},
+            concurrency=max(1, workers),
+            rate_limit=rate_limit,
+            metrics=metrics if metrics.enabled else None,
+        ) as async_client:
+            # the semaphore in the client bounds the requests, this bounds the devices
+            # waiting on it, so a large report does not become one task per device at once
+            pending = set()
+            try:
+                for index, device in enumerate(devices):
+                    pending.add(asyncio.ensure_future(fetch_device(async_client, index, device)))
+                    while len(pending) >= workers or len(finished) >= window:
+                        finished_tasks, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for task in finished_tasks:
+                            task.result()
+                await asyncio.gather(*pending)
+            finally:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    try:
+        asyncio.run(fetch_all())
+    except KeyboardInterrupt:
+        print(f"\nInterrupted, keeping the {count} devices that had finished")
+        for index in sorted(finished):
+            emit(finished[index])
+        if write:
+            raise
+    return rows
+
+@contextlib.contextmanager
+def output_writer(filename: str, flush: bool = False, append: bool = False):
+    # Open the output file and yield a function that writes one row to it. With flush
+    # every row is on disk as soon as it is written, and with append rows are added
+    # after the ones already in the file.
+    exists = append and os.path.exists(filename) and os.path.getsize(filename) > 0
+    with open(filename, mode='a' if exists else 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDNAMES)
+        if not exists:
+            writer.writeheader()
+
+        def write(row):
+            writer.writerow(row)
+            if flush:
+                csv_file.flush()
+
+        yield write
+
+def write_output_file(data, filename: str, journal=None) -> None:
+    with output_writer(filename, append=journal is not None) as write:
         for device in data:
-            writer.writerow(device)
+            if journal is not None:
+                journal.add(device)
+            write(device)
+
+def fetch_rows(devices, args, write, ordered=True):
+    # Fetch the secrets of the devices with the selected --engine, handing each row to write
+    if args.engine == "asyncio":
+        with metrics.phase("fetch"):
+            fetch_device_secrets_asyncio(
+                devices, args.workers, args.rate_limit, write=write, ordered=ordered
+            )
+    else:
+        for row in metrics.timed("fetch", iter_device_secrets(devices, args.workers, ordered)):
+            write(row)
+
+def retry_failed_secrets(rows, args):
+    # Fetch the secrets that failed with a 429, a server error or a timeout again, in up to
+    # --retry-failed passes, waiting longer before each. Returns the rows, updated.
+    for attempt in range(args.retry_failed):
+        failed = [row for row in rows if failed_secrets(row)]
+        if not failed:
+            break
+        delay = RETRY_BACKOFF * 2**attempt
+        print(f"Retrying the failed secrets of {len(failed)} devices in {delay} seconds")
+        time.sleep(delay)
+        retried = {}
+        fetch_rows(failed, args, lambda row: retried.__setitem__(row['device_id'], row))
+        rows = [retried.get(row['device_id'], row) for row in rows]
+    return rows
+
+def stream_device_secrets(args, journal=None) -> int:
+    # Read, fetch and write one device at a time, so memory stays flat however large the
+    # report, and every finished row is already in the output file if the run stops.
+    # Rows with failed secrets are held back for the --retry-failed passes and written
+    # last. Returns the number of rows written.
+    devices = metrics.timed("read", iter_csv_report(args.input))
+    if journal is not None:
+        devices = journal.resume(devices)
+    ordered = not args.unordered
+    # rows waiting for the retry passes
+    held = []
+    written = 0
+
+    with output_writer(args.output, flush=True, append=journal is not None) as write:
+
+        def write_row(row):
+            nonlocal written
+            with metrics.phase("write"):
+                if journal is not None:
+                    journal.add(row)
+                write(row)
+            written += 1
+
+        def take_row(row):
+            if args.retry_failed and failed_secrets(row):
+                held.append(row)
+            else:
+                write_row(row)
+
+        try:
+            fetch_rows(devices, args, take_row, ordered=ordered)
+            held = retry_failed_secrets(held, args)
+        except KeyboardInterrupt:
+            for row in held:
+                write_row(row)
+            raise SystemExit(f"\nInterrupted: wrote {written} devices to {args.output}")
+        for row in held:
+            write_row(row)
+    return written
+
+def batch_device_secrets(args, journal=None) -> None:
+    # Read the whole report, fetch every device, then write the output file
+    print(f"Parsing csv report {args.input}")
+    with metrics.phase("read"):
+        devices = parse_csv_report(args.input)
+        if journal is not None:
+            devices = list(journal.resume(devices))
+    print("Fetching secrets for devices in report")
+    device_secrets = []
+    interrupted = False
+    try:
+        fetch_rows(devices, args, device_secrets.append)
+        device_secrets = retry_failed_secrets(device_secrets, args)
+    except KeyboardInterrupt:
+        interrupted = True
+    print(f"Writing output file to kandji {args.output}")
+    with metrics.phase("write"):
+        write_output_file(device_secrets, args.output, journal)
+    if interrupted:
+        raise SystemExit(f"Interrupted: wrote {len(device_secrets)} of {len(devices)} devices to {args.output}")
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -141,16 +476,171 @@ def parse_args():
         required=False
     )
 
+    parser.add_argument(
+        "--secrets",
+        type=str,
+        default=",".join(secret for secret, _, _ in SECRETS),
+        metavar=",".join(secret for secret, _, _ in SECRETS),
+        help="Comma separated secrets to fetch (default: all). The columns of the others are left blank",
+        required=False
+    )
+
+    parser.add_argument(
+        "--plan-cache",
+        type=str,
+        default=".kandji_secrets_plan.json",
+        metavar="FILENAME",
+        help="File where the secrets each device model has answered 404 for are counted, so that calls that keep failing are skipped (default: .kandji_secrets_plan.json)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--learn-skips",
+        action="store_true",
+        help=f"Also skip secrets that a device model has answered 404 for 10 times and never returned, per --plan-cache. Their cells read \"{LEARNED_SKIP}\"",
+        required=False
+    )
+
+    parser.add_argument(
+        "--no-plan",
+        action="store_true",
+        help="Request every selected secret for every device, even where it cannot exist, e.g. a FileVault key for an iPhone",
+        required=False
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of secrets to fetch concurrently, across devices and within each device (default: 1)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="threads",
+        choices=("threads", "asyncio"),
+        help="Fetch secrets on a pool of --workers threads (threads, the default) or on one event loop with up to --workers requests in flight (asyncio, needs python3 -m pip install aiohttp)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read, fetch and write one device at a time, flushing each row to the output file as soon as it is ready, so memory stays flat and an interrupted run keeps its finished rows",
+        required=False
+    )
+
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="With --stream, write each device as soon as it finishes instead of in the order of the input report",
+        required=False
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the devices already in --output and fetch only the rest, plus the secrets that failed last time. Records failed secrets in <output>.journal, so add it to every run that may need resuming",
+        required=False
+    )
+
+    parser.add_argument(
+        "--retry-failed",
+        type=int,
+        default=2,
+        metavar="N",
+        help=f"Passes over the secrets that failed with a 429, a server error or a timeout once every device has been tried, waiting {RETRY_BACKOFF}s before the first and twice as long before each next one (default: 2)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=RATE_LIMIT,
+        metavar="RPS",
+        help="Maximum API requests per second, shared by all workers (default: no limit until Kandji answers 429, then half the rate sent until then)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        choices=("cpu", "memory"),
+        help="Profile the run with cProfile (cpu) or tracemalloc (memory) and print the per-phase timing summary",
+        required=False
+    )
+
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        metavar="FILENAME",
+        help="Write per-phase timings and request metrics to this JSON file",
+        required=False
+    )
+
     return parser.parse_args()
 
 def main():
+    global metrics, planner
     args = parse_args()
-    print(f"Parsing csv report {args.input}")
-    devices = parse_csv_report(args.input)
-    print("Fetching secrets for devices in report")
-    device_secrets = fetch_device_secrets(devices)
-    print(f"Writing output file to kandji {args.output}")
-    write_output_file(device_secrets, args.output)
+    try:
+        get_api_token()
+    except ConfigError as error:
+        raise SystemExit(str(error))
+    if args.unordered and not args.stream:
+        raise SystemExit("--unordered only applies with --stream")
+    names = [secret for secret, _, _ in SECRETS]
+    selected = [secret.strip() for secret in args.secrets.split(",") if secret.strip()]
+    for secret in selected:
+        if secret not in names:
+            raise SystemExit(f"Unknown secret {secret}. Use one or more of {','.join(names)}")
+    if args.learn_skips and args.no_plan:
+        raise SystemExit("--learn-skips does not apply with --no-plan")
+    planner = SecretsPlanner(
+        selected,
+        path=None if args.no_plan else args.plan_cache,
+        rules=not args.no_plan,
+        skip_learned=args.learn_skips,
+    )
+    planner.load()
+    metrics = Metrics(enabled=bool(args.metrics_out), profile=args.profile)
+    metrics.start()
+    if args.engine == "threads":
+        get_client(args.workers, args.rate_limit)
+    journal = None
+    complete = False
+    try:
+        if args.resume:
+            journal = SecretsJournal(args.output, [column for _, column, _ in SECRETS])
+            skipped = journal.load()
+            print(f"Resuming {args.output}: skipping {skipped} devices, retrying failed secrets of {len(journal.partial)}")
+        if args.stream:
+            print(f"Streaming secrets for the devices in {args.input} to {args.output}")
+            written = stream_device_secrets(args, journal)
+            print(f"Wrote secrets for {written} devices to {args.output}")
+        else:
+            batch_device_secrets(args, journal)
+        complete = True
+    finally:
+        planner.save()
+        for by_secret, reason in (
+            (planner.skipped, "for secrets the platform cannot have"),
+            (planner.learned, f"that the model usually answers 404 for, written as \"{LEARNED_SKIP}\""),
+        ):
+            counts = {secret: count for secret, count in by_secret.items() if count}
+            if counts:
+                listed = ", ".join(f"{count} {secret}" for secret, count in counts.items())
+                print(f"Skipped {sum(counts.values())} secrets calls {reason} ({listed})")
+        if journal is not None:
+            journal.finish(complete)
+            if journal.failed:
+                print(f"{len(journal.failed)} devices still have failed secrets, run again with --resume to retry them")
+        if client is not None:
+            client.close()
+        metrics.finish(args.metrics_out)
 
 if __name__ == "__main__":
     main()
@@ -43,29 +43,49 @@ __version__ = "1.1.0"
 
 # Standard library
 import argparse
+import collections
 import csv
+import hashlib
+import heapq
+import itertools
+import json
 import pathlib
+import re
 import sys
 import os
-from datetime import datetime, timedelta, timezone
-
-from dotenv import load_dotenv
-from dateutil.parser import isoparse
-
-load_dotenv()
-
-# Try to import the module. If the module cannot be imported let the user know so that
-# they can install it.
-try:
-    import requests
-except ImportError as import_error:
-    print(import_error)
-    sys.exit(
-        "Looks like you need to install the requests module. Open a Terminal and run  "
-        "python3 -m pip install requests."
-    )
-
-from requests.adapters import HTTPAdapter
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
+from http import HTTPStatus
+
+# requests and dateutil are imported when they are first needed, so that importing this
+# module, --help and --version stay fast and free of side effects.
+from kandji_cache import CacheMiss, ResponseCache
+from kandji_checkpoint import CrawlJournal
+from kandji_client import (
+    RATE_LIMIT,
+    KandjiAPIError,
+    KandjiClient,
+    KandjiRateLimitError,
+    KandjiServerError,
+    PageSizer,
+)
+from kandji_config import Config, ConfigError, load_tenants
+from kandji_json import CHUNK_SIZE, DECODERS, get_loads, iter_json_array
+from kandji_metrics import Metrics
+from kandji_output import (
+    FORMATS,
+    ColumnTypes,
+    import_optional,
+    open_text,
+    report_path,
+    write_arrow,
+    write_jsonl_zst,
+)
+from kandji_query import UNITS, QueryError, compile_where, parse_duration
+from kandji_rows import RowTable
+from kandji_store import InventoryStore, synced_at_text
 
 ########################################################################################
 ######################### UPDATE VARIABLES BELOW #######################################
@@ -76,35 +96,14 @@ SUBDOMAIN = "truework"  # bravewaffles, example, company_name
 # us("") and eu - this can be found in the Kandji settings on the Access tab (Leave blank for US)
 REGION = ""
 
-# Kandji Bearer Token
-TOKEN = os.getenv("KANDJI_API_TOKEN")
-if not TOKEN:
-    raise SystemExit("Please run export KANDJI_API_TOKEN=<API_TOKEN> before running this script")
+# The Kandji Bearer Token is read from KANDJI_API_TOKEN, or a .env file, when first needed
 
 ########################################################################################
 ######################### DO NOT MODIFY BELOW THIS LINE ################################
 ########################################################################################
 
-UNITS = {"s":"seconds", "m":"minutes", "h":"hours", "d":"days", "w":"weeks"}
-
-# Kandji API base URL
-if REGION in ["", "us"]:
-    BASE_URL = f"https://{SUBDOMAIN}.api.kandji.io/api"
-
-elif REGION in ["eu"]:
-    BASE_URL = f"https://{SUBDOMAIN}.api.{REGION}.kandji.io/api"
-
-else:
-    sys.exit(f'\nUnsupported region "{REGION}". Please update and try again\n')
-
-TODAY = datetime.today().strftime("%Y%m%d")
-
-HEADERS = {
-    "Authorization": f"Bearer {TOKEN}",
-    "Accept": "application/json",
-    "Content-Type": "application/json;charset=utf-8",
-    "Cache-Control": "no-cache",
-}
+# Tenant settings, created on first use by get_config()
+CONFIG = None
 
 # Report name
 SCRIPT_NAME = "Device Report"
@@ -113,19 +112,101 @@ TODAY = datetime.today().strftime("%Y%m%d")
 # Current working directory
 HERE = pathlib.Path("__file__").parent
 
+# Rows held in memory per sorted run when sorting a streamed report
+SORT_RUN_SIZE = 50_000
+
+# Report values that --sort orders as numbers
+NUMBER_RE = re.compile(r"-?\d+(\.\d+)?")
+
+# Number of keep-alive connections held open to the tenant
+POOL_SIZE = 10
+
+# Shared API client, created on first use by get_client()
+CLIENT = None
+
+# Response cache shared by every client in this run, set by --cache-dir
+CACHE = None
+
+# JSON decoder for API responses, set by --json-decoder
+JSON_DECODER = "json"
+
+# Devices returned per page of GET /v1/devices
+DEVICE_PAGE_LIMIT = 300
+
+# Run metrics, enabled by --profile or --metrics-out
+METRICS = Metrics(enabled=False)
+
+
+def get_config():
+    """Return the tenant settings, creating them on first use."""
+    global CONFIG
+    if CONFIG is None:
+        CONFIG = Config(SUBDOMAIN, REGION)
+    return CONFIG
+
+
+def __getattr__(name):
+    """Resolve TOKEN, BASE_URL and HEADERS from the tenant settings when first read."""
+    if name in ("TOKEN", "BASE_URL", "HEADERS"):
+        return getattr(get_config(), name.lower())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_client(pool_size=POOL_SIZE, rate_limit=RATE_LIMIT, replay=False):
+    """Return the shared Kandji API client, creating it on first use.
+
+    With replay the client answers from CACHE only and needs no API token.
+    """
+    global CLIENT
+    if CLIENT is None:
+        import_optional("requests", "requests")
+        config = get_config()
+        CLIENT = KandjiClient(
+            config.base_url,
+            headers={} if replay else config.headers,
+            pool_size=pool_size,
+            rate_limit=rate_limit,
+            metrics=METRICS if METRICS.enabled else None,
+            cache=CACHE,
+            replay=replay,
+        )
+    return CLIENT
+
+
+def page_sizer(arguments, client=None):
+    """Return a PageSizer for one device inventory crawl, or None without --adaptive-pages."""
+    if not arguments.adaptive_pages:
+        return None
+    client = client or get_client()
+    # leave room inside the request timeout for a page that is slower than the last ones
+    return PageSizer(maximum=DEVICE_PAGE_LIMIT, target=client.timeout / 4)
+
 
-def var_validation():
+def decode_json(raw):
+    """Decode a JSON response body with the selected decoder."""
+    return get_loads(JSON_DECODER)(raw)
+
+
+def var_validation(replay=False):
     """Validate variables."""
-    if SUBDOMAIN in ["", "accuhive"]:
+    config = get_config()
+    try:
+        base_url = config.base_url
+        # a replay is answered from the cache, so it does not need a token
+        token = None if replay else config.token
+    except ConfigError as error:
+        sys.exit(f"\n{error}\n")
+
+    if config.subdomain in ["", "accuhive"]:
         print(
-            f'\nThe subdomain "{SUBDOMAIN}" in {BASE_URL} needs to be updated to '
+            f'\nThe subdomain "{config.subdomain}" in {base_url} needs to be updated to '
             "your Kandji tenant subdomain..."
         )
         print("Please see the example in the README for this repo.\n")
         sys.exit()
 
-    if TOKEN in ["api_key", ""]:
-        print(f'\nThe TOKEN should not be "{TOKEN}"...')
+    if token is not None and token in ["api_key", ""]:
+        print(f'\nThe TOKEN should not be "{token}"...')
         print("Please update this to your API Token.\n")
         sys.exit()
 
@@ -159,6 +240,246 @@ def program_arguments():
         required=False
     )
 
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=POOL_SIZE,
+        metavar="N",
+        help=f"Number of keep-alive connections to hold open to Kandji (default: {POOL_SIZE}).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of device inventory pages to fetch concurrently (default: 1).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--adaptive-pages",
+        action="store_true",
+        help="Size each device inventory page from how long and how big recent pages "
+        f"were, up to {DEVICE_PAGE_LIMIT} devices, and ask for smaller pages when they "
+        "time out.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream records from the API straight into the report instead of holding the "
+        "whole inventory in memory.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--columns",
+        type=str,
+        metavar="COLUMN[,COLUMN...]",
+        help="Comma separated report columns, in report order. With --stream this skips "
+        "the column discovery pass over the spooled records.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=RATE_LIMIT,
+        metavar="RPS",
+        help="Maximum requests per second to send to Kandji (default: no limit until "
+        "Kandji answers 429, then half the rate sent until then). The rate backs off "
+        "automatically on 429 responses.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--store",
+        type=str,
+        metavar="FILENAME",
+        help="SQLite file used as a local device inventory store. The report is answered "
+        "from the store while it is fresh and the store is refreshed from Kandji otherwise.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--max-age",
+        type=str,
+        default="1h",
+        metavar=f"1[{','.join(UNITS.keys())}]",
+        help="How old the local store may be before it is refreshed from Kandji "
+        "(default: 1h). Only used with --store.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--since-last-run",
+        action="store_true",
+        help="Only flatten devices that were added or changed since the last run, and "
+        "copy the rest from the previous report.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--state",
+        type=str,
+        metavar="FILENAME",
+        help="State file used by --since-last-run (default: .<report type>_report_state.json).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Save every device page to a checkpoint while crawling, and carry on from "
+        "the checkpoint of a crawl that failed part way through instead of starting over. "
+        "The checkpoint is removed once the report has been written.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        metavar="DIRECTORY",
+        help="Checkpoint directory used by --resume (default: .<report type>_crawl).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--sort",
+        type=str,
+        metavar="COLUMN[,COLUMN...]",
+        help="Comma separated report columns to sort the rows by, e.g. "
+        "serial_number,last_check_in.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--where",
+        type=str,
+        metavar="EXPRESSION",
+        help='Only report devices matching the expression, e.g. \'platform == "Mac" and '
+        'os_version < "14" and last_check_in older 30d\'. Equality tests on fields the '
+        "Kandji API can filter on are sent to the API.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="csv",
+        choices=FORMATS,
+        help="Report file format (default: csv). parquet and arrow need pyarrow, "
+        "jsonl.zst needs zstandard.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--json-decoder",
+        type=str,
+        default=JSON_DECODER,
+        choices=DECODERS,
+        help=f"How API responses are decoded (default: {JSON_DECODER}). orjson is faster "
+        "and needs python3 -m pip install orjson. stream parses each device record as it "
+        "arrives, so the report starts before a page has finished downloading; it only "
+        "applies with --workers 1.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        metavar="DIRECTORY",
+        help="Keep API responses in this directory and answer repeated requests from it "
+        "while they are younger than --cache-ttl.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        type=str,
+        default="1h",
+        metavar=f"1[{','.join(UNITS.keys())}]",
+        help="How long cached API responses are used without asking Kandji (default: 1h). "
+        "Older responses are revalidated when Kandji sent an ETag or Last-Modified header.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Build the report only from the responses recorded in --cache-dir, without "
+        "contacting Kandji or needing an API token.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--tenants",
+        type=str,
+        metavar="FILENAME",
+        help="JSON file listing several Kandji tenants to report on at once. Every tenant "
+        "is crawled concurrently with its own connection pool and rate limit. See the top "
+        "of kandji_config.py for the format.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--tenant-output",
+        type=str,
+        default="merged",
+        choices=("merged", "split"),
+        help="With --tenants, write one report with a tenant column (merged, the default) "
+        "or a separate <tenant>_<report> file per tenant (split).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--enrich",
+        type=str,
+        metavar="details,apps",
+        help="Comma separated per-device data to add to the report: details adds the "
+        "device details, apps adds the installed apps. Each device costs one extra API "
+        "call per item, made concurrently.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--enrich-workers",
+        type=int,
+        default=ENRICH_WORKERS,
+        metavar="N",
+        help=f"Number of concurrent per-device requests for --enrich (default: {ENRICH_WORKERS}).",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--apps-table",
+        action="store_true",
+        help="With --enrich apps, write the apps to separate <report>_apps.csv and "
+        "<report>_device_apps.csv tables instead of an apps column in the report.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        choices=("cpu", "memory"),
+        help="Profile the run with cProfile (cpu) or tracemalloc (memory) and print the "
+        "per-phase timing summary.",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        metavar="FILENAME",
+        help="Write per-phase timings and request metrics (counts, bytes, retries, status "
+        "codes, latency percentiles) to this JSON file.",
+        required=False,
+    )
+
     parser.version = __version__
     parser.add_argument("--version", action="version", help="Show this tool's version.")
     # parser.add_argument("-v", "--verbose", action="store", metavar="LEVEL")
@@ -169,11 +490,11 @@ def program_arguments():
 def http_errors(resp, resp_code, err_msg):
     """Handle HTTP errors."""
     # 400
-    if resp_code == requests.codes["bad_request"]:
+    if resp_code == HTTPStatus.BAD_REQUEST:
         print(f"\n\t{err_msg}")
         print(f"\tResponse msg: {resp.text}\n")
     # 401
-    elif resp_code == requests.codes["unauthorized"]:
+    elif resp_code == HTTPStatus.UNAUTHORIZED:
         print("Make sure that you have the required permissions to access this data.")
         print(
             "Depending on the API platform this could mean that access has just been "
@@ -181,11 +502,11 @@ def http_errors(resp, resp_code, err_msg):
         )
         sys.exit(f"\t{err_msg}")
     # 403
-    elif resp_code == requests.codes["forbidden"]:
+    elif resp_code == HTTPStatus.FORBIDDEN:
         print("The api key may be invalid or missing.")
         sys.exit(f"\t{err_msg}")
     # 404
-    elif resp_code == requests.codes["not_found"]:
+    elif resp_code == HTTPStatus.NOT_FOUND:
         print("\nWe cannot find the one that you are looking for...")
         print("Move along...")
         print(f"\tError: {err_msg}")
@@ -196,25 +517,30 @@ def http_errors(resp, resp_code, err_msg):
             "\t\t\t enrolled in Kandji. This would prevent the MDM command from being\n"
             "\t\t\t sent successfully.\n"
         )
-    # 429
-    elif resp_code == requests.codes["too_many_requests"]:
+    # 429 - only reached once the client has run out of rate limit retries
+    elif resp_code == HTTPStatus.TOO_MANY_REQUESTS:
         print("You have reached the rate limit ...")
         print("Try again later ...")
-        sys.exit(f"\t{err_msg}")
+        raise KandjiRateLimitError(resp, f"{err_msg}")
     # 500
-    elif resp_code == requests.codes["internal_server_error"]:
+    elif resp_code == HTTPStatus.INTERNAL_SERVER_ERROR:
         print("The service is having a problem...")
-        sys.exit(err_msg)
+        raise KandjiServerError(resp, f"{err_msg}")
     # 503
-    elif resp_code == requests.codes["service_unavailable"]:
+    elif resp_code == HTTPStatus.SERVICE_UNAVAILABLE:
         print("Unable to reach the service. Try again later...")
+        raise KandjiServerError(resp, f"{err_msg}")
+    # any other 5xx
+    elif resp_code >= 500:
+        print("The service is having a problem...")
+        raise KandjiServerError(resp, f"{err_msg}")
     else:
         print("Something really bad must have happened...")
         print(err_msg)
         sys.exit()
 
 
-def kandji_api(method, endpoint, params=None, payload=None):
+def kandji_api(method, endpoint, params=None, payload=None, client=None, stats=None):
     """Make an API request and return data.
 
     method   - an HTTP Method (GET, POST, PATCH, DELETE).
@@ -222,66 +548,320 @@ def kandji_api(method, endpoint, params=None, payload=None):
     params   - optional parameters can be passed as a dict.
     payload  - optional payload is passed as a dict and used with PATCH and POST
                methods.
+    client   - optional KandjiClient to send the request with. Defaults to the
+               shared client so that connections are reused between calls.
+    stats    - optional dict that gets the size of the response body in "bytes".
     Returns a JSON data object.
     """
-    attom_adapter = HTTPAdapter(max_retries=3)
-    with requests.Session() as session:
-        session.mount(BASE_URL, attom_adapter)
+    client = client or get_client()
+    from requests.exceptions import RequestException
+
+    response = None
+    try:
+        response = client.request(method, endpoint, params=params, payload=payload)
+        if stats is not None:
+            stats["bytes"] = len(response.content)
+
+        # If a successful status code is returned (200 and 300 range)
+        if response:
+            try:
+                data = decode_json(response.content)
+            except Exception:
+                data = response.text
+
+        # if the request is successful exceptions will not be raised
+        response.raise_for_status()
+
+    except RequestException as err:
+        # no response to report on, e.g. a timeout or a dropped connection
+        if response is None:
+            raise
+        http_errors(resp=response, resp_code=response.status_code, err_msg=err)
+        data = {"error": f"{response.status_code}", "api resp": f"{err}"}
 
-        try:
-            response = session.request(
-                method,
-                BASE_URL + endpoint,
-                data=payload,
-                headers=HEADERS,
-                params=params,
-                timeout=30,
+    return data
+
+
+def iter_api_items(endpoint, params=None, client=None, stats=None):
+    """Yield the items of a JSON array response as they are parsed off the socket.
+
+    stats - optional dict that gets the number of body bytes read so far in "bytes".
+    """
+    client = client or get_client()
+    response = client.request("GET", endpoint, params=params, stream=True)
+
+    def counted(chunks):
+        for chunk in chunks:
+            stats["bytes"] = stats.get("bytes", 0) + len(chunk)
+            yield chunk
+
+    with response:
+        if not response.ok:
+            http_errors(
+                resp=response,
+                resp_code=response.status_code,
+                err_msg=f"{response.status_code} {response.reason}: {response.url}",
+            )
+            return
+        chunks = response.iter_content(CHUNK_SIZE)
+        yield from iter_json_array(counted(chunks) if stats is not None else chunks)
+
+
+def device_page_params(params, ordering, limit, offset):
+    """Return the query params for a single page of device inventory."""
+    # copy so that concurrent pages do not share the same params dict
+    page_params = dict(params)
+    page_params.update(
+        {"ordering": f"{ordering}", "limit": f"{limit}", "offset": f"{offset}"}
+    )
+    return page_params
+
+
+def get_devices_page(params, ordering, limit, offset, client=None, sizer=None):
+    """Return a single page of device inventory.
+
+    sizer - optional kandji_client.PageSizer that is told how long the page took and
+            how big it was.
+    """
+    stats = {} if sizer else None
+    started = time.perf_counter()
+    page = kandji_api(
+        method="GET",
+        endpoint="/v1/devices",
+        params=device_page_params(params, ordering, limit, offset),
+        client=client,
+        stats=stats,
+    )
+    if sizer:
+        sizer.observe(len(page), time.perf_counter() - started, stats.get("bytes", 0))
+    return page
+
+
+def page_timed_out(error):
+    """Return True if a page request failed because the page took too long."""
+    from requests.exceptions import ConnectionError, Timeout
+
+    if isinstance(error, KandjiServerError):
+        return error.status_code == HTTPStatus.GATEWAY_TIMEOUT
+    # read timeouts that urllib3 has already retried come back as a ConnectionError
+    return isinstance(error, (Timeout, ConnectionError))
+
+
+def iter_device_pages_parallel(params, ordering, limit, workers, client=None, start=0, sizer=None):
+    """Yield (offset, limit, page) for device inventory pages fetched concurrently.
+
+    Keeps up to `workers` offsets in flight and stops issuing new offsets once a short
+    or empty page comes back. Pages are yielded in offset order, as soon as every page
+    before them has arrived, so the result is the same as fetching them one at a time.
+
+    With a sizer each page asks for sizer.limit records, and a page that times out is
+    asked for again as two half pages.
+    """
+    # offset -> (limit, page)
+    pages = {}
+    # future -> (offset, limit)
+    pending = {}
+    offset = start
+    # next page offset to hand back to the caller
+    next_offset = start
+    # offset of the first short or empty page seen, i.e. the end of the inventory
+    last_offset = None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(page_offset, page_limit):
+            future = executor.submit(
+                get_devices_page, params, ordering, page_limit, page_offset, client, sizer
             )
+            pending[future] = (page_offset, page_limit)
 
-            # If a successful status code is returned (200 and 300 range)
-            if response:
+        while True:
+            while len(pending) < workers and last_offset is None:
+                page_limit = sizer.limit if sizer else limit
+                submit(offset, page_limit)
+                offset += page_limit
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page_offset, page_limit = pending.pop(future)
                 try:
-                    data = response.json()
-                except Exception:
-                    data = response.text
+                    page = future.result()
+                except Exception as error:
+                    if not (sizer and page_limit > 1 and page_timed_out(error) and sizer.timed_out()):
+                        raise
+                    half = page_limit // 2
+                    submit(page_offset, half)
+                    submit(page_offset + half, page_limit - half)
+                    continue
+
+                pages[page_offset] = (page_limit, page)
+                if len(page) < page_limit and (last_offset is None or page_offset < last_offset):
+                    last_offset = page_offset
+
+            while next_offset in pages and (last_offset is None or next_offset <= last_offset):
+                page_limit, page = pages.pop(next_offset)
+                yield next_offset, page_limit, page
+                next_offset += page_limit
+
+
+def iter_device_pages_serial(params, ordering, limit, client=None, start=0, sizer=None):
+    """Yield (offset, limit, page) for device inventory pages fetched one at a time.
+
+    With a sizer each page asks for sizer.limit records, and a page that times out is
+    asked for again with a smaller limit.
+    """
+    # offset - set the starting point within a list of resources
+    offset = start
 
-            # if the request is successful exceptions will not be raised
-            response.raise_for_status()
+    while True:
+        page_limit = sizer.limit if sizer else limit
+        try:
+            response = get_devices_page(
+                params, ordering, page_limit, offset, client=client, sizer=sizer
+            )
+        except Exception as error:
+            if sizer and page_timed_out(error) and sizer.timed_out():
+                continue
+            raise
 
-        except requests.exceptions.RequestException as err:
-            http_errors(resp=response, resp_code=response.status_code, err_msg=err)
-            data = {"error": f"{response.status_code}", "api resp": f"{err}"}
+        if len(response) == 0:
+            break
 
-        return data
+        yield offset, page_limit, response
+        offset += page_limit
 
+        # a short page is the last one, as in iter_device_pages_parallel
+        if len(response) < page_limit:
+            break
 
-def get_devices(params=None, ordering="serial_number"):
-    """Return device inventory."""
-    count = 0
+
+def iter_device_pages(
+    params=None, ordering="serial_number", client=None, workers=1, journal=None, sizer=None
+):
+    """Yield device inventory one page at a time as each page arrives.
+
+    journal - optional kandji_checkpoint.CrawlJournal. Pages it saved in an earlier run
+              are replayed first, the crawl carries on from the first missing offset,
+              and every new page is saved to it before it is handed on.
+    sizer   - optional kandji_client.PageSizer that picks the size of every page
+              instead of DEVICE_PAGE_LIMIT.
+    """
+    params = params or {}
     # limit - set the number of records to return per API call
-    limit = 300
-    # offset - set the starting point within a list of resources
+    limit = DEVICE_PAGE_LIMIT
     offset = 0
-    # inventory
-    data = []
+    # device ids already replayed, in case devices added since then shifted the pages
+    seen = None
+
+    if journal is not None:
+        yield from journal.completed()
+        if journal.finished:
+            return
+        offset = journal.next_offset
+        seen = journal.device_ids
+
+    if workers > 1:
+        pages = iter_device_pages_parallel(
+            params, ordering, limit, workers, client=client, start=offset, sizer=sizer
+        )
+    else:
+        pages = iter_device_pages_serial(
+            params, ordering, limit, client=client, start=offset, sizer=sizer
+        )
+
+    for offset, page_limit, page in pages:
+        if journal is not None:
+            journal.add(offset, page, page_limit)
+        offset += page_limit
+        yield [record for record in page if record.get("device_id") not in seen] if seen else page
+
+    if journal is not None and not journal.finished:
+        # the crawl ended on an empty page
+        journal.add(offset, [])
+
+
+def iter_devices_streamed(
+    params=None, ordering="serial_number", client=None, journal=None, sizer=None
+):
+    """Yield device inventory records as they are parsed, before their page has finished.
+
+    journal - as for iter_device_pages. A page is saved once all of it has arrived.
+    sizer   - as for iter_device_pages. When a page times out part way through, the
+              crawl carries on after the last record received, with a smaller limit.
+    """
+    params = params or {}
+    limit = DEVICE_PAGE_LIMIT
+    offset = 0
+    seen = None
+
+    if journal is not None:
+        for page in journal.completed():
+            yield from page
+        if journal.finished:
+            return
+        offset = journal.next_offset
+        seen = journal.device_ids
 
     while True:
-        # update params
-        params.update(
-            {"ordering": f"{ordering}", "limit": f"{limit}", "offset": f"{offset}"}
+        page = []
+        page_limit = sizer.limit if sizer else limit
+        page_params = device_page_params(params, ordering, page_limit, offset)
+        stats = {} if sizer else None
+        started = time.perf_counter()
+        try:
+            for record in iter_api_items(
+                "/v1/devices", params=page_params, client=client, stats=stats
+            ):
+                page.append(record)
+                if not seen or record.get("device_id") not in seen:
+                    yield record
+        except Exception as error:
+            if not (sizer and page_timed_out(error) and sizer.timed_out()):
+                raise
+            # keep what arrived as a page of its own and ask for the rest again
+            page_limit = len(page)
+            if not page:
+                continue
+        else:
+            if sizer:
+                sizer.observe(len(page), time.perf_counter() - started, stats.get("bytes", 0))
+
+        if journal is not None:
+            journal.add(offset, page, page_limit)
+        offset += page_limit
+        # a short page is the last one
+        if len(page) < page_limit:
+            break
+
+
+def iter_devices(
+    params=None, ordering="serial_number", client=None, workers=1, journal=None, sizer=None
+):
+    """Yield device inventory records one at a time as their pages arrive.
+
+    With the stream decoder and a single worker each record is handed on as soon as it
+    has been parsed off the socket. journal and sizer are passed on to iter_device_pages.
+    """
+    if JSON_DECODER == "stream" and workers <= 1:
+        yield from iter_devices_streamed(
+            params, ordering, client=client, journal=journal, sizer=sizer
         )
+        return
 
-        # check to see if a platform was specified
-        response = kandji_api(method="GET", endpoint="/v1/devices", params=params)
+    for page in iter_device_pages(
+        params, ordering, client=client, workers=workers, journal=journal, sizer=sizer
+    ):
+        # breakout the response then hand each record to the caller
+        yield from page
 
-        count += len(response)
-        offset += limit
-        if len(response) == 0:
-            break
 
-        # breakout the response then append to the data list
-        for record in response:
-            data.append(record)
+def get_devices(params=None, ordering="serial_number", client=None, workers=1):
+    """Return device inventory."""
+    # inventory
+    data = list(iter_devices(params, ordering, client=client, workers=workers))
 
     if len(data) < 1:
         print("No devices found...\n")
@@ -290,51 +870,201 @@ def get_devices(params=None, ordering="serial_number"):
     return data
 
 
-def flatten(input_dict, separator="_", prefix=""):
-    """Flatten JSON."""
-    output_dict = {}
+# Per-device endpoints that --enrich can add to the report
+ENRICH_KINDS = ("details", "apps")
+
+# Devices enriched concurrently unless --enrich-workers says otherwise
+ENRICH_WORKERS = 8
 
-    for key, value in input_dict.items():
 
-        # Check to see if the JSON value is a dict type. If it is then we we need to break the
-        # JSON structure out more.
-        if isinstance(value, dict) and value:
+def get_device_resource(device_id, resource, client=None):
+    """Return GET /v1/devices/{device_id}/{resource}, or None if the device is gone."""
+    client = client or get_client()
+    response = client.request("GET", f"/v1/devices/{device_id}/{resource}")
 
-            deeper = flatten(value, separator, prefix + key + separator)
+    if response.status_code == HTTPStatus.NOT_FOUND:
+        # the device was removed after the inventory was read
+        return None
 
-            # update the dictionary with the new structure.
-            output_dict.update({key2: val2 for key2, val2 in deeper.items()})
+    if not response.ok:
+        http_errors(
+            resp=response,
+            resp_code=response.status_code,
+            err_msg=f"{response.status_code} {response.reason}: {response.url}",
+        )
+        return None
 
-        # If the JSON value is a list then loop over and see if we need to break out any values
-        # contained in the list.
-        elif isinstance(value, list) and value:
+    return decode_json(response.content)
 
-            for index, sublist in enumerate(value, start=1):
 
-                # Check to see if the JSON value is a dict type. If it is then we we need to
-                # break the JSON structure out more.
-                if isinstance(sublist, dict) and sublist:
-                    deeper = flatten(
-                        sublist,
-                        separator,
-                        prefix + key + separator + str(index) + separator,
-                    )
+class AppTable:
+    """App inventory that stores every distinct app entry once.
+
+    Most devices in a fleet run the same app versions, so each device keeps a tuple of
+    app ids into this table instead of its own copy of every entry.
+    """
 
-                    # update the dictionary with the new structure.
-                    output_dict.update({key2: val2 for key2, val2 in deeper.items()})
+    def __init__(self):
+        # app entry key -> app id
+        self.ids = {}
+        # app entries, app id N is at index N - 1
+        self.apps = []
+
+    def intern(self, app):
+        """Return the id of an app entry, adding it to the table if it is new."""
+        try:
+            key = tuple(sorted(app.items()))
+            app_id = self.ids.get(key)
+        except TypeError:
+            # entries with list or dict values
+            key = json.dumps(app, sort_keys=True)
+            app_id = self.ids.get(key)
+
+        if app_id is None:
+            self.apps.append(app)
+            app_id = self.ids[key] = len(self.apps)
+        return app_id
+
+    def summary(self, app_ids):
+        """Return "name version" for each app, for a single report column."""
+        names = []
+        for app_id in app_ids:
+            app = self.apps[app_id - 1]
+            names.append(f"{app.get('app_name', '')} {app.get('version', '')}".strip())
+        return "; ".join(names)
+
+    def write(self, filename):
+        """Write the table as CSV, one row per distinct app entry."""
+        fields = {"app_id": None}
+        for app in self.apps:
+            fields.update(dict.fromkeys(app))
+
+        with open(filename, mode="w", encoding="utf-8", newline="") as apps_file:
+            writer = csv.DictWriter(apps_file, fieldnames=list(fields))
+            writer.writeheader()
+            for app_id, app in enumerate(self.apps, start=1):
+                writer.writerow({**app, "app_id": app_id})
+
+
+class DeviceEnricher:
+    """Adds per-device details and apps to device records using a bounded worker pool.
+
+    kinds       - any of ENRICH_KINDS.
+    workers     - number of concurrent requests. They all share the client's
+                  keep-alive connection pool.
+    device_apps - optional csv.writer for (device_id, app_id) rows. When given, apps are
+                  written there instead of being merged into the records.
+    """
 
+    def __init__(self, kinds, workers=ENRICH_WORKERS, client=None, device_apps=None):
+        self.kinds = kinds
+        self.workers = workers
+        self.client = client
+        self.device_apps = device_apps
+        self.apps = AppTable()
+
+    def merge(self, record, futures):
+        """Add the fetched resources of a device to its record."""
+        if "details" in futures:
+            details = futures["details"].result()
+            if details is not None:
+                record["details"] = details
+
+        if "apps" in futures:
+            apps = futures["apps"].result()
+            if apps is not None:
+                app_ids = tuple(self.apps.intern(app) for app in apps.get("apps", []))
+                record["app_count"] = len(app_ids)
+                if self.device_apps:
+                    self.device_apps.writerows((record["device_id"], app_id) for app_id in app_ids)
                 else:
-                    output_dict[prefix + key + separator + str(index)] = value
+                    record["apps"] = self.apps.summary(app_ids)
+
+        return record
+
+    def enrich(self, records):
+        """Yield the records, in order, with their details and apps added."""
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        # devices whose requests are in flight, oldest first
+        pending = collections.deque()
+        # devices in flight. Records are yielded in order, so keep enough of them going
+        # that the workers stay busy while one device waits out a retry
+        window = self.workers * 32
+
+        try:
+            for record in records:
+                futures = {
+                    kind: executor.submit(
+                        get_device_resource, record["device_id"], kind, self.client
+                    )
+                    for kind in self.kinds
+                }
+                pending.append((record, futures))
+                if len(pending) >= window:
+                    yield self.merge(*pending.popleft())
+
+            while pending:
+                yield self.merge(*pending.popleft())
 
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_enriched_devices(records, kinds, report_name, workers=ENRICH_WORKERS, apps_table=False):
+    """Yield device records with --enrich data added.
+
+    With apps_table the apps go to <report>_apps.csv, one row per distinct app, and
+    <report>_device_apps.csv, one row per device and app, instead of the report rows.
+    """
+    if "apps" not in kinds or not apps_table:
+        yield from DeviceEnricher(kinds, workers=workers).enrich(records)
+        return
+
+    stem = report_name[: report_name.index(".")]
+    with open(f"{stem}_device_apps.csv", mode="w", encoding="utf-8", newline="") as device_apps:
+        writer = csv.writer(device_apps)
+        writer.writerow(["device_id", "app_id"])
+        enricher = DeviceEnricher(kinds, workers=workers, device_apps=writer)
+        yield from enricher.enrich(records)
+
+    enricher.apps.write(f"{stem}_apps.csv")
+    print(f"Apps table at: {HERE.resolve()}/{stem}_apps.csv ({len(enricher.apps.apps)} apps)")
+    print(f"Device apps table at: {HERE.resolve()}/{stem}_device_apps.csv")
+
+
+def flatten(input_dict, separator="_", prefix=""):
+    """Flatten JSON.
+
+    Nested dicts are broken out under "<key>_" and lists under "<key>_<n>", depth first
+    with an explicit stack instead of recursion. Lists inside lists, and empty dicts and
+    lists, are kept as plain values.
+    """
+    output_dict = {}
+    # (column prefix, remaining (key, value) pairs, inside a list) of every level
+    stack = [(prefix, iter(input_dict.items()), False)]
+
+    while stack:
+        prefix, items, in_list = stack[-1]
+        for key, value in items:
+            column = prefix + key
+            if value and isinstance(value, dict):
+                stack.append((column + separator, iter(value.items()), False))
+                break
+            if value and not in_list and isinstance(value, list):
+                numbered = zip(map(str, itertools.count(1)), value)
+                stack.append((column + separator, numbered, True))
+                break
+            output_dict[column] = value
         else:
-            output_dict[prefix + key] = value
+            stack.pop()
 
     return output_dict
 
 
-def generate_report_payload(_input, details_param=None):
-    """Create a JSON payload."""
-    report_payload = []
+def iter_report_payload(_input, details_param=None):
+    """Yield flattened report records one at a time."""
+    if details_param:
+        details_param_key, details_param_value = next(iter(details_param.items()))
 
     for record in _input:
 
@@ -342,76 +1072,722 @@ def generate_report_payload(_input, details_param=None):
 
         if details_param:
 
-            details_param_keys = list(details_param.keys())
-            details_param_values = list(details_param.values())
+            if (
+                details_param_key in flattened
+                and flattened[details_param_key] == details_param_value
+            ):
+                yield flattened
+
+        else:
+            yield flattened
 
-            for key, value in flattened.items():
 
-                if key == details_param_keys[0] and details_param_values[0] == value:
+def generate_report_payload(_input, details_param=None):
+    """Create a JSON payload, held as a compact RowTable of flattened records."""
+    return RowTable(iter_report_payload(_input, details_param))
 
-                    report_payload.append(flattened)
 
-        else:
-            report_payload.append(flattened)
+def count_records(records, counts, name):
+    """Yield the records, counting them in counts[name]."""
+    for record in records:
+        counts[name] += 1
+        yield record
+
+
+def report_fields(out_fields, sort_by="serial_number"):
+    """Return the report column order with the "sort_by" field(s) first."""
+
+    # find the "sort_by" field so that we can sort the report on that.
+    def thingy(out_field):
+        this = ""
+        if sort_by in out_field:
+            this = out_field
+        return this
+
+    return sorted(out_fields, key=thingy, reverse=True)
+
+
+def row_sort_key(sort_keys):
+    """Return a key function that orders rows by the given columns.
+
+    Rows are compared on the text that ends up in the report, so rows read back from an
+    earlier CSV sort the same way as freshly flattened ones. Values that are numbers
+    (app_count, 10 after 9) sort as numbers, before any text in the same column.
+    Missing values sort first.
+    """
+
+    def value_key(value):
+        text = "" if value is None else str(value)
+        if not text:
+            return (0, 0.0, text)
+        if NUMBER_RE.fullmatch(text):
+            return (1, float(text), text)
+        return (2, 0.0, text)
 
-    return report_payload
+    def key(row):
+        return tuple(value_key(row.get(sort_key)) for sort_key in sort_keys)
 
+    return key
 
-def write_report(_input, report_name, sort_by="serial_number"):
-    """Write the report."""
+
+def spill_run(rows):
+    """Write already sorted rows to a temporary JSON lines file, rewound for reading."""
+    run = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+    for row in rows:
+        run.write(json.dumps(row))
+        run.write("\n")
+    run.seek(0)
+    return run
+
+
+def external_sort(rows, sort_keys, run_size=SORT_RUN_SIZE):
+    """Yield rows sorted by the given columns, holding at most run_size rows in memory.
+
+    Rows are sorted in runs of run_size that are spilled to temporary files and then
+    merged. Inputs that fit in a single run are sorted in memory. The sort is stable.
+    """
+    key = row_sort_key(sort_keys)
+    runs = []
+    chunk = []
+
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= run_size:
+                chunk.sort(key=key)
+                runs.append(spill_run(chunk))
+                chunk = []
+
+        chunk.sort(key=key)
+        if not runs:
+            yield from chunk
+            return
+
+        if chunk:
+            runs.append(spill_run(chunk))
+            chunk = []
+
+        yield from heapq.merge(*(map(json.loads, run) for run in runs), key=key)
+
+    finally:
+        for run in runs:
+            run.close()
+
+
+def write_report(_input, report_name, sort_by="serial_number", sort_keys=None, columns=None):
+    """Write the report, with only the given columns if there are any."""
     # write report to csv file
 
     with open(report_name, mode="w", encoding="utf-8") as report:
 
-        out_fields = []
-
-        for item in _input:
-            for key in item.keys():
-                if key not in out_fields:
-                    out_fields.append(key)
+        # dict keys double as an insertion ordered set of column names
+        out_fields = {}
 
-        # find the "sort_by" field so that we can sort the report on that.
-        def thingy(out_field):
-            this = ""
-            if sort_by in out_field:
-                this = out_field
-            return this
+        if columns:
+            fields = columns
+        else:
+            if isinstance(_input, RowTable):
+                # rows with the same columns share a schema, so only look at each schema once
+                out_fields.update(dict.fromkeys(_input.columns()))
+            else:
+                for item in _input:
+                    out_fields.update(dict.fromkeys(item))
+            fields = report_fields(out_fields, sort_by)
 
-        writer = csv.DictWriter(
-            report, fieldnames=sorted(out_fields, key=thingy, reverse=True)
-        )
+        writer = csv.DictWriter(report, fieldnames=fields, extrasaction="ignore")
 
         # Write headers to CSV
         writer.writeheader()
 
+        if sort_keys:
+            _input = sorted(_input, key=row_sort_key(sort_keys))
+
         # Loop over the item list
         for item in _input:
             # Write row to csv file
             writer.writerow(item)
 
-def filter_by_last_active(data: list[dict[str,str]], last_active_str: str) -> list[dict[str,str]]:
+
+def write_report_stream(
+    _input, report_name, sort_by="serial_number", columns=None, sort_keys=None, fmt="csv"
+):
+    """Write the report from an iterable of flattened records, one row at a time.
+
+    If `columns` is given those are the report columns, in that order, and rows are
+    written straight to the report. Otherwise rows are spooled to a temporary JSON lines
+    file while the columns are discovered, then copied into the report, so only one
+    record is held in memory at a time. With `sort_keys` the rows are ordered by an
+    external merge sort, whose spilled runs double as the spool.
+
+    fmt is one of kandji_output.FORMATS. Parquet and Arrow always spool, since the
+    column types have to be known before the first row is written.
+
+    Returns the number of rows written.
+    """
+    count = 0
+    # dict keys double as an insertion ordered set of column names
+    out_fields = {}
+    typed = fmt in ("parquet", "arrow")
+    types = ColumnTypes() if typed else None
+
+    def discover(rows):
+        nonlocal count
+        for row in rows:
+            if not columns:
+                out_fields.update(dict.fromkeys(row))
+            if typed:
+                types.add(row)
+            count += 1
+            yield row
+
+    def write(rows):
+        fields = columns or report_fields(out_fields, sort_by)
+
+        if typed:
+            write_arrow(rows, report_name, fields, types, fmt)
+
+        elif fmt == "jsonl.zst":
+            if columns:
+                rows = ({field: row.get(field) for field in fields} for row in rows)
+            write_jsonl_zst(rows, report_name)
+
+        else:
+            with open_text(report_name, fmt) as report:
+                writer = csv.DictWriter(report, fieldnames=fields, extrasaction="ignore")
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(row)
+
+    if sort_keys:
+        rows = external_sort(discover(_input), sort_keys)
+        # the sort reads every row before handing back the first one, so once it has
+        # started all of the columns are known
+        first = next(rows, None)
+        write(itertools.chain([first], rows) if first is not None else ())
+        rows.close()
+
+    elif (columns and not typed) or fmt == "jsonl.zst":
+        write(discover(_input))
+
+    else:
+        with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as spool:
+            for item in discover(_input):
+                spool.write(json.dumps(item))
+                spool.write("\n")
+
+            spool.seek(0)
+            write(map(json.loads, spool))
+
+    return count
+
+
+def record_hash(record):
+    """Return a content hash for a device record."""
+    return hashlib.blake2b(
+        json.dumps(record, sort_keys=True).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def load_state(state_path):
+    """Return the saved state of the last --since-last-run report, or an empty state."""
+    try:
+        with open(state_path, encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state_path, state):
+    """Save the state of a --since-last-run report."""
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, state_path)
+
+
+def write_delta_report(
+    _input, report_name, state_path, sort_by="serial_number", sort_keys=None, columns=None
+):
+    """Write the report, only flattening records that changed since the last run.
+
+    The state file keeps a content hash and the columns per device_id, the name of the
+    last report and the --sort keys it was written with. Rows of unchanged devices are
+    copied from that report instead of being flattened again. The header has the columns
+    of the rows written, so columns that no device has any more are dropped, or just
+    `columns` if given. The report is only left alone if nothing changed and the sort
+    and columns are the same. Changing the columns flattens every record again.
+
+    Returns a dict of added, changed, removed and unchanged counts.
+    """
+    state = load_state(state_path)
+    previous_hashes = state.get("hashes", {})
+    previous_report = state.get("report")
+    # devices share the column lists, so each device only stores an index into them
+    previous_schemas = state.get("schemas", [])
+    previous_schema_of = state.get("schema_of", {})
+
+    # rows from the last report, keyed by device_id
+    previous_rows = {}
+    previous_fields = []
+    # the last report only holds the columns it was written with, and rows can only be
+    # matched up if device_id is one of them
+    same_columns = state.get("columns") == (columns or None)
+    if previous_report and same_columns and os.path.exists(previous_report):
+        with open(previous_report, encoding="utf-8") as report:
+            reader = csv.DictReader(report)
+            previous_fields = reader.fieldnames or []
+            if "device_id" in previous_fields:
+                previous_rows = {row["device_id"]: row for row in reader}
+
+    counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    hashes = {}
+    rows = []
+    # columns of added and changed rows, in discovery order
+    new_fields = {}
+    # columns of copied rows
+    copied_fields = set()
+    # column list -> index, and device_id -> index, for the new state
+    schemas = {}
+    schema_of = {}
+
+    for record in _input:
+        device_id = record["device_id"]
+        hashes[device_id] = record_hash(record)
+
+        same = previous_hashes.get(device_id) == hashes[device_id]
+        if same and device_id in previous_rows:
+            row = previous_rows[device_id]
+            index = previous_schema_of.get(device_id)
+            if index is not None and index < len(previous_schemas):
+                fields = previous_schemas[index]
+            else:
+                # state from before columns were kept, the CSV only tells which have a value
+                fields = [field for field, value in row.items() if value]
+            copied_fields.update(fields)
+            schema_of[device_id] = schemas.setdefault(tuple(fields), len(schemas))
+            rows.append(row)
+            counts["unchanged"] += 1
+            continue
+
+        flattened = flatten(record)
+        new_fields.update(dict.fromkeys(flattened))
+        schema_of[device_id] = schemas.setdefault(tuple(flattened), len(schemas))
+        rows.append(flattened)
+        if same:
+            counts["unchanged"] += 1
+        else:
+            counts["changed" if device_id in previous_hashes else "added"] += 1
+
+    counts["removed"] = len(previous_hashes.keys() - hashes.keys())
+
+    unchanged = not (counts["added"] or counts["changed"] or counts["removed"])
+    same_sort = state.get("sort") == (sort_keys or None)
+    if unchanged and same_sort and previous_report == report_name and previous_rows:
+        return counts
+
+    out_fields = dict.fromkeys(field for field in previous_fields if field in copied_fields)
+    out_fields.update(new_fields)
+
+    if sort_keys:
+        rows.sort(key=row_sort_key(sort_keys))
+
+    with open(report_name, mode="w", encoding="utf-8") as report:
+        # copied rows still hold the blank cells of dropped columns
+        writer = csv.DictWriter(
+            report,
+            fieldnames=columns or report_fields(out_fields, sort_by),
+            extrasaction="ignore",
+        )
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+    save_state(
+        state_path,
+        {
+            "report": report_name,
+            "hashes": hashes,
+            "schemas": [list(fields) for fields in schemas],
+            "schema_of": schema_of,
+            "sort": sort_keys or None,
+            "columns": columns or None,
+        },
+    )
+    return counts
+
+
+def last_active_cutoff(last_active_str: str) -> datetime:
+    """Return the check in date that devices must be older than."""
     now = datetime.now(tz=timezone.utc)
-    last_active_count = int(last_active_str[:-1])
-    last_active_unit = UNITS[ last_active_str[-1] ]
-    last_active_delta = timedelta(**{last_active_unit: last_active_count})
-    cutoff_date = now - last_active_delta
-    return [
-        device
-        for device in data
-        if isoparse(device["last_check_in"]) < cutoff_date
-    ]
+    return now - parse_duration(last_active_str)
+
+
+def iter_filter_by_last_active(data, last_active_str: str):
+    """Yield only the devices that last checked in before the cutoff."""
+    from dateutil.parser import isoparse
+
+    cutoff_date = last_active_cutoff(last_active_str)
+    for device in data:
+        if isoparse(device["last_check_in"]) < cutoff_date:
+            yield device
+
+
+def filter_by_last_active(data: list[dict[str,str]], last_active_str: str) -> list[dict[str,str]]:
+    return list(iter_filter_by_last_active(data, last_active_str))
+
+
+def iter_stored_devices(store, params, max_age, last_check_in=None, workers=1, sizer=None):
+    """Yield device inventory from the local store, refreshing it from Kandji if stale."""
+    platform = params.get("platform")
+
+    if store.is_fresh(parse_duration(max_age), platform):
+        print(f"Using local device store synced at {synced_at_text(store.last_synced(platform))}")
+    else:
+        print(f"Refreshing local device store {store.path} from Kandji...")
+        count = store.sync(iter_devices(params=params, workers=workers, sizer=sizer), platform)
+        print(f"Stored records: {count}")
+
+    older_than = last_active_cutoff(last_check_in) if last_check_in else None
+    yield from store.devices(platform=platform, older_than=older_than)
+
+
+def open_journal(arguments, report_name, params, base_url, tenant=None):
+    """Return the CrawlJournal of a crawl for --resume, or None without it."""
+    if not arguments.resume:
+        return None
+
+    report_type = report_name.split("_report_")[0]
+    if arguments.checkpoint:
+        path = arguments.checkpoint
+        if tenant:
+            head, tail = os.path.split(path.rstrip(os.sep))
+            path = os.path.join(head, f"{tenant}_{tail}")
+    else:
+        path = f".{tenant}_{report_type}_crawl" if tenant else f".{report_type}_crawl"
+
+    journal = CrawlJournal(
+        path,
+        {
+            "url": f"{base_url}/v1/devices",
+            "params": params,
+            "ordering": "serial_number",
+            "limit": DEVICE_PAGE_LIMIT,
+        },
+    )
+    pages = journal.start()
+    if journal.finished:
+        print(f"Resuming from {path}: all {pages} pages were saved")
+    elif pages:
+        print(f"Resuming from {path}: {pages} pages saved, carrying on at offset {journal.next_offset}")
+    return journal
+
+
+def stream_report(arguments, params_dict, report_name, store=None, query=None):
+    """Fetch, filter, flatten and write the report one record at a time."""
+    journal = None
+    if store:
+        records = METRICS.timed(
+            "fetch",
+            iter_stored_devices(
+                store,
+                params_dict,
+                arguments.max_age,
+                last_check_in=arguments.last_check_in,
+                workers=arguments.workers,
+                sizer=page_sizer(arguments),
+            ),
+        )
+
+    else:
+        print("Streaming device inventory from Kandji into the report...")
+        # the store keeps the whole inventory, so --where is only pushed to the API here
+        if query:
+            params_dict = {**params_dict, **query.params}
+        journal = open_journal(arguments, report_name, params_dict, get_config().base_url)
+        records = METRICS.timed(
+            "fetch",
+            iter_devices(
+                params=params_dict,
+                workers=arguments.workers,
+                journal=journal,
+                sizer=page_sizer(arguments),
+            ),
+        )
+
+        if arguments.last_check_in:
+            print(f"Filtering down to only devices older than {arguments.last_check_in}")
+            records = METRICS.timed(
+                "filter", iter_filter_by_last_active(records, arguments.last_check_in)
+            )
+
+    if query:
+        records = METRICS.timed("filter", filter(query, records))
+
+    if arguments.enrich:
+        print(f"Adding {', '.join(arguments.enrich)} for each device...")
+        records = METRICS.timed(
+            "enrich",
+            iter_enriched_devices(
+                records,
+                arguments.enrich,
+                report_name,
+                workers=arguments.enrich_workers,
+                apps_table=arguments.apps_table,
+            ),
+        )
+
+    sort_keys = arguments.sort.split(",") if arguments.sort else None
+    columns = arguments.columns.split(",") if arguments.columns else None
+
+    if arguments.since_last_run:
+        state_path = arguments.state or f".{report_name.split('_report_')[0]}_report_state.json"
+        with METRICS.phase("write"):
+            counts = write_delta_report(
+                records, report_name, state_path, sort_keys=sort_keys, columns=columns
+            )
+        print(
+            f"Added: {counts['added']}, changed: {counts['changed']}, "
+            f"removed: {counts['removed']}, unchanged: {counts['unchanged']}"
+        )
+        count = counts["added"] + counts["changed"] + counts["unchanged"]
+
+    else:
+        with METRICS.phase("write"):
+            count = write_report_stream(
+                METRICS.timed("flatten", iter_report_payload(records)),
+                report_name,
+                columns=columns,
+                sort_keys=sort_keys,
+                fmt=arguments.format,
+            )
+
+    if journal is not None:
+        journal.remove()
+
+    if count < 1:
+        print("No devices found...\n")
+        if os.path.exists(report_name):
+            os.remove(report_name)
+        sys.exit()
+
+    print(f"Total records written: {count}\n")
+    print("Kandji report complete ...")
+    print(f"Kandji report at: {HERE.resolve()}/{report_name}")
 
 
 def main():
     """Run main logic."""
+    global METRICS
+
     # Return the arguments
     arguments = program_arguments()
 
-    var_validation()
+    METRICS = Metrics(enabled=bool(arguments.metrics_out), profile=arguments.profile)
+    METRICS.start()
+    try:
+        run_report(arguments)
+    finally:
+        METRICS.finish(arguments.metrics_out)
+
+
+def write_device_report(report_payload, report_name, arguments):
+    """Write the flattened device records to the report file."""
+    print("Generating device report for the following devices ...")
+
+    # check to see if we are sorting by a particular column heading
+    sort_keys = arguments.sort.split(",") if arguments.sort else None
+    columns = arguments.columns.split(",") if arguments.columns else None
+    with METRICS.phase("write"):
+        if arguments.format == "csv":
+            write_report(report_payload, report_name, sort_keys=sort_keys, columns=columns)
+        else:
+            if sort_keys:
+                report_payload.sort(key=row_sort_key(sort_keys))
+            write_report_stream(
+                map(dict, report_payload), report_name, columns=columns, fmt=arguments.format
+            )
+
+    print("Kandji report complete ...")
+    print(f"Kandji report at: {HERE.resolve()}/{report_name}")
+
+
+def crawl_tenant(config, arguments, params_dict, query=None, journal=None):
+    """Return the filtered, and enriched, device records of one tenant as a RowTable.
+
+    Each record gets a leading tenant field. The tenant has its own connection pool and
+    rate limiter, so one tenant being throttled does not slow down the others.
+    """
+    rate_limit = arguments.rate_limit if config.rate_limit is None else config.rate_limit
+    client = KandjiClient(
+        config.base_url,
+        headers={} if arguments.replay else config.headers,
+        pool_size=max(arguments.pool_size, arguments.workers, arguments.enrich_workers),
+        rate_limit=rate_limit,
+        metrics=METRICS if METRICS.enabled else None,
+        cache=CACHE,
+        replay=arguments.replay,
+    )
+
+    with client:
+        records = iter_devices(
+            params=params_dict,
+            client=client,
+            workers=arguments.workers,
+            journal=journal,
+            sizer=page_sizer(arguments, client),
+        )
+        if query:
+            records = filter(query, records)
+        if arguments.last_check_in:
+            records = iter_filter_by_last_active(records, arguments.last_check_in)
+        if arguments.enrich:
+            enricher = DeviceEnricher(
+                arguments.enrich, workers=arguments.enrich_workers, client=client
+            )
+            records = enricher.enrich(records)
+        return generate_report_payload({"tenant": config.name, **record} for record in records)
+
+
+def run_tenant_reports(arguments, tenants, params_dict, report_name, query=None):
+    """Crawl every tenant concurrently and write a merged report or one per tenant."""
+    if query:
+        params_dict = {**params_dict, **query.params}
+
+    journals = {
+        config.name: open_journal(
+            arguments, report_name, params_dict, config.base_url, tenant=config.name
+        )
+        for config in tenants
+    }
+
+    print(f"Getting device inventory from {len(tenants)} Kandji tenants...")
+    results = {}
+    failures = {}
+    with METRICS.phase("fetch"), ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+        futures = {
+            executor.submit(
+                crawl_tenant, config, arguments, params_dict, query, journals[config.name]
+            ): config.name
+            for config in tenants
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            # a failing tenant should not take the others down with it
+            except (KandjiAPIError, CacheMiss, OSError, SystemExit) as error:
+                failures[name] = error
+                print(f"Tenant {name} failed: {error}")
+            else:
+                print(f"Tenant {name}: {len(results[name])} devices")
+
+    # tenants keep the order of the tenants file
+    names = [config.name for config in tenants if config.name in results]
+    if arguments.tenant_output == "split":
+        for name in names:
+            if results[name]:
+                write_device_report(results[name], f"{name}_{report_name}", arguments)
+            else:
+                print(f"No devices found for tenant {name}...\n")
+    else:
+        report_payload = RowTable()
+        for name in names:
+            report_payload.extend(results.pop(name))
+        if report_payload:
+            write_device_report(report_payload, report_name, arguments)
+        else:
+            print("No devices found...\n")
+
+    # the reports of these tenants are written, so their crawls need no resuming
+    for name in names:
+        if journals[name] is not None:
+            journals[name].remove()
+
+    if failures:
+        sys.exit(f"\n\tNo report for tenants: {', '.join(sorted(failures))}\n")
+
+
+def check_where_filters(params_dict, query):
+    """Exit if --where pushes down an API filter that another option sets differently.
+
+    The --where params replace the API filters of the other options (--platform), so a
+    query asking for another value would silently return the wrong devices.
+    """
+    for field, value in query.params.items():
+        if field in params_dict and params_dict[field] != value:
+            sys.exit(
+                f"\n\t--where asks for {field} {value} but --{field} asks for "
+                f"{params_dict[field]}, so no device can match. Drop one of them.\n"
+            )
+
+
+def run_report(arguments):
+    """Build the device report for the parsed arguments."""
+    global CACHE, JSON_DECODER
+
+    JSON_DECODER = arguments.json_decoder
+    if JSON_DECODER == "orjson":
+        import_optional("orjson", "orjson")
+
+    if arguments.replay:
+        if not arguments.cache_dir:
+            sys.exit("\n\t--replay needs the --cache-dir of a recorded run\n")
+        # the recorded pages are keyed by their limit, which would not be the same twice
+        if arguments.adaptive_pages:
+            sys.exit("\n\t--adaptive-pages cannot be used with --replay\n")
+        # pages past the end of the inventory were only recorded if that run asked for them
+        arguments.workers = 1
+    if arguments.cache_dir:
+        try:
+            ttl = parse_duration(arguments.cache_ttl).total_seconds()
+        except (KeyError, ValueError):
+            sys.exit(f"\n\tInvalid --cache-ttl {arguments.cache_ttl}\n")
+        CACHE = ResponseCache(arguments.cache_dir, ttl=ttl)
+
+    if arguments.enrich:
+        arguments.enrich = [kind.strip() for kind in arguments.enrich.split(",")]
+        for kind in arguments.enrich:
+            if kind not in ENRICH_KINDS:
+                sys.exit(f"\n\tUnknown --enrich value {kind}. Use {','.join(ENRICH_KINDS)}\n")
+
+    tenants = None
+    if arguments.tenants:
+        for option in ("store", "stream", "since_last_run", "apps_table"):
+            if getattr(arguments, option):
+                sys.exit(f"\n\t--{option.replace('_', '-')} cannot be used with --tenants\n")
+        import_optional("requests", "requests")
+        try:
+            tenants = load_tenants(arguments.tenants)
+            # resolve every tenant up front, so that a missing token fails before any crawl
+            for config in tenants:
+                config.base_url
+                if not arguments.replay:
+                    config.headers
+        except ConfigError as error:
+            sys.exit(f"\n{error}\n")
+
+    else:
+        var_validation(replay=arguments.replay)
+
+        # open the shared connection pool used by every API call in this run
+        get_client(
+            pool_size=max(
+                arguments.pool_size,
+                arguments.workers,
+                arguments.enrich_workers if arguments.enrich else 0,
+            ),
+            rate_limit=arguments.rate_limit,
+            replay=arguments.replay,
+        )
 
     print(f"\nRunning: {SCRIPT_NAME} ...")
     print(f"Version: {__version__}\n")
-    print(f"Base URL: {BASE_URL}\n")
+    if tenants:
+        for config in tenants:
+            print(f"Tenant {config.name}: {config.base_url}")
+        print()
+    else:
+        print(f"Base URL: {get_config().base_url}\n")
 
     # dict placeholder for params passed to api requests
     params_dict = {}
@@ -423,36 +1799,110 @@ def main():
     else:
         report_name = f"devices_report_{TODAY}.csv"
 
-    # Get all device inventory records
+    if arguments.format != "csv":
+        if arguments.since_last_run:
+            sys.exit("\n\t--since-last-run only supports the csv format\n")
+        report_name = report_path(report_name, arguments.format)
+
+    # compile --where once, up front, so that a typo fails before any API calls
+    query = None
+    if arguments.where:
+        try:
+            query = compile_where(arguments.where)
+        except QueryError as error:
+            sys.exit(f"\n\t{error}\n")
+        check_where_filters(params_dict, query)
+        print(f"Filtering devices where: {arguments.where}")
+        if query.params:
+            print(f"Filters sent to the Kandji API: {query.params}\n")
+
+    if tenants:
+        run_tenant_reports(arguments, tenants, params_dict, report_name, query=query)
+        return
+
+    if arguments.store:
+        if arguments.resume:
+            sys.exit("\n\t--resume cannot be used with --store\n")
+        with InventoryStore(arguments.store) as store:
+            stream_report(arguments, params_dict, report_name, store=store, query=query)
+        return
+
+    if arguments.stream or arguments.since_last_run:
+        stream_report(arguments, params_dict, report_name, query=query)
+        return
+
+    if query:
+        params_dict.update(query.params)
+
+    # Get all device inventory records. Each record is filtered, enriched and flattened
+    # as its page arrives, so only the compact report rows are held in memory and not
+    # the raw inventory as well.
     print("Getting device inventory from Kandji...")
-    device_inventory = get_devices(params=params_dict)
-    print(f"Total records returned: {len(device_inventory)}\n")
+    journal = open_journal(arguments, report_name, params_dict, get_config().base_url)
+    counts = collections.Counter()
+    records = count_records(
+        METRICS.timed(
+            "fetch",
+            iter_devices(
+                params=params_dict,
+                workers=arguments.workers,
+                journal=journal,
+                sizer=page_sizer(arguments),
+            ),
+        ),
+        counts,
+        "returned",
+    )
+
+    if query:
+        records = count_records(METRICS.timed("filter", filter(query, records)), counts, "where")
 
     if arguments.last_check_in:
         print(f"Filtering down to only devices older than {arguments.last_check_in}")
-        device_inventory = filter_by_last_active(device_inventory, arguments.last_check_in)
-        print(f"Remaining records: {len(device_inventory)}")
-
-    # list to hold all device details
-    device_info_list = []
+        records = count_records(
+            METRICS.timed(
+                "filter", iter_filter_by_last_active(records, arguments.last_check_in)
+            ),
+            counts,
+            "remaining",
+        )
 
-    # Get device details for each device
-    for device in device_inventory:
-        # add the device dict to the list
-        device_info_list.append(device)
+    # Get device details and the app names and app versions for each device
+    if arguments.enrich:
+        print(f"Adding {', '.join(arguments.enrich)} for each device...")
+        records = METRICS.timed(
+            "enrich",
+            iter_enriched_devices(
+                records,
+                arguments.enrich,
+                report_name,
+                workers=arguments.enrich_workers,
+                apps_table=arguments.apps_table,
+            ),
+        )
 
-    # Get the app names and app versions from the app details by passing a list of
-    # device ids
-    report_payload = generate_report_payload(device_info_list)
+    with METRICS.phase("flatten"):
+        report_payload = generate_report_payload(records)
 
-    print("Generating device report for the following devices ...")
+    print(f"Total records returned: {counts['returned']}\n")
+    if counts["returned"] < 1:
+        print("No devices found...\n")
+        sys.exit()
+    if query:
+        print(f"Records matching --where: {counts['where']}")
+    if arguments.last_check_in:
+        print(f"Remaining records: {counts['remaining']}")
 
-    # check to see if we are sorting by a particular column heading
-    write_report(report_payload, report_name)
+    write_device_report(report_payload, report_name, arguments)
 
-    print("Kandji report complete ...")
-    print(f"Kandji report at: {HERE.resolve()}/{report_name}")
+    if journal is not None:
+        journal.remove()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except KandjiAPIError as error:
+        sys.exit(f"\n\tKandji API error: {error}\n")
+    except CacheMiss as error:
+        sys.exit(f"\n\tCannot replay: {error}. Record it by running with --cache-dir first\n")
@@ -0,0 +1,108 @@
+"""JSON decoding for Kandji API responses."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Three decoders can be picked with --json-decoder:
+#
+#       json    the standard library, decoding the response bytes directly
+#       orjson  orjson, a faster drop-in decoder (python3 -m pip install orjson)
+#       stream  the standard library, parsing a JSON array one item at a time while the
+#               response is still downloading, so the first records reach the report
+#               before the page has finished
+#
+#   Every decoder takes the raw response bytes, so the body is never also held as a str.
+#
+################################################################################################
+
+import codecs
+import json
+import re
+
+DECODERS = ("json", "orjson", "stream")
+
+# Bytes read from the socket at a time by the stream decoder
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# Characters that may follow an item in an array
+DELIMITERS = frozenset(" \t\n\r,]")
+
+
+def get_loads(decoder="json"):
+    """Return a function that decodes a whole JSON document from bytes."""
+    if decoder == "orjson":
+        from kandji_output import import_optional
+
+        return import_optional("orjson", "orjson").loads
+    if decoder not in DECODERS:
+        raise ValueError(f"Unknown JSON decoder {decoder}. Use one of {', '.join(DECODERS)}")
+    return json.loads
+
+
+def iter_json_array(chunks):
+    """Yield the items of a JSON array from an iterable of byte chunks.
+
+    Each item is yielded as soon as all of it has arrived. Raises ValueError if the
+    document is not an array or is cut short.
+    """
+    chunks = iter(chunks)
+    scan = json.JSONDecoder().raw_decode
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    finished = False
+    # start -> first item or ] -> separator -> item -> separator ...
+    state = "start"
+
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        need_more = position == len(buffer)
+
+        if not need_more:
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                position += 1
+                state = "first"
+                continue
+            if state == "separator":
+                if char == "]":
+                    return
+                if char != ",":
+                    raise ValueError(f"Expected , or ] in JSON array, found {char!r}")
+                position += 1
+                state = "item"
+                continue
+            if char == "]" and state == "first":
+                return
+            try:
+                item, end = scan(buffer, position)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                need_more = True
+            else:
+                # a number cut off by the end of a chunk also parses, so only accept an
+                # item once the character after it has arrived
+                if finished or (end < len(buffer) and buffer[end] in DELIMITERS):
+                    position = end
+                    state = "separator"
+                    yield item
+                    continue
+                need_more = True
+
+        if finished:
+            raise ValueError("JSON array is incomplete")
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            chunk_text = text.decode(b"", final=True)
+        else:
+            chunk_text = text.decode(chunk)
+        # drop everything already parsed, so the buffer only holds the current item
+        buffer = buffer[position:] + chunk_text
+        position = 0
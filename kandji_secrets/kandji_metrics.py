@@ -0,0 +1,283 @@
+"""Per-phase timing and request telemetry for the Kandji scripts."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Metrics splits a run into phases (fetch, filter, flatten, write, ...) and records
+#   for each one the wall time spent in it and the HTTP requests that completed while it
+#   was running: count, bytes received, retries, status codes and latency percentiles.
+#
+#   Phases are exclusive. Entering a phase pauses the one that was running, so when a
+#   streaming pipeline pulls a record through fetch -> filter -> flatten -> write, each
+#   step is only charged for its own work. Requests made by worker threads count
+#   towards whichever phase the main thread is in when the response arrives.
+#
+#   --profile cpu runs cProfile over the whole run and dumps the stats to a .prof file.
+#   --profile memory runs tracemalloc, records the peak traced memory of each phase and
+#   lists the top allocation sites.
+#
+################################################################################################
+
+import contextlib
+import json
+import pathlib
+import threading
+import time
+
+# Phase used for time and requests outside any named phase
+OTHER = "other"
+
+# Number of entries listed from cProfile and tracemalloc
+TOP = 15
+
+
+class Phase:
+    """Counters for a single phase."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.status_codes = {}
+        self.latencies = []
+        self.peak_memory = 0
+
+    def summary(self):
+        """Return the counters as a dict that can be written as JSON."""
+        summary = {
+            "seconds": round(self.seconds, 6),
+            "requests": self.requests,
+            "bytes_received": self.bytes,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+        }
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            summary["latency_ms"] = {
+                name: round(percentile(ordered, fraction) * 1000, 3)
+                for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))
+            }
+        if self.peak_memory:
+            summary["peak_traced_mib"] = round(self.peak_memory / 2**20, 3)
+        return summary
+
+
+def percentile(ordered, fraction):
+    """Return the nearest-rank percentile of a sorted list."""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Metrics:
+    """Collects per-phase metrics for a run.
+
+    enabled - when False every method is a cheap no-op, so callers need no checks.
+    profile - None, "cpu" for cProfile or "memory" for tracemalloc.
+    """
+
+    def __init__(self, enabled=True, profile=None):
+        self.enabled = enabled or bool(profile)
+        self.profile = profile
+        self.phases = {}
+        self.stack = []
+        self.lock = threading.Lock()
+        self.started = None
+        self.mark = None
+        self.profiler = None
+        self.tracemalloc = None
+
+    def start(self):
+        """Start the run clock and the profiler, if any."""
+        if not self.enabled:
+            return
+        if self.profile == "cpu":
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == "memory":
+            import tracemalloc
+
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+        self.started = self.mark = time.perf_counter()
+
+    def get(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            # setdefault, as worker threads may add the same phase at the same time
+            phase = self.phases.setdefault(name, Phase())
+        return phase
+
+    def current(self):
+        return self.stack[-1] if self.stack else OTHER
+
+    def switch(self):
+        """Charge the time since the last switch to the running phase."""
+        now = time.perf_counter()
+        phase = self.get(self.current())
+        phase.seconds += now - self.mark
+        self.mark = now
+        if self.tracemalloc:
+            phase.peak_memory = max(phase.peak_memory, self.tracemalloc.get_traced_memory()[1])
+            self.tracemalloc.reset_peak()
+
+    def enter(self, name):
+        self.switch()
+        self.stack.append(name)
+
+    def leave(self):
+        self.switch()
+        self.stack.pop()
+
+    def phase(self, name):
+        """Return a context manager that runs its block as the named phase."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.phase_context(name)
+
+    @contextlib.contextmanager
+    def phase_context(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def timed(self, name, iterable):
+        """Return the iterable, charging the time spent producing each item to a phase."""
+        if not self.enabled:
+            return iterable
+        return self.timed_iter(name, iter(iterable))
+
+    def timed_iter(self, name, iterator):
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            yield item
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests response hook that records a completed request."""
+        if not self.enabled:
+            return response
+        # retries done by urllib3 (connection errors, 502, 504) are in the retry history
+        retries = getattr(response.raw, "retries", None)
+        retried = len(retries.history) if retries is not None else 0
+        # reading a streamed body here would defeat streaming, so use its declared size
+        if kwargs.get("stream"):
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            size = len(response.content)
+        self.record(response.status_code, response.elapsed.total_seconds(), size, retried)
+        return response
+
+    def record(self, status_code, seconds, size, retried=0):
+        """Record a completed request made without requests, e.g. by the asyncio engine."""
+        if not self.enabled:
+            return
+        with self.lock:
+            phase = self.get(self.current())
+            phase.requests += 1
+            phase.bytes += size
+            phase.retries += retried
+            phase.status_codes[status_code] = phase.status_codes.get(status_code, 0) + 1
+            phase.latencies.append(seconds)
+
+    def hooks(self):
+        """Return the hooks argument for requests calls."""
+        return {"response": [self.response_hook]} if self.enabled else {}
+
+    def retried(self):
+        """Record a request retried by the caller, e.g. after a 429."""
+        if self.enabled:
+            with self.lock:
+                self.get(self.current()).retries += 1
+
+    def cached(self):
+        """Record a request answered from the response cache."""
+        if self.enabled:
+            with self.lock:
+                self.get(self.current()).cache_hits += 1
+
+    def summary(self):
+        """Return every phase, and the run totals, as a dict."""
+        total = Phase()
+        for phase in self.phases.values():
+            total.seconds += phase.seconds
+            total.requests += phase.requests
+            total.bytes += phase.bytes
+            total.retries += phase.retries
+            total.cache_hits += phase.cache_hits
+            total.latencies.extend(phase.latencies)
+            total.peak_memory = max(total.peak_memory, phase.peak_memory)
+            for code, count in phase.status_codes.items():
+                total.status_codes[code] = total.status_codes.get(code, 0) + count
+        return {
+            "phases": {
+                name: phase.summary()
+                for name, phase in self.phases.items()
+                if phase.seconds or phase.requests or phase.cache_hits
+            },
+            "total": total.summary(),
+        }
+
+    def finish(self, metrics_out=None):
+        """Stop profiling, print a summary and write it to metrics_out if given."""
+        if not self.enabled or self.started is None:
+            return
+        while self.stack:
+            self.leave()
+        self.switch()
+        summary = self.summary()
+        stem = pathlib.Path(metrics_out).with_suffix("") if metrics_out else pathlib.Path("kandji")
+
+        if self.profiler:
+            import pstats
+
+            self.profiler.disable()
+            profile_path = f"{stem}.prof"
+            self.profiler.dump_stats(profile_path)
+            summary["cpu_profile"] = profile_path
+            print(f"\nTop {TOP} functions by cumulative time (full profile in {profile_path}):")
+            pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(TOP)
+
+        if self.tracemalloc:
+            snapshot = self.tracemalloc.take_snapshot()
+            self.tracemalloc.stop()
+            summary["top_allocations"] = [
+                {"where": str(stat.traceback), "mib": round(stat.size / 2**20, 3)}
+                for stat in snapshot.statistics("lineno")[:TOP]
+            ]
+
+        print("\nPhase          seconds  requests      bytes  retries  p50 ms  p99 ms")
+        for name, phase in [*summary["phases"].items(), ("total", summary["total"])]:
+            latency = phase.get("latency_ms", {})
+            print(
+                f"{name:<12} {phase['seconds']:>9.3f} {phase['requests']:>9} "
+                f"{phase['bytes_received']:>10} {phase['retries']:>8} "
+                f"{latency.get('p50', '-'):>7} {latency.get('p99', '-'):>7}"
+            )
+        if self.tracemalloc:
+            peaks = {
+                name: phase["peak_traced_mib"]
+                for name, phase in summary["phases"].items()
+                if "peak_traced_mib" in phase
+            }
+            print(f"Peak traced memory (MiB): {peaks}")
+        if summary["total"]["cache_hits"]:
+            print(f"Cache hits: {summary['total']['cache_hits']}")
+        if summary["total"]["status_codes"]:
+            print(f"Status codes: {summary['total']['status_codes']}")
+
+        if metrics_out:
+            with open(metrics_out, mode="w", encoding="utf-8") as metrics_file:
+                json.dump(summary, metrics_file, indent=2)
+            print(f"Metrics written to {metrics_out}")
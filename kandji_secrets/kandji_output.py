@@ -0,0 +1,186 @@
+"""Report output formats for kandji_devices_report.py."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   The device report is written as CSV by default. This module adds gzipped CSV,
+#   zstandard compressed JSON lines, and typed Parquet and Arrow IPC files. For the
+#   typed formats the type of every column is worked out while the rows are spooled,
+#   so timestamps such as last_check_in become real UTC datetime columns.
+#
+#   Parquet and Arrow need pyarrow, and jsonl.zst needs zstandard. Both are only
+#   imported when one of those formats is asked for.
+#
+################################################################################################
+
+import gzip
+import json
+import re
+import sys
+
+FORMATS = ("csv", "csv.gz", "jsonl.zst", "parquet", "arrow")
+
+# Rows per record batch when writing Parquet and Arrow files
+BATCH_SIZE = 10_000
+
+TIMESTAMP_RE = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?$")
+
+
+def import_optional(module, package):
+    """Import an optional module, or exit with install instructions."""
+    try:
+        return __import__(module, fromlist=["_"])
+    except ImportError as import_error:
+        print(import_error)
+        sys.exit(
+            f"Looks like you need to install the {package} module. Open a Terminal and run  "
+            f"python3 -m pip install {package}."
+        )
+
+
+def report_path(report_name, fmt):
+    """Return the report name with the extension for the format."""
+    stem = report_name[: -len(".csv")] if report_name.endswith(".csv") else report_name
+    return f"{stem}.{fmt}"
+
+
+def open_text(report_name, fmt):
+    """Open a text report for writing, compressed if the format asks for it."""
+    if fmt == "csv.gz":
+        return gzip.open(report_name, mode="wt", encoding="utf-8")
+    return open(report_name, mode="w", encoding="utf-8")
+
+
+class ColumnTypes:
+    """Works out a single type for every report column from the values seen.
+
+    Columns holding only booleans, integers, numbers or ISO 8601 timestamps get that
+    type. Anything else, including mixed columns, is written as text.
+    """
+
+    def __init__(self):
+        # column -> set of kinds seen
+        self.kinds = {}
+
+    def add(self, row):
+        """Record the kinds of the values of a row."""
+        for column, value in row.items():
+            kinds = self.kinds.get(column)
+            if kinds is None:
+                kinds = self.kinds[column] = set()
+            kinds.add(value_kind(value))
+
+    def resolve(self, column):
+        """Return one of bool, int, float, timestamp or string for the column."""
+        kinds = self.kinds.get(column, set()) - {"null"}
+        if kinds == {"bool"}:
+            return "bool"
+        if kinds == {"int"}:
+            return "int"
+        if kinds and kinds <= {"int", "float"}:
+            return "float"
+        if kinds == {"timestamp"}:
+            return "timestamp"
+        return "string"
+
+
+def value_kind(value):
+    """Return the kind of a single value."""
+    if value is None or value == "":
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str) and TIMESTAMP_RE.match(value):
+        return "timestamp"
+    return "other"
+
+
+def converter(column_type):
+    """Return a function that turns a raw value into the column type."""
+    if column_type == "timestamp":
+        from dateutil.parser import isoparse
+
+        return lambda value: isoparse(value) if value else None
+    if column_type == "string":
+
+        def to_text(value):
+            if value is None:
+                return None
+            if isinstance(value, str):
+                return value
+            if isinstance(value, (list, dict)):
+                return json.dumps(value)
+            return str(value)
+
+        return to_text
+    return lambda value: None if value == "" else value
+
+
+def arrow_schema(pa, fields, types):
+    """Return the pyarrow schema for the report columns."""
+    arrow_types = {
+        "bool": pa.bool_(),
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+        "string": pa.string(),
+    }
+    return pa.schema([(field, arrow_types[types.resolve(field)]) for field in fields])
+
+
+def write_arrow(rows, report_name, fields, types, fmt):
+    """Write rows to a Parquet or Arrow IPC file in record batches.
+
+    rows   - iterable of flattened records.
+    fields - report columns, in order.
+    types  - ColumnTypes collected from the same rows.
+    """
+    pa = import_optional("pyarrow", "pyarrow")
+    schema = arrow_schema(pa, fields, types)
+    converters = [converter(types.resolve(field)) for field in fields]
+
+    if fmt == "parquet":
+        parquet = import_optional("pyarrow.parquet", "pyarrow")
+        writer = parquet.ParquetWriter(report_name, schema, compression="zstd")
+        write_batch = writer.write_batch
+    else:
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        writer = pa.ipc.new_file(report_name, schema, options=options)
+        write_batch = writer.write_batch
+
+    def flush(batch):
+        arrays = [
+            pa.array([convert(row.get(field)) for row in batch], type=schema.field(index).type)
+            for index, (field, convert) in enumerate(zip(fields, converters))
+        ]
+        write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    finally:
+        writer.close()
+
+
+def write_jsonl_zst(rows, report_name):
+    """Write rows as zstandard compressed JSON lines. Returns the number of rows."""
+    zstandard = import_optional("zstandard", "zstandard")
+    count = 0
+    with open(report_name, mode="wb") as raw:
+        with zstandard.ZstdCompressor().stream_writer(raw) as report:
+            for row in rows:
+                report.write(json.dumps(row).encode("utf-8"))
+                report.write(b"\n")
+                count += 1
+    return count
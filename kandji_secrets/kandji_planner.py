@@ -0,0 +1,151 @@
+"""Plans which secrets are worth asking Kandji for, device by device."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Not every secret exists on every platform. FileVault keys and unlock PINs are Mac
+#   only, so asking for them for an iPhone or an Apple TV is a round-trip that can only
+#   come back 404. SecretsPlanner skips those calls using the platform of each device,
+#   taken from the platform column of a devices report, or worked out from the model.
+#
+#   It also learns. Every 404 and every success is counted per model and secret in a
+#   small JSON cache. With skip_learned, once a model has answered 404 for a secret
+#   LEARN_AFTER times without ever returning it, the secret is skipped for that model
+#   from then on. One call in PROBE_EVERY is still sent, so a model that starts having
+#   the secret (say after FileVault is turned on) is noticed. A learned skip is only a
+#   guess, so it is off by default and its cells are written as LEARNED_SKIP rather than
+#   blank, which would read as "this device has no such secret".
+#
+################################################################################################
+
+import json
+import os
+import tempfile
+import threading
+
+# Secrets that only exist on these platforms
+PLATFORM_SECRETS = {
+    "filevaultkey": frozenset(["Mac"]),
+    "unlockpin": frozenset(["Mac"]),
+}
+
+# (text found in a model name, platform), checked in order
+MODEL_PLATFORMS = (
+    ("iphone", "iPhone"),
+    ("ipad", "iPad"),
+    ("apple tv", "AppleTV"),
+    ("appletv", "AppleTV"),
+    ("mac", "Mac"),
+)
+
+# 404s for a model and secret, with no success, before the secret is skipped for the model
+LEARN_AFTER = 10
+
+# One call in this many is still sent for a learned skip
+PROBE_EVERY = 50
+
+# Cell written for a secret skipped because of what was learned
+LEARNED_SKIP = "not requested: model usually 404"
+
+
+def device_platform(device):
+    """Return the platform of a device row, or None if it cannot be told."""
+    platform = device.get("platform")
+    if platform:
+        return platform
+    model = (device.get("model") or "").lower()
+    for text, platform in MODEL_PLATFORMS:
+        if text in model:
+            return platform
+    return None
+
+
+class SecretsPlanner:
+    """Thread-safe picker of the secrets to request for each device.
+
+    secrets - names of the secrets asked for, e.g. ("filevaultkey", "bypasscode").
+    path    - optional JSON file the learned 404 counts are loaded from and saved to.
+    rules   - skip secrets by platform and count 404s. Without it every secret asked for
+              is requested.
+    skip_learned - also skip secrets that a model keeps answering 404 for.
+    """
+
+    def __init__(self, secrets, path=None, rules=True, skip_learned=False):
+        self.secrets = tuple(secrets)
+        self.path = path
+        self.rules = rules
+        self.skip_learned = skip_learned
+        # model -> secret -> [404s, successes]
+        self.models = {}
+        # (model, secret) -> calls skipped since the last probe
+        self.skips = {}
+        # secret -> calls skipped by platform, and by what was learned
+        self.skipped = dict.fromkeys(self.secrets, 0)
+        self.learned = dict.fromkeys(self.secrets, 0)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the counts learned by earlier runs, if there are any."""
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                self.models = json.load(cache_file).get("models", {})
+        except (OSError, ValueError):
+            self.models = {}
+
+    def save(self):
+        """Write the learned counts, atomically."""
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, mode="w", encoding="utf-8") as cache_file:
+                with self.lock:
+                    json.dump({"models": self.models}, cache_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def plan(self, device, secret):
+        """Return None if the secret should be requested for the device, or else the
+        cell to write for it: blank if it was not asked for or cannot exist on the
+        platform, LEARNED_SKIP if the model keeps answering 404 for it."""
+        if secret not in self.secrets:
+            return ""
+        if not self.rules:
+            return None
+
+        platform = device_platform(device)
+        platforms = PLATFORM_SECRETS.get(secret)
+        if platform and platforms and platform not in platforms:
+            with self.lock:
+                self.skipped[secret] += 1
+            return ""
+
+        model = device.get("model")
+        if not self.skip_learned or not model:
+            return None
+        with self.lock:
+            not_found, found = self.models.get(model, {}).get(secret, (0, 0))
+            if found or not_found < LEARN_AFTER:
+                return None
+            key = (model, secret)
+            self.skips[key] = self.skips.get(key, 0) + 1
+            if self.skips[key] >= PROBE_EVERY:
+                self.skips[key] = 0
+                return None
+            self.learned[secret] += 1
+            return LEARNED_SKIP
+
+    def learn(self, device, secret, status_code):
+        """Count the answer to a request: a 404, or the secret."""
+        model = device.get("model")
+        if not self.rules or not model or status_code not in (200, 404):
+            return
+        with self.lock:
+            counts = self.models.setdefault(model, {}).setdefault(secret, [0, 0])
+            counts[status_code == 200] += 1
@@ -0,0 +1,305 @@
+"""Small predicate language for filtering Kandji device records."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Compiles a --where expression such as
+#
+#       platform == "Mac" and os_version < "14" and last_check_in older 30d
+#
+#   once into a predicate over raw device records. Equality tests on fields that the
+#   GET /v1/devices endpoint can filter on are also returned as query params, so that
+#   the API does the narrowing before anything is downloaded.
+#
+#   expression  := or_expr
+#   or_expr     := and_expr ("or" and_expr)*
+#   and_expr    := not_expr ("and" not_expr)*
+#   not_expr    := "not" not_expr | "(" expression ")" | comparison
+#   comparison  := field ("==" | "!=" | "<" | "<=" | ">" | ">=") literal
+#                | field ("older" | "newer") duration
+#                | field "contains" literal
+#                | field ["not"] "in" "(" literal ("," literal)* ")"
+#   literal     := "string" | number | true | false | null
+#
+#   Fields are record keys; use dots for nested values, e.g. user.email. Strings that
+#   look like versions (14, 13.6.1) compare numerically part by part.
+#
+################################################################################################
+
+import operator
+import re
+from datetime import datetime, timedelta, timezone
+
+UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+# GET /v1/devices query params that filter on a record field of the same name
+API_FILTERS = frozenset(
+    [
+        "asset_tag",
+        "blueprint_id",
+        "device_id",
+        "device_name",
+        "model",
+        "os_version",
+        "platform",
+        "serial_number",
+    ]
+)
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+KEYWORDS = {"and", "or", "not", "in", "contains", "older", "newer", "true", "false", "null"}
+
+TOKEN_RE = re.compile(
+    r"""
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<duration>\d+[smhdw])\b
+      | (?P<number>-?\d+(?:\.\d+)?)\b
+      | (?P<op>==|!=|<=|>=|<|>|\(|\)|,)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    )""",
+    re.VERBOSE,
+)
+
+VERSION_RE = re.compile(r"^\d+(?:\.\d+)*$")
+
+
+class QueryError(ValueError):
+    """Raised when a --where expression cannot be parsed."""
+
+
+def parse_duration(duration_str: str) -> timedelta:
+    """Return a timedelta for a duration such as 30d or 26w."""
+    duration_count = int(duration_str[:-1])
+    duration_unit = UNITS[ duration_str[-1] ]
+    return timedelta(**{duration_unit: duration_count})
+
+
+def tokenize(text):
+    """Return a list of (kind, value) tokens."""
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if not match:
+            raise QueryError(f"Unexpected input at {position}: {text[position:]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.lower() in KEYWORDS:
+            kind, value = "keyword", value.lower()
+        elif kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def field_getter(field):
+    """Return a function that reads a (possibly dotted) field from a record."""
+    path = field.split(".")
+    if len(path) == 1:
+        return lambda record: record.get(field)
+
+    def get(record):
+        value = record
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    return get
+
+
+def comparable(left, right):
+    """Return both values in a form that compares sensibly, versions as int tuples."""
+    # numbers are compared against text as text, so that os_version >= 14 works
+    if isinstance(left, str) and isinstance(right, (int, float)) and not isinstance(right, bool):
+        right = str(right)
+    elif isinstance(right, str) and isinstance(left, (int, float)) and not isinstance(left, bool):
+        left = str(left)
+
+    if isinstance(left, str) and isinstance(right, str):
+        if VERSION_RE.match(left) and VERSION_RE.match(right):
+            return tuple(map(int, left.split("."))), tuple(map(int, right.split(".")))
+    return left, right
+
+
+class Query:
+    """A compiled --where expression.
+
+    predicate - function of a raw device record, True if the record matches.
+    params    - GET /v1/devices query params that are implied by the expression.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.params = {}
+        self.tokens = tokenize(text)
+        self.position = 0
+        if not self.tokens:
+            raise QueryError("Empty --where expression")
+        self.predicate = self.parse_or(top_level=True)
+        if self.position != len(self.tokens):
+            raise QueryError(f"Unexpected {self.tokens[self.position][1]!r} in --where")
+
+    def __call__(self, record):
+        return self.predicate(record)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            expected = value or kind or "more input"
+            raise QueryError(f"Expected {expected} in --where, got {token[1]!r}")
+        self.position += 1
+        return token[1]
+
+    def parse_or(self, top_level=False):
+        terms = [self.parse_and(top_level)]
+        while self.peek() == ("keyword", "or"):
+            self.take()
+            terms.append(self.parse_and())
+        if len(terms) > 1:
+            # pushdown is only safe for terms that every match has to satisfy
+            if top_level:
+                self.params.clear()
+            return lambda record: any(term(record) for term in terms)
+        return terms[0]
+
+    def parse_and(self, top_level=False):
+        terms = [self.parse_not(top_level)]
+        while self.peek() == ("keyword", "and"):
+            self.take()
+            terms.append(self.parse_not(top_level))
+        if len(terms) > 1:
+            return lambda record: all(term(record) for term in terms)
+        return terms[0]
+
+    def parse_not(self, top_level=False):
+        if self.peek() == ("keyword", "not"):
+            self.take()
+            term = self.parse_not()
+            return lambda record: not term(record)
+        if self.peek() == ("op", "("):
+            self.take()
+            term = self.parse_or()
+            self.take("op", ")")
+            return term
+        return self.parse_comparison(top_level)
+
+    def parse_literal(self):
+        kind, value = self.peek()
+        if kind in ("string", "number"):
+            self.take()
+            return value
+        if kind == "keyword" and value in ("true", "false", "null"):
+            self.take()
+            return {"true": True, "false": False, "null": None}[value]
+        raise QueryError(f"Expected a value in --where, got {value!r}")
+
+    def parse_comparison(self, top_level=False):
+        field = self.take("name")
+        get = field_getter(field)
+        kind, word = self.peek()
+
+        if kind == "op" and word in COMPARISONS:
+            self.take()
+            literal = self.parse_literal()
+            compare = COMPARISONS[word]
+
+            if top_level and word == "==" and field in API_FILTERS and literal is not None:
+                self.params[field] = str(literal).lower() if isinstance(literal, bool) else str(literal)
+
+            def comparison(record):
+                value = get(record)
+                if value is None or literal is None:
+                    return compare(value, literal) if word in ("==", "!=") else False
+                try:
+                    return compare(*comparable(value, literal))
+                except TypeError:
+                    return False
+
+            return comparison
+
+        if kind == "keyword" and word in ("older", "newer"):
+            from dateutil.parser import isoparse
+
+            self.take()
+            duration = parse_duration(self.take("duration"))
+            cutoff = datetime.now(tz=timezone.utc) - duration
+            older = word == "older"
+
+            def age(record):
+                value = get(record)
+                if not value:
+                    return False
+                try:
+                    when = isoparse(value)
+                except (TypeError, ValueError):
+                    return False
+                if when.tzinfo is None:
+                    when = when.replace(tzinfo=timezone.utc)
+                return when < cutoff if older else when >= cutoff
+
+            return age
+
+        if kind == "keyword" and word == "contains":
+            self.take()
+            literal = self.parse_literal()
+
+            def contains(record):
+                value = get(record)
+                if isinstance(value, str):
+                    return str(literal).lower() in value.lower()
+                if isinstance(value, list):
+                    return literal in value
+                return False
+
+            return contains
+
+        negate = False
+        if kind == "keyword" and word == "not":
+            self.take()
+            negate = True
+        if self.peek() == ("keyword", "in"):
+            self.take()
+            self.take("op", "(")
+            literals = [self.parse_literal()]
+            while self.peek() == ("op", ","):
+                self.take()
+                literals.append(self.parse_literal())
+            self.take("op", ")")
+            choices = set(literals)
+
+            def within(record):
+                try:
+                    return (get(record) in choices) != negate
+                except TypeError:
+                    # lists and dicts cannot be one of the literals
+                    return negate
+
+            return within
+
+        raise QueryError(f"Expected a comparison after {field!r} in --where, got {word!r}")
+
+
+def compile_where(text):
+    """Compile a --where expression into a Query."""
+    return Query(text)
@@ -0,0 +1,141 @@
+"""Compact in-memory storage for flattened report rows."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   A flattened device is a dict of a few hundred columns, and a report built in memory
+#   holds one such dict per device, each with its own hash table repeating the same
+#   column names. RowTable keeps every row as a tuple of values instead, against a
+#   Schema that is shared by all rows with the same columns in the same order.
+#
+#   Short strings that repeat down a column (platform, model, os_version, ...) are
+#   stored once per table. Columns whose values are mostly unique, such as serial
+#   numbers, stop being interned once they pass INTERN_LIMIT distinct values.
+#
+#   Rows are read-only mappings, so the filters, sort keys and csv.DictWriter used on
+#   flattened dicts work on them unchanged. dict(row) gives a plain dict back.
+#
+################################################################################################
+
+from collections.abc import Mapping
+
+# Distinct values kept per column before a column stops being interned
+INTERN_LIMIT = 1024
+
+# Longest string that gets interned
+INTERN_LENGTH = 64
+
+
+class Schema:
+    """The columns, in order, of a group of rows."""
+
+    __slots__ = ("columns", "index")
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.index = {column: position for position, column in enumerate(columns)}
+
+
+class Row(Mapping):
+    """A read-only flattened record stored as a tuple against a shared Schema."""
+
+    __slots__ = ("schema", "values")
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, column):
+        return self.values[self.schema.index[column]]
+
+    def get(self, column, default=None):
+        position = self.schema.index.get(column)
+        return default if position is None else self.values[position]
+
+    def __contains__(self, column):
+        return column in self.schema.index
+
+    def __iter__(self):
+        return iter(self.schema.columns)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return self.schema.index.keys()
+
+    def __repr__(self):
+        return f"Row({dict(self)!r})"
+
+
+class RowTable:
+    """A list of flattened records stored as Rows.
+
+    rows - optional iterable of flattened dicts to add.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = []
+        # column names -> Schema
+        self.schemas = {}
+        # column -> {value: value} for columns that are still being interned
+        self.values = {}
+        # columns with too many distinct values to intern
+        self.unique = set()
+        self.extend(rows)
+
+    def append(self, record):
+        """Add a flattened dict, or a Row from another table."""
+        if isinstance(record, Row):
+            columns = record.schema.columns
+            schema = self.schemas.setdefault(columns, record.schema)
+            self.rows.append(record if schema is record.schema else Row(schema, record.values))
+            return
+        columns = tuple(record)
+        schema = self.schemas.get(columns)
+        if schema is None:
+            schema = self.schemas[columns] = Schema(columns)
+        self.rows.append(Row(schema, tuple(map(self.intern, columns, record.values()))))
+
+    def extend(self, records):
+        """Add flattened dicts or Rows."""
+        for record in records:
+            self.append(record)
+
+    def intern(self, column, value):
+        """Return the table's copy of a short string value, adding it if new."""
+        if type(value) is not str or len(value) > INTERN_LENGTH or column in self.unique:
+            return value
+        seen = self.values.get(column)
+        if seen is None:
+            seen = self.values[column] = {}
+        stored = seen.get(value)
+        if stored is not None:
+            return stored
+        if len(seen) >= INTERN_LIMIT:
+            # mostly unique values, keeping them would cost more than it saves
+            self.unique.add(column)
+            del self.values[column]
+            return value
+        seen[value] = value
+        return value
+
+    def columns(self):
+        """Return every column in the order it was first seen, like dict.fromkeys over the rows."""
+        columns = {}
+        for schema in self.schemas.values():
+            columns.update(dict.fromkeys(schema.columns))
+        return list(columns)
+
+    def sort(self, key=None, reverse=False):
+        self.rows.sort(key=key, reverse=reverse)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
@@ -0,0 +1,194 @@
+"""Local SQLite store for Kandji device inventory records."""
+
+################################################################################################
+# Software Information
+################################################################################################
+#
+#   Device records from GET /v1/devices are upserted by device_id, with the columns that
+#   reports filter on pulled out and indexed. The full record is kept as JSON so that
+#   reports built from the store match reports built from the API.
+#
+#   Each sync is recorded per platform ("*" for the whole tenant) so that callers can
+#   decide whether the stored inventory is fresh enough to answer from.
+#
+################################################################################################
+
+import json
+import time
+from datetime import datetime, timezone
+
+# scope used for syncs that cover every platform
+ALL_PLATFORMS = "*"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device_id     TEXT PRIMARY KEY,
+    serial_number TEXT,
+    platform      TEXT,
+    last_check_in TEXT,
+    os_version    TEXT,
+    record        TEXT NOT NULL,
+    synced_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_serial_number ON devices (serial_number);
+CREATE INDEX IF NOT EXISTS devices_platform ON devices (platform);
+CREATE INDEX IF NOT EXISTS devices_last_check_in ON devices (last_check_in);
+CREATE INDEX IF NOT EXISTS devices_os_version ON devices (os_version);
+CREATE TABLE IF NOT EXISTS syncs (
+    scope     TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+def normalize_timestamp(value):
+    """Return an ISO 8601 UTC timestamp that sorts correctly as text, or None."""
+    if not value:
+        return None
+    from dateutil.parser import isoparse
+
+    try:
+        parsed = isoparse(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class InventoryStore:
+    """SQLite backed device inventory.
+
+    path - database file to open or create.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def upsert(self, records, synced_at=None):
+        """Insert or update device records by device_id. Returns the number written."""
+        synced_at = synced_at or time.time()
+        rows = (
+            (
+                record["device_id"],
+                record.get("serial_number"),
+                record.get("platform"),
+                normalize_timestamp(record.get("last_check_in")),
+                record.get("os_version"),
+                json.dumps(record),
+                synced_at,
+            )
+            for record in records
+        )
+        with self.db:
+            cursor = self.db.executemany(
+                """
+                INSERT INTO devices
+                    (device_id, serial_number, platform, last_check_in, os_version,
+                     record, synced_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (device_id) DO UPDATE SET
+                    serial_number = excluded.serial_number,
+                    platform = excluded.platform,
+                    last_check_in = excluded.last_check_in,
+                    os_version = excluded.os_version,
+                    record = excluded.record,
+                    synced_at = excluded.synced_at
+                """,
+                rows,
+            )
+        return cursor.rowcount
+
+    def sync(self, records, platform=None):
+        """Replace the stored inventory for a platform (or all) with a full crawl.
+
+        Devices in scope that were not part of the crawl are removed.
+        Returns the number of records written.
+        """
+        started = time.time()
+        count = self.upsert(records, synced_at=started)
+        scope = platform or ALL_PLATFORMS
+
+        with self.db:
+            if platform:
+                self.db.execute(
+                    "DELETE FROM devices WHERE platform = ? AND synced_at < ?",
+                    (platform, started),
+                )
+            else:
+                self.db.execute("DELETE FROM devices WHERE synced_at < ?", (started,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO syncs (scope, synced_at) VALUES (?, ?)",
+                (scope, started),
+            )
+        return count
+
+    def last_synced(self, platform=None):
+        """Return the time of the last full sync covering the platform, or None."""
+        scopes = [ALL_PLATFORMS] + ([platform] if platform else [])
+        row = self.db.execute(
+            f"SELECT MAX(synced_at) FROM syncs WHERE scope IN ({','.join('?' * len(scopes))})",
+            scopes,
+        ).fetchone()
+        return row[0]
+
+    def is_fresh(self, max_age, platform=None):
+        """Return True if the platform was fully synced within max_age (a timedelta)."""
+        synced_at = self.last_synced(platform)
+        return synced_at is not None and time.time() - synced_at <= max_age.total_seconds()
+
+    def devices(self, platform=None, older_than=None, ordering="serial_number"):
+        """Yield stored device records.
+
+        platform   - only return devices of this platform.
+        older_than - only return devices that last checked in before this datetime.
+        ordering   - indexed column to order by, "-" prefix for descending.
+        """
+        field = ordering.lstrip("-")
+        if field not in ("device_id", "serial_number", "platform", "last_check_in", "os_version"):
+            raise ValueError(f"Cannot order stored devices by {ordering}")
+
+        clauses = []
+        values = []
+        if platform:
+            clauses.append("platform = ?")
+            values.append(platform)
+        if older_than:
+            clauses.append("last_check_in < ?")
+            values.append(normalize_timestamp(older_than.isoformat()))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        direction = "DESC" if ordering.startswith("-") else "ASC"
+        query = f"SELECT record FROM devices {where} ORDER BY {field} {direction}"
+
+        for (record,) in self.db.execute(query, values):
+            yield json.loads(record)
+
+    def count(self, platform=None):
+        """Return the number of stored devices."""
+        if platform:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM devices WHERE platform = ?", (platform,)
+            ).fetchone()
+        else:
+            row = self.db.execute("SELECT COUNT(*) FROM devices").fetchone()
+        return row[0]
+
+
+def synced_at_text(synced_at):
+    """Return a sync time as a readable local timestamp."""
+    return datetime.fromtimestamp(synced_at).strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,7 @@
+"""Shared setup for the kandji_secrets tests."""
+
+import pathlib
+import sys
+
+# the scripts import each other as top level modules
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,207 @@
+"""Checkpoints for --resume: device crawl pages and secrets dumps."""
+
+import csv
+import json
+import os
+
+from kandji_checkpoint import CrawlJournal, SecretsJournal
+
+CRAWL = {"url": "https://example.api.kandji.io/api/v1/devices", "params": {}, "limit": 3}
+
+
+def page(offset, count):
+    return [{"device_id": f"d{offset + index}"} for index in range(count)]
+
+
+def resumed(path, crawl=CRAWL, **kwargs):
+    journal = CrawlJournal(str(path), crawl, **kwargs)
+    return journal, journal.start()
+
+
+# CrawlJournal
+
+
+def test_new_crawl_has_nothing_to_replay(tmp_path):
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 0
+    assert journal.next_offset == 0
+    assert not journal.finished
+
+
+def test_resume_replays_saved_pages_in_order(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+    journal.add(3, page(3, 3))
+
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 2
+    assert journal.next_offset == 6
+    assert not journal.finished
+    assert [records for records in journal.completed()] == [page(0, 3), page(3, 3)]
+    assert journal.device_ids == {f"d{index}" for index in range(6)}
+
+
+def test_short_page_finishes_the_crawl(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+    journal.add(3, page(3, 1))
+    assert journal.finished
+
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 2
+    assert journal.finished
+
+
+def test_replay_stops_at_the_first_gap(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+    # page 3 never finished, page 6 did
+    journal.add(6, page(6, 3))
+
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 1
+    assert journal.next_offset == 3
+
+
+def test_unreadable_page_is_fetched_again(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+    journal.add(3, page(3, 3))
+    with open(journal.page_path(3), "wb") as page_file:
+        page_file.write(b"not gzip")
+
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 1
+    assert journal.next_offset == 3
+
+
+def test_pages_keep_their_own_size(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 5), limit=5)
+    journal.add(5, page(5, 2), limit=2)
+
+    journal, replayed = resumed(tmp_path / "crawl")
+    assert replayed == 2
+    assert journal.next_offset == 7
+
+
+def test_different_crawl_starts_over(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+
+    journal, replayed = resumed(tmp_path / "crawl", crawl={**CRAWL, "params": {"platform": "Mac"}})
+    assert replayed == 0
+    assert not os.path.exists(journal.page_path(0))
+
+
+def test_old_checkpoint_starts_over(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+
+    journal, replayed = resumed(tmp_path / "crawl", max_age=-1)
+    assert replayed == 0
+
+
+def test_remove(tmp_path):
+    journal, _ = resumed(tmp_path / "crawl")
+    journal.add(0, page(0, 3))
+    journal.remove()
+    assert not os.path.exists(tmp_path / "crawl")
+
+
+# SecretsJournal
+
+COLUMNS = ["filevault_key", "bypass_code"]
+FIELDS = ["device_id", *COLUMNS]
+
+
+def write_rows(path, rows, header=True):
+    with open(path, mode="a", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDS)
+        if header:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({field: "" if row[field] is None else row[field] for field in FIELDS})
+
+
+def read_rows(path):
+    with open(path, newline="") as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def first_run(tmp_path):
+    """A run that wrote three devices, the second with a failed bypass code."""
+    output = str(tmp_path / "secrets.csv")
+    journal = SecretsJournal(output, COLUMNS)
+    assert journal.load() == 0
+    rows = [
+        {"device_id": "a", "filevault_key": "k1", "bypass_code": "b1"},
+        {"device_id": "b", "filevault_key": "k2", "bypass_code": None},
+        {"device_id": "c", "filevault_key": "", "bypass_code": "b3"},
+    ]
+    for row in rows:
+        journal.add(row)
+    write_rows(output, rows)
+    journal.finish(complete=False)
+    return output
+
+
+def test_resume_skips_done_devices_and_retries_failed_secrets(tmp_path):
+    output = first_run(tmp_path)
+    journal = SecretsJournal(output, COLUMNS)
+    assert journal.load() == 2
+    assert journal.failed == {"b"}
+
+    devices = [{"device_id": device_id} for device_id in "abcd"]
+    todo = list(journal.resume(devices))
+    # b comes back as its row, with only the failed secret left to fetch
+    assert todo == [
+        {"device_id": "b", "filevault_key": "k2", "bypass_code": None},
+        {"device_id": "d"},
+    ]
+    journal.file.close()
+
+
+def test_finish_compacts_the_output_and_removes_the_journal(tmp_path):
+    output = first_run(tmp_path)
+    journal = SecretsJournal(output, COLUMNS)
+    journal.load()
+    rows = [
+        {"device_id": "b", "filevault_key": "k2", "bypass_code": "b2"},
+        {"device_id": "d", "filevault_key": "k4", "bypass_code": "b4"},
+    ]
+    for row in rows:
+        journal.add(row)
+    write_rows(output, rows, header=False)
+    journal.finish(complete=True)
+
+    assert [(row["device_id"], row["bypass_code"]) for row in read_rows(output)] == [
+        ("a", "b1"),
+        ("b", "b2"),
+        ("c", "b3"),
+        ("d", "b4"),
+    ]
+    assert not os.path.exists(journal.path)
+
+
+def test_journal_is_kept_while_secrets_still_fail(tmp_path):
+    output = first_run(tmp_path)
+    journal = SecretsJournal(output, COLUMNS)
+    journal.load()
+    row = {"device_id": "b", "filevault_key": "k2", "bypass_code": None}
+    journal.add(row)
+    write_rows(output, [row], header=False)
+    journal.finish(complete=True)
+
+    assert os.path.exists(journal.path)
+    assert [row["device_id"] for row in read_rows(output)] == ["a", "b", "c"]
+
+
+def test_torn_journal_line_is_ignored(tmp_path):
+    output = first_run(tmp_path)
+    with open(f"{output}.journal", mode="a", encoding="utf-8") as journal_file:
+        journal_file.write(json.dumps({"device_id": "c", "failed": ["bypass_code"]})[:10])
+    journal = SecretsJournal(output, COLUMNS)
+    assert journal.load() == 2
+    assert set(journal.partial) == {"b"}
+    journal.file.close()
@@ -0,0 +1,47 @@
+"""flatten() turns nested device records into report columns."""
+
+from kandji_devices_report import flatten
+
+
+def test_nested_dicts_and_lists():
+    record = {
+        "device_id": "a",
+        "user": {"name": "x", "email": {"work": "w"}},
+        "tags": ["one", "two"],
+        "volumes": [{"name": "Macintosh HD", "encrypted": True}, "other"],
+    }
+    assert flatten(record) == {
+        "device_id": "a",
+        "user_name": "x",
+        "user_email_work": "w",
+        "tags_1": "one",
+        "tags_2": "two",
+        "volumes_1_name": "Macintosh HD",
+        "volumes_1_encrypted": True,
+        "volumes_2": "other",
+    }
+
+
+def test_keeps_record_key_order():
+    record = {"a": 1, "b": {"c": 2, "d": [3]}, "e": 4}
+    assert list(flatten(record)) == ["a", "b_c", "b_d_1", "e"]
+
+
+def test_empty_values_and_lists_in_lists_are_kept():
+    record = {"details": {}, "apps": [], "matrix": [[1, 2], [3]], "none": None}
+    assert flatten(record) == {
+        "details": {},
+        "apps": [],
+        "matrix_1": [1, 2],
+        "matrix_2": [3],
+        "none": None,
+    }
+
+
+def test_lists_inside_list_items_are_broken_out():
+    record = {"apps": [{"name": "n", "versions": ["1", "2"]}]}
+    assert flatten(record) == {"apps_1_name": "n", "apps_1_versions_1": "1", "apps_1_versions_2": "2"}
+
+
+def test_separator_and_prefix():
+    assert flatten({"a": {"b": 1}}, separator=".", prefix="x.") == {"x.a.b": 1}
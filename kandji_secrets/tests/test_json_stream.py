@@ -0,0 +1,67 @@
+"""iter_json_array parses a JSON array one item at a time, however it is chunked."""
+
+import json
+
+import pytest
+
+from kandji_json import get_loads, iter_json_array
+
+ITEMS = [
+    {"device_id": "a", "name": "café ☕", "tags": ["x", "]", ","], "n": 12345},
+    [],
+    {},
+    -1.5,
+    12,
+    "text with \"quotes\" and ] and ,",
+    True,
+    None,
+]
+
+
+def chunked(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1 << 20])
+def test_items_across_any_chunking(size):
+    data = json.dumps(ITEMS, ensure_ascii=False).encode("utf-8")
+    assert list(iter_json_array(chunked(data, size))) == ITEMS
+
+
+def test_whitespace_between_tokens():
+    data = b' \n[ 1 ,\n\t2 , {"a" : [ 3 ] } ]\n '
+    assert list(iter_json_array(chunked(data, 2))) == [1, 2, {"a": [3]}]
+
+
+def test_numbers_cut_by_a_chunk_boundary():
+    # 123 must not be yielded as 1 when the chunk ends after its first digit
+    assert list(iter_json_array([b"[1", b"23,4", b"56]"])) == [123, 456]
+
+
+def test_empty_array():
+    assert list(iter_json_array([b"[", b"]"])) == []
+    assert list(iter_json_array([b" [ ] "])) == []
+
+
+def test_items_are_yielded_before_the_array_ends():
+    def chunks():
+        yield b'[{"a": 1}, '
+        raise AssertionError("read past the first item")
+
+    assert next(iter_json_array(chunks())) == {"a": 1}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b'{"a": 1}', b"[1, 2", b'[1, {"a": ', b"[1 2]", b"", b"[1,]"],
+)
+def test_bad_documents_raise(data):
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunked(data, 3)))
+
+
+def test_get_loads():
+    assert get_loads("json")(b'[{"a": 1}]') == [{"a": 1}]
+    assert get_loads("stream")(b"[1]") == [1]
+    with pytest.raises(ValueError, match="Unknown JSON decoder"):
+        get_loads("yaml")
@@ -0,0 +1,30 @@
+"""Metrics costs nothing when it is not enabled."""
+
+import types
+
+from kandji_metrics import Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.start()
+    response = types.SimpleNamespace(status_code=200)
+    # a disabled hook must not touch the response, e.g. read its body
+    assert metrics.response_hook(response) is response
+    metrics.record(200, 0.1, 10)
+    metrics.retried()
+    metrics.cached()
+    assert metrics.phases == {}
+
+
+def test_enabled_metrics_record_per_phase():
+    metrics = Metrics(enabled=True)
+    metrics.start()
+    with metrics.phase("fetch"):
+        metrics.record(200, 0.1, 10)
+        metrics.record(429, 0.2, 5, retried=1)
+    summary = metrics.summary()["phases"]["fetch"]
+    assert summary["requests"] == 2
+    assert summary["bytes_received"] == 15
+    assert summary["retries"] == 1
+    assert summary["status_codes"] == {"200": 1, "429": 1}
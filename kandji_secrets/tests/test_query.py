@@ -0,0 +1,238 @@
+"""--where expressions: parsing, evaluation and API pushdown."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import kandji_devices_report as report
+from kandji_query import QueryError, compile_where, parse_duration, tokenize
+
+MAC = {
+    "platform": "Mac",
+    "model": "MacBook Air (M2, 2022)",
+    "os_version": "14.4.1",
+    "blueprint_id": "bp-1",
+    "app_count": 120,
+    "user": {"email": "it@example.com", "name": "IT"},
+    "tags": ["loaner", "eng"],
+    "supervised": True,
+    "asset_tag": None,
+}
+IPHONE = {
+    "platform": "iPhone",
+    "model": "iPhone 15",
+    "os_version": "17.2",
+    "blueprint_id": "bp-2",
+    "app_count": 9,
+    "user": {"email": "someone@example.com"},
+    "tags": [],
+    "supervised": False,
+}
+
+
+def matches(text, *records):
+    query = compile_where(text)
+    return [query(record) for record in records]
+
+
+def checked_in(days_ago):
+    when = datetime.now(tz=timezone.utc) - timedelta(days=days_ago)
+    return {"last_check_in": when.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+
+
+# precedence
+
+
+def test_and_binds_tighter_than_or():
+    # platform == "iPhone" or (platform == "Mac" and app_count < 10)
+    assert matches('platform == "iPhone" or platform == "Mac" and app_count < 10', MAC, IPHONE) == [
+        False,
+        True,
+    ]
+
+
+def test_parentheses_override_precedence():
+    assert matches('(platform == "iPhone" or platform == "Mac") and app_count < 10', MAC, IPHONE) == [
+        False,
+        True,
+    ]
+
+
+def test_not_binds_tighter_than_and():
+    assert matches('not platform == "Mac" and app_count < 10', MAC, IPHONE) == [False, True]
+    assert matches('not (platform == "Mac" and app_count > 100)', MAC, IPHONE) == [False, True]
+
+
+def test_keywords_are_case_insensitive():
+    assert matches('platform == "Mac" AND NOT supervised == FALSE', MAC, IPHONE) == [True, False]
+
+
+# quoting and literals
+
+
+def test_single_and_double_quotes():
+    assert matches("model == 'iPhone 15'", MAC, IPHONE) == [False, True]
+    assert matches('model == "iPhone 15"', MAC, IPHONE) == [False, True]
+
+
+def test_escaped_quotes_in_strings():
+    assert tokenize(r'name == "say \"hi\""') == [("name", "name"), ("op", "=="), ("string", 'say "hi"')]
+    assert matches(r"name == 'it\'s'", {"name": "it's"}) == [True]
+
+
+def test_operators_inside_strings_are_text():
+    assert matches('model == "a and (b or c)"', {"model": "a and (b or c)"}) == [True]
+
+
+def test_numbers_booleans_and_null():
+    assert tokenize("a == 1.5 or b == -2") == [
+        ("name", "a"), ("op", "=="), ("number", 1.5), ("keyword", "or"),
+        ("name", "b"), ("op", "=="), ("number", -2),
+    ]
+    assert matches("supervised == true", MAC, IPHONE) == [True, False]
+    assert matches("asset_tag == null", MAC, IPHONE) == [True, True]
+    assert matches("asset_tag != null", MAC, {"asset_tag": "7"}) == [False, True]
+
+
+def test_versions_compare_part_by_part():
+    assert matches('os_version >= "14.10"', {"os_version": "14.9"}, {"os_version": "14.10.1"}) == [
+        False,
+        True,
+    ]
+    # numbers are compared against text as text, so they work on versions too
+    assert matches("os_version >= 14", MAC, {"os_version": "13.6.1"}) == [True, False]
+
+
+def test_dotted_fields_read_nested_values():
+    assert matches('user.email contains "it@"', MAC, IPHONE) == [True, False]
+    assert matches('user.name == "IT"', MAC, IPHONE) == [True, False]
+    assert matches('missing.deeper == "x"', MAC) == [False]
+
+
+def test_contains_text_and_lists():
+    assert matches('model contains "macbook"', MAC, IPHONE) == [True, False]
+    assert matches('tags contains "loaner"', MAC, IPHONE) == [True, False]
+
+
+def test_ordering_against_missing_values_is_false():
+    assert matches("app_count > 5", {}, {"app_count": None}) == [False, False]
+
+
+# in lists
+
+
+def test_in_list():
+    assert matches('platform in ("iPhone", "iPad")', MAC, IPHONE) == [False, True]
+    assert matches('platform not in ("iPhone", "iPad")', MAC, IPHONE) == [True, False]
+
+
+def test_in_list_with_one_item_and_numbers():
+    assert matches('platform in ("Mac")', MAC, IPHONE) == [True, False]
+    assert matches("app_count in (9, 10)", MAC, IPHONE) == [False, True]
+
+
+def test_in_list_against_a_list_value():
+    # a list cannot be one of the literals
+    assert matches('tags in ("eng")', MAC) == [False]
+    assert matches('tags not in ("eng")', MAC) == [True]
+
+
+# durations
+
+
+def test_parse_duration():
+    assert parse_duration("45s") == timedelta(seconds=45)
+    assert parse_duration("30d") == timedelta(days=30)
+    assert parse_duration("26w") == timedelta(weeks=26)
+
+
+def test_older_and_newer():
+    old, recent = checked_in(45), checked_in(2)
+    assert matches("last_check_in older 30d", old, recent) == [True, False]
+    assert matches("last_check_in newer 1w", old, recent) == [False, True]
+
+
+def test_durations_without_timezones_and_missing_dates():
+    naive = {"last_check_in": (datetime.now(tz=timezone.utc) - timedelta(days=40)).replace(tzinfo=None).isoformat()}
+    assert matches("last_check_in older 30d", naive, {}, {"last_check_in": "not a date"}) == [
+        True,
+        False,
+        False,
+    ]
+
+
+# errors
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "platform ==",
+        'platform == "Mac" and',
+        '(platform == "Mac"',
+        'platform == "Mac")',
+        'platform ~ "Mac"',
+        "platform in ()",
+        'platform "Mac"',
+        "last_check_in older soon",
+        'platform == "Mac',
+    ],
+)
+def test_bad_expressions_are_rejected(text):
+    with pytest.raises(QueryError):
+        compile_where(text)
+
+
+# pushdown
+
+
+def test_top_level_equality_on_api_fields_is_pushed_down():
+    query = compile_where('platform == "Mac" and blueprint_id == "bp-1" and app_count > 10')
+    assert query.params == {"platform": "Mac", "blueprint_id": "bp-1"}
+
+
+def test_only_equality_on_api_fields_is_pushed_down():
+    assert compile_where('platform != "Mac"').params == {}
+    assert compile_where('model contains "Mac"').params == {}
+    assert compile_where('user.email == "it@example.com"').params == {}
+    assert compile_where("asset_tag == null").params == {}
+
+
+def test_booleans_and_numbers_are_pushed_down_as_text():
+    assert compile_where("asset_tag == 7").params == {"asset_tag": "7"}
+
+
+def test_nothing_is_pushed_down_from_or_not_or_parentheses():
+    assert compile_where('platform == "Mac" or platform == "iPhone"').params == {}
+    assert compile_where('platform == "Mac" and model == "x" or app_count > 1').params == {}
+    assert compile_where('not platform == "Mac"').params == {}
+    assert compile_where('(platform == "Mac" or app_count > 1) and model == "x"').params == {
+        "model": "x"
+    }
+
+
+def test_pushed_down_filters_still_apply_client_side():
+    query = compile_where('platform == "Mac" and app_count > 100')
+    assert query.params == {"platform": "Mac"}
+    assert [query(MAC), query(IPHONE), query({**MAC, "app_count": 5})] == [True, False, False]
+
+
+# --platform conflicts
+
+
+def test_where_that_agrees_with_platform_is_accepted():
+    report.check_where_filters({"platform": "Mac"}, compile_where('platform == "Mac"'))
+    report.check_where_filters({}, compile_where('platform == "iPhone"'))
+
+
+def test_where_that_conflicts_with_platform_is_rejected():
+    with pytest.raises(SystemExit, match="--where asks for platform iPhone but --platform asks for Mac"):
+        report.check_where_filters({"platform": "Mac"}, compile_where('platform == "iPhone"'))
+
+
+def test_client_side_platform_filter_does_not_conflict():
+    # not pushed down, so it is simply ANDed with --platform on the client
+    report.check_where_filters(
+        {"platform": "Mac"}, compile_where('platform == "iPhone" or app_count > 1')
+    )
@@ -0,0 +1,73 @@
+"""RateLimiter starts on the first 429 and slows down once per burst."""
+
+import pytest
+
+import kandji_client
+from kandji_client import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kandji_client.time, "monotonic", clock)
+    return clock
+
+
+def send(limiter, clock, count, seconds):
+    """Send count requests spread over seconds."""
+    for _ in range(count):
+        assert limiter.reserve() == 0
+        clock.now += seconds / count
+
+
+def test_unlimited_until_first_429(clock):
+    limiter = RateLimiter(None)
+    send(limiter, clock, 1000, 0.1)
+    assert limiter.max_rate is None
+
+
+def test_first_429_rate_comes_from_recent_requests(clock):
+    limiter = RateLimiter(None)
+    send(limiter, clock, 10, 10)
+    # a long idle spell, then 20 requests per second
+    clock.now += 3600
+    send(limiter, clock, 100, 5)
+    limiter.throttled(0, sent_at=clock.now)
+    assert limiter.max_rate == pytest.approx(20, rel=0.05)
+    assert limiter.rate == pytest.approx(10, rel=0.05)
+
+
+def test_one_slow_down_per_burst(clock):
+    limiter = RateLimiter(40)
+    burst = clock.now
+    send(limiter, clock, 16, 0.1)
+    # every worker of the burst gets a 429
+    for _ in range(16):
+        limiter.throttled(1, sent_at=burst)
+    assert limiter.rate == 20
+    assert limiter.paused_until == pytest.approx(clock.now + 1)
+
+    # a request sent after the slow down that still gets a 429 halves the rate again
+    clock.now += 2
+    limiter.throttled(1, sent_at=clock.now)
+    assert limiter.rate == 10
+
+
+def test_recovery_is_paced_by_time_not_requests(clock):
+    limiter = RateLimiter(100)
+    limiter.throttled(0)
+    assert limiter.rate == 50
+    # requests go out at the current rate, so the rate climbs max_rate / 20 per second
+    started = clock.now
+    while limiter.rate < limiter.max_rate:
+        limiter.succeeded()
+        clock.now += 1 / limiter.rate
+    assert clock.now - started == pytest.approx(10, rel=0.05)
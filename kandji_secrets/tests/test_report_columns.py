@@ -0,0 +1,57 @@
+"""--columns limits the CSV report header on every write path."""
+
+import csv
+
+import kandji_devices_report as report
+
+RECORDS = [
+    {"device_id": "a", "serial_number": "S2", "model": "Mac mini", "user": {"name": "x"}},
+    {"device_id": "b", "serial_number": "S1", "model": "iPhone 15", "asset_tag": "7"},
+]
+
+COLUMNS = ["serial_number", "model"]
+
+
+def read(path):
+    with open(path, encoding="utf-8") as report_file:
+        reader = csv.DictReader(report_file)
+        return reader.fieldnames, list(reader)
+
+
+def test_write_report_columns(tmp_path):
+    path = tmp_path / "report.csv"
+    report.write_report(report.generate_report_payload(RECORDS), path, columns=COLUMNS)
+    header, rows = read(path)
+    assert header == COLUMNS
+    assert [row["serial_number"] for row in rows] == ["S2", "S1"]
+
+
+def test_write_report_without_columns_keeps_every_column(tmp_path):
+    path = tmp_path / "report.csv"
+    report.write_report(report.generate_report_payload(RECORDS), path)
+    header, _ = read(path)
+    assert {"device_id", "serial_number", "model", "user_name", "asset_tag"} <= set(header)
+
+
+def test_write_delta_report_columns(tmp_path):
+    path = str(tmp_path / "report.csv")
+    state = str(tmp_path / "state.json")
+    report.write_delta_report(iter(RECORDS), path, state, columns=COLUMNS)
+    assert read(path)[0] == COLUMNS
+
+    # unchanged rows are copied from the last report, which only has these columns
+    report.write_delta_report(iter(RECORDS), path, state, columns=COLUMNS, sort_keys=["serial_number"])
+    header, rows = read(path)
+    assert header == COLUMNS
+    assert [row["serial_number"] for row in rows] == ["S1", "S2"]
+
+
+def test_write_delta_report_new_columns_flatten_again(tmp_path):
+    path = str(tmp_path / "report.csv")
+    state = str(tmp_path / "state.json")
+    report.write_delta_report(iter(RECORDS), path, state, columns=COLUMNS)
+    counts = report.write_delta_report(iter(RECORDS), path, state, columns=["device_id", "asset_tag"])
+    assert counts["unchanged"] == 2
+    header, rows = read(path)
+    assert header == ["device_id", "asset_tag"]
+    assert [row["asset_tag"] for row in rows] == ["", "7"]
@@ -0,0 +1,56 @@
+"""--sort orders report rows the same way whether they are fresh or read from a CSV."""
+
+import csv
+
+import kandji_devices_report as report
+
+
+def sort(rows, *keys):
+    return sorted(rows, key=report.row_sort_key(list(keys)))
+
+
+def test_numbers_sort_as_numbers():
+    rows = [{"app_count": value} for value in (100, 2, 10, 1)]
+    assert [row["app_count"] for row in sort(rows, "app_count")] == [1, 2, 10, 100]
+
+
+def test_numeric_text_sorts_like_numbers():
+    # the same values read back from an earlier CSV report
+    rows = [{"app_count": value} for value in ("100", "2", "10", "1", "-3", "2.5")]
+    assert [row["app_count"] for row in sort(rows, "app_count")] == [
+        "-3", "1", "2", "2.5", "10", "100"
+    ]
+
+
+def test_missing_first_then_numbers_then_text():
+    rows = [{"user_id": "bob"}, {"user_id": 12}, {}, {"user_id": 3}, {"user_id": ""}]
+    assert [row.get("user_id") for row in sort(rows, "user_id")] == [None, "", 3, 12, "bob"]
+
+
+def test_secondary_keys():
+    rows = [
+        {"model": "b", "app_count": 9},
+        {"model": "a", "app_count": 10},
+        {"model": "a", "app_count": 9},
+    ]
+    assert sort(rows, "model", "app_count") == [rows[2], rows[1], rows[0]]
+
+
+def test_external_sort_matches_in_memory_sort():
+    rows = [{"device_id": str(index), "app_count": (index * 37) % 101} for index in range(500)]
+    merged = list(report.external_sort(iter(rows), ["app_count"], run_size=64))
+    assert merged == sort(rows, "app_count")
+
+
+def test_delta_resort_orders_copied_rows_as_numbers(tmp_path):
+    path = str(tmp_path / "report.csv")
+    state = str(tmp_path / "state.json")
+    records = [
+        {"device_id": str(index), "serial_number": f"S{index}", "app_count": count}
+        for index, count in enumerate((100, 2, 10, 1))
+    ]
+    report.write_delta_report(iter(records), path, state)
+    # nothing changed, but the new sort rewrites the report from the copied CSV rows
+    report.write_delta_report(iter(records), path, state, sort_keys=["app_count"])
+    with open(path, encoding="utf-8") as report_file:
+        assert [row["app_count"] for row in csv.DictReader(report_file)] == ["1", "2", "10", "100"]